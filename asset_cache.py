@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Keeps the images in an asset store (see asset_store.py) within a byte
+budget. Every read and write is recorded in 'assets/asset_cache.sqlite3';
+when the images pass the budget, the least valuable go: negatives, then
+crops, then everything else, least recently used first. Images queued for
+tweeting are never evicted. Anything evicted that's needed again is simply
+downloaded again. In a PackStore, eviction only drops index rows; the bytes
+stay in the pack until `python asset_store.py --compact`.
+
+Set BIRBYBOT_ASSET_BUDGET_MB to wrap the store `asset_store.get_store()`
+returns in an AssetCache, or sweep once:
+
+    python asset_cache.py --budget-mb 500
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import asset_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(asset_store.DEFAULT_ROOT, "asset_cache.sqlite3")
+# tweet.QUEUE_PATH, which can't be imported here: tweet.py uses the store.
+QUEUE_PATH = os.path.join(os.path.dirname(__file__), "tweet_queue.json")
+# Tags in the order their images are evicted.
+EVICTION_ORDER = ("prefiltered", "negative", "cropped", "positive")
+# Evicting stops once the images fit in this fraction of the budget, so that
+# it doesn't run again on the next write.
+LOW_WATER = 0.9
+
+
+def queued_names(queue_path=QUEUE_PATH):
+    """Returns set of names of photos in the tweet queue (see
+    `tweet.stage_tweets`)."""
+    try:
+        with open(queue_path) as f:
+            return {staged["name"] for staged in json.load(f)}
+    except FileNotFoundError:
+        return set()
+
+
+def _photo_name(filepath):
+    """Given 'path/to/assets/cropped/name_cropped.jpg', returns 'name'."""
+    return os.path.splitext(os.path.basename(filepath))[0].split("_")[0]
+
+
+class AssetCache(object):
+    """Asset store wrapper that records when each image was last used, and
+    evicts images to stay within max_bytes.
+
+    Args:
+        store (optional): What to wrap. Defaults to a DirectoryStore.
+        max_bytes (int, optional): Budget; None only evicts by age. Defaults
+        to None.
+        max_age (float, optional): Seconds after its last use an image is
+        evicted regardless of the budget. Defaults to None.
+        path (str, optional): SQLite database file. Defaults to
+        'path/to/assets/asset_cache.sqlite3'.
+        root (str, optional): Assets folder, scanned for images the database
+        doesn't know about yet. Defaults to 'path/to/assets'.
+        pinned (callable, optional): Returns set of photo names that mustn't
+        be evicted. Defaults to `queued_names`.
+    """
+
+    def __init__(self, store=None, max_bytes=None, max_age=None, path=DEFAULT_PATH,
+                 root=asset_store.DEFAULT_ROOT, pinned=queued_names):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.store = store or asset_store.DirectoryStore()
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.pinned = pinned
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("BEGIN IMMEDIATE")
+        self._db.execute("CREATE TABLE IF NOT EXISTS assets ("
+                         "filepath TEXT PRIMARY KEY, "
+                         "size INTEGER NOT NULL, "
+                         "tag TEXT NOT NULL, "
+                         "accessed REAL NOT NULL)")
+        # The total is kept in the database, by triggers, so that every
+        # process sharing it sees the same one.
+        if not self._db.execute("SELECT name FROM sqlite_master WHERE name = 'total'").fetchone():
+            self._db.execute("CREATE TABLE total (bytes INTEGER NOT NULL)")
+            self._db.execute("INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM assets")
+        self._db.execute("CREATE TRIGGER IF NOT EXISTS assets_inserted AFTER INSERT ON assets "
+                         "BEGIN UPDATE total SET bytes = bytes + NEW.size; END")
+        self._db.execute("CREATE TRIGGER IF NOT EXISTS assets_deleted AFTER DELETE ON assets "
+                         "BEGIN UPDATE total SET bytes = bytes - OLD.size; END")
+        self._db.execute("CREATE TRIGGER IF NOT EXISTS assets_resized AFTER UPDATE OF size "
+                         "ON assets BEGIN UPDATE total SET bytes = bytes - OLD.size + NEW.size; END")
+        self._db.commit()
+        self._scan(root)
+
+    def _scan(self, root):
+        """Records images already in the store as never used, so that they're
+        the first of their tag to go."""
+        known = {row[0] for row in self._db.execute("SELECT filepath FROM assets")}
+        found = list()
+        for folder in asset_store.TAG_DIRS.values():
+            for filepath in self.store.list(os.path.join(root, folder)):
+                if filepath not in known:
+                    found.append((filepath, self.store.size(filepath),
+                                  asset_store.tag_of(filepath), 0.0))
+        self._db.executemany("INSERT OR IGNORE INTO assets VALUES (?, ?, ?, ?)", found)
+        self._db.commit()
+        if found:
+            logger.info(f"Found {len(found)} images not in the cache index.")
+
+    def touch(self, filepath, size=None):
+        """Records that filepath was just used (and, if given, its size)."""
+        with self._lock:
+            if size is None:
+                self._db.execute("UPDATE assets SET accessed = ? WHERE filepath = ?",
+                                 (time.time(), filepath))
+            else:
+                # An upsert rather than a REPLACE, whose delete wouldn't fire
+                # the trigger keeping the total.
+                self._db.execute("INSERT INTO assets VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT (filepath) DO UPDATE SET size = excluded.size, "
+                                 "tag = excluded.tag, accessed = excluded.accessed",
+                                 (filepath, size, asset_store.tag_of(filepath), time.time()))
+            self._db.commit()
+
+    def _forget(self, filepath):
+        with self._lock:
+            self._db.execute("DELETE FROM assets WHERE filepath = ?", (filepath,))
+            self._db.commit()
+
+    @property
+    def total(self):
+        """Bytes of images in the cache, across every process using it."""
+        with self._lock:
+            return self._db.execute("SELECT bytes FROM total").fetchone()[0]
+
+    def exists(self, filepath):
+        return self.store.exists(filepath)
+
+    def size(self, filepath):
+        return self.store.size(filepath)
+
+    def list(self, directory):
+        return self.store.list(directory)
+
+    def read(self, filepath):
+        content = self.store.read(filepath)
+        self.touch(filepath)
+        return content
+
+    def read_stream(self, filepath, chunk_size):
+        yield from self.store.read_stream(filepath, chunk_size)
+        self.touch(filepath)
+
+    def write(self, filepath, content):
+        self.write_stream(filepath, [content])
+        return filepath
+
+    def write_stream(self, filepath, chunks):
+        size = self.store.write_stream(filepath, chunks)
+        self.touch(filepath, size)
+        if self.max_bytes is not None and self.total > self.max_bytes:
+            # The caller is about to use what it just wrote.
+            self.evict(keep={filepath})
+        return size
+
+    def move(self, filepath, new_filepath):
+        moved = self.store.move(filepath, new_filepath)
+        size = self.store.size(moved)
+        self._forget(filepath)
+        self.touch(moved, size)
+        return moved
+
+    def remove(self, filepath):
+        self._forget(filepath)
+        return self.store.remove(filepath)
+
+    def evict(self, keep=()):
+        """Removes images unused for max_age, then, if the rest are over
+        max_bytes, the first in EVICTION_ORDER until they fit in LOW_WATER of
+        it, least recently used first within each tag. Pinned photos stay.
+
+        The total and the images to evict are read, and the evicted images
+        dropped from the database, in one transaction, so that processes
+        evicting at once don't both count the same bytes.
+
+        Args:
+            keep (collection, optional): Filepaths not to evict this time.
+            Defaults to ().
+
+        Returns:
+            list of str filepaths evicted
+        """
+        pinned = self.pinned() if self.pinned else set()
+        tag_rank = " ".join(f"WHEN '{tag}' THEN {i}" for i, tag in enumerate(EVICTION_ORDER))
+        cutoff = time.time() - self.max_age if self.max_age is not None else None
+        target = self.max_bytes * LOW_WATER if self.max_bytes is not None else None
+        evicting = list()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                total = self._db.execute("SELECT bytes FROM total").fetchone()[0]
+                rows = self._db.execute("SELECT filepath, size, accessed FROM assets "
+                                        f"ORDER BY CASE tag {tag_rank} "
+                                        f"ELSE {len(EVICTION_ORDER)} END, accessed")
+                for filepath, size, accessed in rows:
+                    if filepath in keep or _photo_name(filepath) in pinned:
+                        continue
+                    too_old = cutoff is not None and accessed < cutoff
+                    too_big = target is not None and total > target
+                    if too_old or too_big:
+                        evicting.append(filepath)
+                        total -= size
+                self._db.executemany("DELETE FROM assets WHERE filepath = ?",
+                                     [(filepath,) for filepath in evicting])
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+        for filepath in evicting:
+            self.store.remove(filepath)
+        if evicting:
+            self.evicted += len(evicting)
+            logger.info(f"Evicted {len(evicting)} images; {total} bytes remain.")
+        return evicting
+
+    def stats(self):
+        """Returns dict of images and bytes cached, budget, and images evicted
+        by this instance."""
+        with self._lock:
+            images, total = self._db.execute("SELECT (SELECT COUNT(*) FROM assets), bytes "
+                                             "FROM total").fetchone()
+        return {"images": images, "bytes": total, "max_bytes": self.max_bytes,
+                "evicted": self.evicted}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+################################################################################
+
+if __name__ == "__main__":
+    import utils
+    utils.configure_logger(logger, console_output=True)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-mb", type=float, help="Most MB of images to keep.")
+    parser.add_argument("--max-age-days", type=float,
+                        help="Evict images unused for this many days.")
+    args = parser.parse_args()
+    store = asset_store.get_store()
+    cache = AssetCache(getattr(store, "store", store),
+                       max_bytes=int(args.budget_mb * 1024 * 1024) if args.budget_mb else None,
+                       max_age=args.max_age_days * 24 * 60 * 60 if args.max_age_days else None)
+    cache.evict()
+    logger.info(f"{cache.stats()}")
@@ -0,0 +1,457 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Where downloaded images, crops and tweet copies are kept. Everything else
+still names images by path, e.g. 'path/to/assets/negative/name.jpg', and
+reads and writes them through the store returned by `get_store()`:
+
+* `DirectoryStore` (the default) keeps one JPEG per file, as always.
+* `PackStore` appends every image to one pack file, 'assets/assets.pack'
+  (renumbered by each compaction), indexed by name and tag in
+  'assets/assets.sqlite3'. A path's folder (negative, negative/prefiltered,
+  cropped) is a tag in the index, so `move_neg` is an index update rather
+  than a rename. Reads are slices of a memory map.
+
+Set BIRBYBOT_ASSET_STORE=pack to use the pack file, after moving existing
+images into it:
+
+    python asset_store.py --migrate            # copy files into the pack
+    python asset_store.py --migrate --delete   # and remove them once verified
+    python asset_store.py --compact            # drop overwritten copies
+"""
+
+import argparse
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import pathlib
+import sqlite3
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(__file__), "assets")
+# Folder under the assets directory that each tag's images are in.
+TAG_DIRS = {"positive": "",
+            "negative": "negative",
+            "prefiltered": os.path.join("negative", "prefiltered"),
+            "cropped": "cropped"}
+
+
+def write_atomically(filepath, chunks):
+    """Writes chunks of bytes to filepath through a temporary file renamed
+    into place, so readers never see it half-written.
+
+    Returns:
+        int: bytes written
+    """
+    directory = os.path.dirname(filepath) or "."
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return size
+
+
+def tag_of(filepath):
+    """Given 'path/to/assets/negative/name.jpg', returns 'negative'."""
+    directory = os.sep + os.path.dirname(filepath)
+    for tag in ("prefiltered", "negative", "cropped"):
+        if directory.endswith(os.sep + TAG_DIRS[tag]):
+            return tag
+    return "positive"
+
+
+def _name(filepath):
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+
+class DirectoryStore(object):
+    """One file per image, at its path."""
+
+    def exists(self, filepath):
+        return os.path.exists(filepath)
+
+    def read(self, filepath):
+        with open(filepath, 'rb') as f:
+            return f.read()
+
+    def read_stream(self, filepath, chunk_size):
+        """Yields filepath's bytes chunk_size at a time."""
+        with open(filepath, 'rb') as f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+
+    def size(self, filepath):
+        return os.path.getsize(filepath)
+
+    def write(self, filepath, content):
+        """Saves bytes as filepath and returns filepath."""
+        self.write_stream(filepath, [content])
+        return filepath
+
+    def write_stream(self, filepath, chunks):
+        """Saves chunks of bytes as filepath as they arrive, and returns the
+        number of bytes written."""
+        return write_atomically(filepath, chunks)
+
+    def move(self, filepath, new_filepath):
+        pathlib.Path(os.path.dirname(new_filepath)).mkdir(parents=True, exist_ok=True)
+        os.rename(filepath, new_filepath)
+        return new_filepath
+
+    def remove(self, filepath):
+        """Deletes filepath's image; returns False if it wasn't there."""
+        try:
+            os.remove(filepath)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list(self, directory):
+        """Returns sorted paths of the JPEGs directly in directory."""
+        if not os.path.isdir(directory):
+            return list()
+        return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                      if f.endswith(".jpg"))
+
+
+class PackStore(object):
+    """Append-only pack file of images, indexed by name and tag in SQLite, so
+    one photo can be stored under several folders at once. Writing an image
+    that's already there appends a new copy and points the index at it;
+    `compact` reclaims the old ones. A crash mid-write leaves at most some
+    unindexed bytes at the end of the pack.
+
+    Several processes can share a pack. Appends, index updates and
+    compaction take an exclusive `fcntl.flock` on 'assets.pack.lock', and
+    reads a shared one. Each compaction writes a new pack file,
+    'assets.<generation>.pack', and bumps the generation recorded in the
+    index in the same commit as the new offsets, so every handle notices
+    and reopens the pack.
+
+    Args:
+        root (str, optional): Folder holding the pack, 'assets.sqlite3' and
+        the lock file. Defaults to 'path/to/assets'.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT):
+        pathlib.Path(root).mkdir(parents=True, exist_ok=True)
+        self.root = root
+        self.index_path = os.path.join(root, "assets.sqlite3")
+        self._lock = threading.Lock()
+        self._lock_file = open(os.path.join(root, "assets.pack.lock"), "ab")
+        self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+        with self._lock, self._flocked(exclusive=True):
+            self._create_tables()
+        self._generation = None
+        self._pack = None
+        self._map = None
+        self._mapped = 0
+        with self._lock:
+            self._open(self._current_generation())
+
+    def _create_tables(self):
+        """Creates the index, or rekeys one keyed by name alone, which let a
+        photo's copy in one folder replace its copy in another."""
+        columns = {row[1]: row[5] for row in self._db.execute("PRAGMA table_info(assets)")}
+        if columns and not columns["tag"]:
+            self._db.execute("ALTER TABLE assets RENAME TO assets_by_name")
+            self._db.execute("DROP INDEX IF EXISTS assets_tag")
+        self._db.execute("CREATE TABLE IF NOT EXISTS assets ("
+                         "name TEXT NOT NULL, "
+                         "offset INTEGER NOT NULL, "
+                         "length INTEGER NOT NULL, "
+                         "tag TEXT NOT NULL, "
+                         "PRIMARY KEY (name, tag))")
+        if columns and not columns["tag"]:
+            self._db.execute("INSERT INTO assets (name, offset, length, tag) "
+                             "SELECT name, offset, length, tag FROM assets_by_name")
+            self._db.execute("DROP TABLE assets_by_name")
+        self._db.execute("CREATE INDEX IF NOT EXISTS assets_tag ON assets (tag)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pack (generation INTEGER NOT NULL)")
+        self._db.execute("INSERT INTO pack SELECT 0 WHERE NOT EXISTS (SELECT * FROM pack)")
+        self._db.commit()
+
+    def _path(self, generation):
+        return os.path.join(self.root, f"assets.{generation}.pack" if generation else "assets.pack")
+
+    @property
+    def pack_path(self):
+        return self._path(self._generation)
+
+    def _current_generation(self):
+        return self._db.execute("SELECT generation FROM pack").fetchone()[0]
+
+    @contextlib.contextmanager
+    def _flocked(self, exclusive=False):
+        """Holds the pack's lock file, shared or exclusive, across processes.
+        Callers hold _lock, so threads never share the lock file's flock."""
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open(self, generation):
+        """Points the append handle at generation's pack file, dropping the
+        map of an older one. Call with _lock held."""
+        if generation == self._generation:
+            return
+        self._unmap()
+        if self._pack is not None:
+            self._pack.close()
+        self._generation = generation
+        self._pack = open(self.pack_path, "ab")
+
+    def _unmap(self):
+        if self._mapped:
+            self._map.close()
+        self._map, self._mapped = None, 0
+
+    def _row(self, filepath):
+        """Returns (offset, length) of filepath's image if it's stored under
+        filepath's tag, else None."""
+        with self._lock:
+            return self._db.execute("SELECT offset, length FROM assets "
+                                    "WHERE name = ? AND tag = ?",
+                                    (_name(filepath), tag_of(filepath))).fetchone()
+
+    def exists(self, filepath):
+        return self._row(filepath) is not None
+
+    def size(self, filepath):
+        row = self._row(filepath)
+        if row is None:
+            raise FileNotFoundError(filepath)
+        return row[1]
+
+    def read(self, filepath):
+        # The lookup and the slice happen under one hold of both locks, so
+        # neither another thread nor another process can compact in between.
+        with self._lock, self._flocked():
+            row = self._db.execute("SELECT assets.offset, assets.length, pack.generation "
+                                   "FROM assets, pack WHERE assets.name = ? AND assets.tag = ?",
+                                   (_name(filepath), tag_of(filepath))).fetchone()
+            if row is None:
+                raise FileNotFoundError(filepath)
+            offset, length, generation = row
+            self._open(generation)
+            if offset + length > self._mapped:
+                self._remap()
+            return self._map[offset:offset + length]
+
+    def read_stream(self, filepath, chunk_size):
+        """Yields filepath's bytes chunk_size at a time, from a handle on the
+        pack file of the generation it was looked up in. Packs are only ever
+        appended to, and a compacted one stays readable through an open
+        handle, so the locks aren't held while the chunks are read."""
+        with self._lock, self._flocked():
+            row = self._db.execute("SELECT assets.offset, assets.length, pack.generation "
+                                   "FROM assets, pack WHERE assets.name = ? AND assets.tag = ?",
+                                   (_name(filepath), tag_of(filepath))).fetchone()
+            if row is None:
+                raise FileNotFoundError(filepath)
+            offset, length, generation = row
+            self._open(generation)
+            self._pack.flush()
+            path = self._path(generation)
+            f = open(path, "rb")
+        with f:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(chunk_size, length))
+                if not chunk:
+                    raise IOError(f"{path} ends inside {filepath}.")
+                length -= len(chunk)
+                yield chunk
+
+    def _remap(self):
+        """Maps the whole pack, which has grown since it was last mapped."""
+        self._pack.flush()
+        self._unmap()
+        with open(self.pack_path, "rb") as f:
+            self._mapped = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), self._mapped, access=mmap.ACCESS_READ) if self._mapped else b""
+
+    def write(self, filepath, content):
+        self.write_stream(filepath, [content])
+        return filepath
+
+    def write_stream(self, filepath, chunks):
+        # Joined before taking the locks, so slow downloads don't hold up others.
+        content = b"".join(chunks)
+        with self._lock, self._flocked(exclusive=True):
+            self._open(self._current_generation())
+            offset = self._pack.seek(0, os.SEEK_END)
+            self._pack.write(content)
+            self._pack.flush()
+            self._db.execute("INSERT OR REPLACE INTO assets (name, offset, length, tag) "
+                             "VALUES (?, ?, ?, ?)",
+                             (_name(filepath), offset, len(content), tag_of(filepath)))
+            self._db.commit()
+        return len(content)
+
+    def move(self, filepath, new_filepath):
+        """Points new_filepath's index entry at filepath's image, replacing
+        any image already there, and drops filepath's entry. The bytes stay
+        where they are."""
+        with self._lock, self._flocked(exclusive=True):
+            updated = self._db.execute("UPDATE OR REPLACE assets SET name = ?, tag = ? "
+                                       "WHERE name = ? AND tag = ?",
+                                       (_name(new_filepath), tag_of(new_filepath),
+                                        _name(filepath), tag_of(filepath)))
+            self._db.commit()
+        if not updated.rowcount:
+            raise FileNotFoundError(filepath)
+        return new_filepath
+
+    def remove(self, filepath):
+        """Drops filepath's image from the index; returns False if it wasn't
+        there. Its bytes stay in the pack until `compact`."""
+        with self._lock, self._flocked(exclusive=True):
+            deleted = self._db.execute("DELETE FROM assets WHERE name = ? AND tag = ?",
+                                       (_name(filepath), tag_of(filepath)))
+            self._db.commit()
+        return deleted.rowcount > 0
+
+    def list(self, directory):
+        """Returns sorted paths of the images tagged with directory's folder."""
+        tag = tag_of(os.path.join(directory, "x.jpg"))
+        with self._lock:
+            names = [row[0] for row in self._db.execute(
+                "SELECT name FROM assets WHERE tag = ? ORDER BY name", (tag,))]
+        return [os.path.join(directory, f"{name}.jpg") for name in names]
+
+    def stats(self):
+        """Returns dict of images stored, and live and total bytes in the pack."""
+        with self._lock, self._flocked():
+            count, live = self._db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) "
+                                           "FROM assets").fetchone()
+            self._open(self._current_generation())
+            total = self._pack.seek(0, os.SEEK_END)
+        return {"images": count, "live_bytes": live, "pack_bytes": total}
+
+    def compact(self):
+        """Copies the images the index points at, in index order, into the
+        next generation's pack file, switches the index over to it, and
+        deletes the old one. Returns the bytes reclaimed."""
+        with self._lock, self._flocked(exclusive=True):
+            generation = self._current_generation()
+            self._open(generation)
+            rows = self._db.execute("SELECT name, tag, offset, length FROM assets "
+                                    "ORDER BY offset").fetchall()
+            self._pack.flush()
+            before = self._pack.seek(0, os.SEEK_END)
+            old_path, new_path = self.pack_path, self._path(generation + 1)
+            moved = list()
+            with open(old_path, "rb") as src, open(new_path, "wb") as dst:
+                for name, tag, offset, length in rows:
+                    src.seek(offset)
+                    moved.append((dst.tell(), name, tag))
+                    dst.write(src.read(length))
+                after = dst.tell()
+                dst.flush()
+                os.fsync(dst.fileno())
+            # Until this commits, the old pack and offsets are still current.
+            self._db.executemany("UPDATE assets SET offset = ? WHERE name = ? AND tag = ?",
+                                 moved)
+            self._db.execute("UPDATE pack SET generation = ?", (generation + 1,))
+            self._db.commit()
+            self._open(generation + 1)
+            os.remove(old_path)
+        logger.info(f"Compacted {old_path} from {before} to {after} bytes into {new_path}.")
+        return before - after
+
+    def close(self):
+        with self._lock:
+            self._unmap()
+            self._pack.close()
+            self._lock_file.close()
+            self._db.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns the module's shared store: a PackStore if the environment
+    variable BIRBYBOT_ASSET_STORE is 'pack', else a DirectoryStore, wrapped in
+    an asset_cache.AssetCache if BIRBYBOT_ASSET_BUDGET_MB is set."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if os.environ.get("BIRBYBOT_ASSET_STORE", "").lower() == "pack":
+                _store = PackStore()
+            else:
+                _store = DirectoryStore()
+            budget_mb = os.environ.get("BIRBYBOT_ASSET_BUDGET_MB")
+            if budget_mb:
+                import asset_cache
+                _store = asset_cache.AssetCache(_store, max_bytes=int(float(budget_mb) * 1024 * 1024))
+        return _store
+
+
+def set_store(store):
+    """Makes store the one `get_store` returns, and returns the previous one."""
+    global _store
+    with _store_lock:
+        previous, _store = _store, store
+    return previous
+
+
+def migrate(root=DEFAULT_ROOT, pack=None, delete=False):
+    """Copies every JPEG in root's tag folders into pack (skipping those
+    already there), and, if delete, removes each file once its copy reads
+    back identical.
+
+    Returns:
+        int: images copied
+    """
+    pack = pack or PackStore(root)
+    files = DirectoryStore()
+    copied = 0
+    for tag, folder in TAG_DIRS.items():
+        for filepath in files.list(os.path.join(root, folder)):
+            if not pack.exists(filepath):
+                pack.write(filepath, files.read(filepath))
+                copied += 1
+            if delete and pack.read(filepath) == files.read(filepath):
+                os.remove(filepath)
+        logger.info(f"Migrated {tag} images.")
+    logger.info(f"Copied {copied} images into {pack.pack_path}: {pack.stats()}")
+    return copied
+
+
+################################################################################
+
+if __name__ == "__main__":
+    import utils
+    utils.configure_logger(logger, console_output=True)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--migrate", action="store_true",
+                        help="Copy images from the folders into the pack.")
+    parser.add_argument("--delete", action="store_true",
+                        help="With --migrate, remove files once copied.")
+    parser.add_argument("--compact", action="store_true",
+                        help="Drop overwritten copies from the pack.")
+    parser.add_argument("--root", default=DEFAULT_ROOT)
+    args = parser.parse_args()
+    pack = PackStore(args.root)
+    if args.migrate:
+        migrate(args.root, pack, delete=args.delete)
+    if args.compact:
+        pack.compact()
+    logger.info(f"{pack.stats()}")
+    pack.close()
@@ -6,7 +6,6 @@ import io
 import json
 import logging
 import os
-import pathlib
 import random
 import sys
 
@@ -19,8 +18,12 @@ from google.cloud import vision
 from PIL import Image
 from twython import Twython
 
+import asset_store
+import classifier
 import flickr_to_datastore
+import tweet
 import utils
+import vision_cache
 
 ### LOGGING ####################################################################
 logger = logging.getLogger(__name__)
@@ -36,7 +39,7 @@ def show_photos(entities):
         try:
             filepath = download_image(url=entity.get("download_url"),
                                       name=name)
-            with Image.open(filepath) as im:
+            with Image.open(io.BytesIO(asset_store.get_store().read(filepath))) as im:
                 im.show()
         except requests.exceptions.HTTPError as e:
             logger.exception(e)
@@ -54,8 +57,7 @@ def classify_as_resp_only(terms, entities):
             continue
         logger.debug(f"Opening {name}...")
         try:
-            with io.open(filepath, 'rb') as image_file:
-                content = image_file.read()
+            content = asset_store.get_store().read(filepath)
             image = vision.types.Image(content=content)
         except Exception as e:
             logger.exception(e)
@@ -67,7 +69,7 @@ def classify_as_resp_only(terms, entities):
                 "features": [{'type': vision.enums.Feature.Type.LABEL_DETECTION},
                              {'type': vision.enums.Feature.Type.OBJECT_LOCALIZATION}]
             })
-            logger.debug(f"Response for {name} annotation request: {response}")
+            logger.debug("Response for %s annotation request: %s", name, response)
         except exceptions.GoogleAPIError as e:
             logger.exception(e)
             continue
@@ -86,7 +88,7 @@ twitter = Twython(
     os.environ['TWITTER_ACCESS_SECRET']
 )
 ds_client = datastore.Client()
-v_client = vision.ImageAnnotatorClient()
+v_client = vision_cache.CachedAnnotatorClient(vision.ImageAnnotatorClient())
 
 # Search Flickr for bats!
 def search_flickr(search_string):
@@ -127,7 +129,10 @@ def photos_to_entities(photos):
     return entities
 
 # Classify photos!
-def classify_as(terms, entities):
+def classify_as(terms, entities, field="is_bat"):
+    """Classifies entities with `classifier.label_image`, setting field True
+    for photos labeled with any of terms."""
+    target = classifier.Target(field, terms)
     bat_counter = 0
     for entity in entities:
         logger.debug(entity)
@@ -141,80 +146,16 @@ def classify_as(terms, entities):
         except requests.exceptions.HTTPError as e:
             logger.exception(e)
             continue
-        
-        # Load image.
-        logger.debug(f"Opening {name}...")
-        try:
-            with io.open(filepath, 'rb') as image_file:
-                content = image_file.read()
-            image = vision.types.Image(content=content)
-        except Exception as e:
-            logger.exception(e)
-            continue
-        
-        # Label image as a whole and find objects in image.
-        logger.info(f"Starting classification for {name}...")
+
         try:
-            response = v_client.annotate_image({
-                "image": image,
-                "features": [{'type': vision.enums.Feature.Type.LABEL_DETECTION},
-                             {'type': vision.enums.Feature.Type.OBJECT_LOCALIZATION}]
-            })
-            logger.debug(f"Response for {name} annotation request: {response}")
+            labels, objects = classifier.label_image(v_client, filepath, [target])
         except exceptions.GoogleAPIError as e:
             logger.exception(e)
             continue
-
-        labels = set()
-        crop_boxes = set()
-        if response.label_annotations:
-            labels.update([a.description for a in response.label_annotations])
-        if response.localized_object_annotations:
-            labels.update([a.name.lower() for a in response.localized_object_annotations])
-            # While we're here, let's save crop boxes.
-            with Image.open(filepath) as im:
-                width, height = im.size
-            for a in response.localized_object_annotations:
-                verts = a.bounding_poly.normalized_vertices
-                crop_boxes.add(( round(verts[0].x * width),
-                                 round(verts[0].y * height),
-                                 round(verts[2].x * width),
-                                 round(verts[2].y * height) ))
-        # If it's not a bat but there are crop boxes, let's crop and get new labels.
-        if not is_a(["bat"], labels) and crop_boxes:
-            logger.debug(f"Cropping {name}...")
-            im = Image.open(filepath)
-            for cb in crop_boxes:
-                with im.crop(box=cb) as im2:
-                    # Convert PIL.Image.Image to bytes.
-                    with io.BytesIO() as buffer:
-                        im2.save(buffer, format='JPEG')
-                        byts = buffer.getvalue()
-                        img = vision.types.Image(content=byts)
-                logger.debug(f"Requesting label detection for crop...")
-                try:
-                    response = v_client.label_detection(image=img)
-                    logger.debug(f"Response for crop label detection request: {response}")
-                except exceptions.GoogleAPIError as e:
-                    logger.exception(e)
-                    continue
-                if response.label_annotations:
-                    labels.update([a.description for a in response.label_annotations])
-                    if is_a(terms, labels):
-                        # We found a bat, let's stop cropping and labeling.
-                        break
-            im.close()
-            logger.debug(f"Done cropping {name}.")
-        
-        logger.debug(f"{name}'s labels: {labels}")
-        entity.update({
-            "is_bat": is_a(terms, labels),
-            "vision_labels": json.dumps(list(labels)),
-            "is_classified": True
-        })
-        if entity.get("is_bat"):
+        classifier.apply(entity, labels, [target], objects)
+        if entity.get(field):
             bat_counter += 1
-        logger.info(f"{name} is_bat = {entity.get('is_bat')}!\n")
+        logger.info(f"{name} {field} = {entity.get(field)}!\n")
     logger.debug(f"Processed {len(entities)} entities. Found {bat_counter} bats.")
     return
 
@@ -231,16 +172,15 @@ def tweet_photo_entity(entity):
     logger.debug(message)
 
     # Download image if we somehow don't already have it.
-    filepath = os.path.join(os.path.dirname(__file__), f'assets/{name}.jpg')
-    if not pathlib.Path(filepath).exists():
-        filepath = download_image(url=entity.get("download_url"),
-                                  name=name)
+    filepath = os.path.join(utils.ASSETS_DIR, f'{name}.jpg')
+    if not asset_store.get_store().exists(filepath):
+        filepath = utils.download_image(url=entity.get("download_url"),
+                                        name=name)
 
     # Load image and tweet.
     try:
-        with io.open(filepath, 'rb') as img:
-            upload_resp = twitter.upload_media(media=img)
-            logger.debug(upload_resp)
+        upload_resp = tweet.upload_media(filepath, twitter)
+        logger.debug(upload_resp)
         tweet_resp = twitter.update_status(status=message,
                                            media_ids=[upload_resp["media_id"]])
         logger.debug(tweet_resp)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Runs ingest, classify and tweet end to end against the fakes in `fakes.py`
+and reports per-stage throughput, p50/p99 latency and peak RSS for each
+dataset size. Nothing leaves the machine.
+
+    python benchmark.py --sizes 100 1000 10000 --output bench.json
+    python benchmark.py --baseline bench.json    # exits 1 on a regression
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from dateutil.relativedelta import relativedelta
+
+import classify_images
+import fakes
+import flickr_to_datastore
+import metrics
+import tweet
+import utils
+
+SEARCH_TERMS = ["plover chick", "plover hatchling", "plover baby",
+                "sandpiper chick", "sandpiper hatchling", "sandpiper baby"]
+DEFAULT_SIZES = [100, 1000, 10000]
+
+
+def percentile(values, p):
+    """Returns the nearest-rank pth percentile of values, or None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+def peak_rss_mb():
+    """Returns this process's peak resident set size in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_stage(name, func, tracker):
+    """Calls func, which returns the number of items it handled, and returns a
+    dict of stage measurements, including the stage's `metrics` counters."""
+    metrics.reset()
+    started = time.monotonic()
+    items = func()
+    seconds = time.monotonic() - started
+    latencies = tracker.latencies
+    return {"stage": name,
+            "items": items,
+            "seconds": round(seconds, 3),
+            "per_second": round(items / seconds, 1) if seconds else None,
+            "p50_ms": _ms(percentile(latencies, 50)),
+            "p99_ms": _ms(percentile(latencies, 99)),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "counters": metrics.summary()["counters"]}
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def run(size, latency=0.0, error_rate=0.0, tweets=10, concurrent=True,
+        batch_size=utils.VISION_BATCH_SIZE, image_size=(96, 72)):
+    """Runs every stage once over size fake photos.
+
+    Args:
+        size (int): Photos Flickr returns across all search terms.
+        latency (float, optional): Seconds each fake call sleeps.
+        error_rate (float, optional): Fraction of fake calls that fail.
+        tweets (int, optional): Photos to tweet.
+        concurrent (bool, optional): Passed to `classify_unclassified_entities`.
+        batch_size (int, optional): Passed to `classify_unclassified_entities`.
+        image_size (tuple, optional): (width, height) of fixture images.
+
+    Returns:
+        list of dicts, one per stage (see `run_stage`).
+    """
+    assets_dir = tempfile.mkdtemp(prefix="birbybot-bench-")
+    assets = utils.ASSETS_DIR
+    utils.ASSETS_DIR = assets_dir
+    session = utils._session
+    try:
+        fake_ds = fakes.FakeDatastoreClient(latency, error_rate)
+        flickr = fakes.FakeFlickrAPI(size, SEARCH_TERMS, latency, error_rate)
+        # Instrumented like the real clients, so the overhead is measured too.
+        ds_client = metrics.instrument(fake_ds, "datastore")
+        v_client = metrics.instrument(fakes.FakeImageAnnotatorClient(latency, error_rate), "vision")
+        twitter = metrics.instrument(fakes.FakeTwython(latency, error_rate), "twitter")
+        # Swapped in for the shared session, and swapped back out below.
+        utils._session = fakes.make_cdn_session(fakes.make_fixtures(size=image_size),
+                                                latency, error_rate)
+
+        def use_tracker():
+            tracker = fakes.LatencyTracker()
+            for service in (fake_ds, flickr):
+                service.tracker = tracker
+            return tracker
+
+        def ingest():
+            return flickr_to_datastore.ingest_incrementally(
+                ds_client, SEARCH_TERMS, min_upload_date="2018-01-01",
+                flickr=flickr, calls_per_second=1000)
+
+        def classify():
+            classify_images.classify_unclassified_entities(
+                ds_client, v_client, concurrent=concurrent, batch_size=batch_size)
+            return sum(1 for e in fake_ds.entities.values() if e.get("is_classified"))
+
+        def tweet_some():
+            done = 0
+            cutoff = datetime.datetime.utcnow() - relativedelta(months=1)
+            for _ in range(tweets):
+                entity = tweet.pick_random_bird_entity(ds_client, tweeted_before=cutoff)
+                if entity is None:
+                    break
+                try:
+                    tweet.tweet_and_update(ds_client, entity, twitter)
+                    done += 1
+                except Exception:
+                    continue
+            return done
+
+        results = list()
+        for name, func in (("ingest", ingest), ("classify", classify), ("tweet", tweet_some)):
+            tracker = use_tracker()
+            results.append(run_stage(name, func, tracker))
+        return results
+    finally:
+        utils.ASSETS_DIR = assets
+        utils._session = session
+        shutil.rmtree(assets_dir, ignore_errors=True)
+
+
+def run_in_subprocess(size, args):
+    """Runs one size in a fresh interpreter so peak RSS isn't shared."""
+    command = [sys.executable, os.path.abspath(__file__), "--one", str(size),
+               "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+               "--tweets", str(args.tweets), "--batch-size", str(args.batch_size)]
+    if args.sequential:
+        command.append("--sequential")
+    out = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def regressions(results, baseline, tolerance):
+    """Returns a list of messages for stages whose throughput fell more than
+    tolerance (a fraction) below baseline."""
+    before = {(r["size"], r["stage"]): r for r in baseline}
+    messages = list()
+    for r in results:
+        b = before.get((r["size"], r["stage"]))
+        if not b or not b["per_second"] or r["per_second"] is None:
+            continue
+        if r["per_second"] < b["per_second"] * (1 - tolerance):
+            messages.append(f"{r['stage']} at {r['size']}: {r['per_second']}/s "
+                            f"vs. {b['per_second']}/s baseline")
+    return messages
+
+
+def print_table(results):
+    columns = ["size", "stage", "items", "seconds", "per_second", "p50_ms", "p99_ms", "peak_rss_mb"]
+    print(" ".join(f"{c:>11}" for c in columns))
+    for r in results:
+        print(" ".join(f"{str(r[c]):>11}" for c in columns))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Dataset sizes, e.g., 100 1000 10000 100000.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds each fake backend call sleeps.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of fake backend calls that fail.")
+    parser.add_argument("--tweets", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=utils.VISION_BATCH_SIZE)
+    parser.add_argument("--sequential", action="store_true",
+                        help="Classify one entity at a time.")
+    parser.add_argument("--output", help="Write results as JSON here.")
+    parser.add_argument("--baseline", help="Compare against this JSON output.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed fractional throughput drop vs. baseline.")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+################################################################################
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    if args.one is not None:
+        stages = run(args.one, args.latency, args.error_rate, args.tweets,
+                     concurrent=not args.sequential, batch_size=args.batch_size)
+        print(json.dumps([dict(r, size=args.one) for r in stages]))
+        sys.exit(0)
+    results = list()
+    for size in args.sizes:
+        results.extend(run_in_subprocess(size, args))
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for message in found:
+            print(f"REGRESSION: {message}")
+        sys.exit(1 if found else 0)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Classification engine shared by every campaign: annotates each image once
+(whole image, then crops of likely objects) and decides any number of
+Targets, e.g. birds and bats, from the same labels."""
+
+import json
+import logging
+
+from google.api_core import exceptions
+from google.cloud import vision
+
+import utils
+
+### LOGGING ####################################################################
+logger = logging.getLogger(__name__)
+utils.configure_logger(logger, console_output=True)
+################################################################################
+
+class Target(object):
+    """A classification campaign: photos with any label in vocabulary get
+    field set True, and the rest False.
+
+    Args:
+        field (str): Entity property, e.g., "is_bird"
+        vocabulary (iterable): Labels that count, e.g., ["bird", "beak"]
+    """
+
+    def __init__(self, field, vocabulary):
+        self.field = field
+        self.vocabulary = frozenset(vocabulary)
+
+    def __repr__(self):
+        return f"Target({self.field!r}, {sorted(self.vocabulary)!r})"
+
+    def matches(self, labels):
+        """Given a collection of strings, returns True if any are in
+        vocabulary."""
+        return any(x in self.vocabulary for x in labels)
+
+
+BIRD = Target("is_bird", ["bird", "seabird", "beak", "egg"])
+BAT = Target("is_bat", ["bat"])
+
+
+def all_match(targets, labels):
+    """Returns True if every target matches labels, i.e., crops can't change
+    any decision and cropping can stop."""
+    return all(t.matches(labels) for t in targets)
+
+
+def decide(targets, labels):
+    """Returns dict of each target's field: whether it matches labels."""
+    return {t.field: t.matches(labels) for t in targets}
+
+
+def apply(entity, labels, targets, objects=None):
+    """Records labels, objects and every target's decision on entity locally,
+    and marks it classified."""
+    logger.debug("%s's labels: %s", entity.key.name, labels)
+    entity.exclude_from_indexes.add("vision_objects")
+    entity.update(decide(targets, labels))
+    entity.update({
+        "vision_labels": utils.compact_labels(labels),
+        "vision_objects": json.dumps(objects or [], separators=(",", ":")),
+        "is_classified": True
+    })
+    logger.debug(entity)
+    return entity
+
+
+IMAGE_FEATURES = [{'type': vision.enums.Feature.Type.LABEL_DETECTION},
+                  {'type': vision.enums.Feature.Type.OBJECT_LOCALIZATION}]
+CROP_FEATURES = [{'type': vision.enums.Feature.Type.LABEL_DETECTION}]
+# Images larger than this on their longest edge (e.g., Flickr originals, when
+# there's no url_l) are shrunk before they're sent to Vision. None sends every
+# image as downloaded.
+UPLOAD_MAX_EDGE = 1600
+
+
+def labels_from_response(response):
+    """Returns set of label descriptions and lowercase object names."""
+    labels = set()
+    if response.label_annotations:
+        labels.update([a.description for a in response.label_annotations])
+    if response.localized_object_annotations:
+        labels.update([a.name.lower() for a in response.localized_object_annotations])
+    return labels
+
+
+def objects_from_response(response):
+    """Returns list of objects found in image, compacted to [name, score, left,
+    upper, right, lower] with normalized coordinates: [['bird', 0.912, 0.21,
+    0.33, 0.48, 0.7], ...]"""
+    objects = list()
+    for a in response.localized_object_annotations:
+        verts = a.bounding_poly.normalized_vertices
+        objects.append([a.name.lower(), round(a.score, 3),
+                        round(verts[0].x, 3), round(verts[0].y, 3),
+                        round(verts[2].x, 3), round(verts[2].y, 3)])
+    return objects
+
+
+def crop_boxes_from_response(response, size):
+    """Returns set of (left, upper, right, lower) pixel boxes around the objects
+    found in an image of size (width, height)."""
+    crop_boxes = set()
+    if response.localized_object_annotations:
+        width, height = size
+        for a in response.localized_object_annotations:
+            verts = a.bounding_poly.normalized_vertices
+            crop_boxes.add(( round(verts[0].x * width),
+                             round(verts[0].y * height),
+                             round(verts[2].x * width),
+                             round(verts[2].y * height) ))
+    return crop_boxes
+
+
+# Object names the object localizer gives things that might turn out to be
+# birds (or bats, ...) once cropped; crops of these are tried first.
+ANIMAL_OBJECTS = {"bird", "animal", "duck", "goose", "chicken", "penguin", "owl",
+                  "parrot", "eagle", "swan", "turkey", "falcon", "sparrow",
+                  "egg", "insect", "mammal", "bat"}
+# Crop scheduling defaults; see `schedule_crop_boxes`.
+MAX_CROPS = 3
+MIN_CROP_AREA = 0.01
+CROP_IOU_THRESHOLD = 0.6
+
+
+def schedule_crop_boxes(response, size, max_crops=MAX_CROPS, min_area=MIN_CROP_AREA,
+                        iou_threshold=CROP_IOU_THRESHOLD):
+    """Decides which objects are worth cropping and re-labeling, and in what
+    order: objects smaller than min_area (as a fraction of the image) are
+    dropped; the rest are ranked likely animals first, then by score; objects
+    overlapping a better-ranked one by more than iou_threshold are dropped as
+    duplicates; and at most max_crops are kept.
+
+    Args:
+        response (google.cloud.vision_v1.types.AnnotateImageResponse)
+        size (tuple): (width, height) of the original image
+        max_crops (int, optional): Defaults to MAX_CROPS. None keeps all.
+        min_area (float, optional): Defaults to MIN_CROP_AREA.
+        iou_threshold (float, optional): Defaults to CROP_IOU_THRESHOLD.
+
+    Returns:
+        list of (left, upper, right, lower) pixel boxes, best first.
+    """
+    width, height = size
+    candidates = list()
+    for a in response.localized_object_annotations:
+        verts = a.bounding_poly.normalized_vertices
+        box = (verts[0].x, verts[0].y, verts[2].x, verts[2].y)
+        if _area(box) < min_area:
+            continue
+        candidates.append((a.name.lower() not in ANIMAL_OBJECTS, -a.score, box))
+    candidates.sort()
+
+    kept = list()
+    for _, _, box in candidates:
+        if max_crops is not None and len(kept) >= max_crops:
+            break
+        if all(_iou(box, k) <= iou_threshold for k in kept):
+            kept.append(box)
+    if len(kept) < len(response.localized_object_annotations):
+        logger.debug(f"Cropping {len(kept)} of {len(response.localized_object_annotations)} objects.")
+    return [( round(b[0] * width),
+              round(b[1] * height),
+              round(b[2] * width),
+              round(b[3] * height) ) for b in kept]
+
+
+def _area(box):
+    return max(0, box[2] - box[0]) * max(0, box[3] - box[1])
+
+
+def _iou(a, b):
+    """Intersection over union of two (left, upper, right, lower) boxes."""
+    inter = _area((max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])))
+    union = _area(a) + _area(b) - inter
+    return inter / union if union else 0.0
+
+
+def label_image(v_client, filepath, targets, crop_quality=utils.CROP_QUALITY,
+                crop_max_size=None, max_edge=UPLOAD_MAX_EDGE,
+                upload_quality=utils.UPLOAD_QUALITY):
+    """Labels the image at filepath as a whole, and, if that doesn't match all
+    of targets, crops to the objects `schedule_crop_boxes` picks and labels
+    the crops until every target matches or the crops run out.
+
+    Args:
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        filepath (str): 'path/to/assets/name.jpg'
+        targets (list): Target objects
+        crop_quality (int, optional): JPEG quality crops are sent at. Defaults
+        to utils.CROP_QUALITY.
+        crop_max_size (int, optional): Longest edge crops are shrunk to fit.
+        Defaults to None, full size.
+        max_edge (int, optional): Longest edge the whole image is shrunk to fit
+        before upload. Crops are still cut from the original. Defaults to
+        UPLOAD_MAX_EDGE.
+        upload_quality (int, optional): JPEG quality of a shrunk image.
+        Defaults to utils.UPLOAD_QUALITY.
+
+    Returns:
+        tuple of set of str labels: {'Bird', 'Beak', 'bird', ...} and list of
+        objects from `objects_from_response`
+    """
+    name = utils.name_from_path(filepath)
+    with utils.ImageHandle(filepath) as handle:
+        # Label image as a whole and find objects in image.
+        logger.info(f"Starting classification for {name}...")
+        response = v_client.annotate_image({
+            "image": handle.vision_image(max_edge=max_edge, quality=upload_quality),
+            "features": IMAGE_FEATURES
+        })
+        logger.debug("Response for %s annotation request: %s", name, response)
+
+        labels = labels_from_response(response)
+        objects = objects_from_response(response)
+        # While we're here, let's pick crop boxes.
+        crop_boxes = schedule_crop_boxes(response, handle.size)
+        # If some target doesn't match yet but there are crop boxes, let's crop
+        # and get new labels.
+        if not all_match(targets, labels) and crop_boxes:
+            logger.debug(f"Cropping {name}...")
+            for cb in crop_boxes:
+                img = handle.crop_vision_image(cb, quality=crop_quality, max_size=crop_max_size)
+                logger.debug(f"Requesting label detection for crop...")
+                try:
+                    r = v_client.label_detection(image=img)
+                    logger.debug("Response for crop label detection request: %s", r)
+                except exceptions.GoogleAPIError as e:
+                    logger.exception(e)
+                    continue
+                if r and r.label_annotations:
+                    labels.update([a.description for a in r.label_annotations])
+                    if all_match(targets, labels):
+                        # Found them all, let's stop cropping and labeling.
+                        break
+            logger.debug(f"Done cropping {name}.")
+    return labels, objects
+
+
+def label_images(v_client, filepaths, targets, batch_size=utils.VISION_BATCH_SIZE,
+                 crop_quality=utils.CROP_QUALITY, crop_max_size=None,
+                 max_edge=UPLOAD_MAX_EDGE, upload_quality=utils.UPLOAD_QUALITY):
+    """Like `label_image`, but for many images at once: whole-image requests
+    go out `batch_size` at a time through `batch_annotate_images`, then crops
+    are re-labeled in rounds, one crop per still-undecided image per round, so
+    an image stops cropping as soon as every target matches.
+
+    Args:
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        filepaths (list): 'path/to/assets/name.jpg' strs
+        targets (list): Target objects
+        batch_size (int, optional): Images per batch_annotate_images call.
+        Defaults to utils.VISION_BATCH_SIZE.
+        crop_quality (int, optional): See `label_image`.
+        crop_max_size (int, optional): See `label_image`.
+        max_edge (int, optional): See `label_image`.
+        upload_quality (int, optional): See `label_image`.
+
+    Returns:
+        list of (labels, objects) tuples like `label_image` returns, in the
+        same order as filepaths. An image whose whole-image annotation, or a
+        round of whose crops, failed gets None instead.
+    """
+    handles = [utils.ImageHandle(fp) for fp in filepaths]
+    try:
+        image_requests = [{"image": h.vision_image(max_edge=max_edge, quality=upload_quality),
+                           "features": IMAGE_FEATURES} for h in handles]
+        logger.info(f"Starting classification for {len(filepaths)} images...")
+        responses = utils.batch_annotate(v_client, image_requests, batch_size=batch_size)
+
+        results = list()
+        pending = dict()  # Index into filepaths -> crop boxes left to try.
+        for i, (handle, response) in enumerate(zip(handles, responses)):
+            if response.error.message:
+                logger.error(f"Annotation request for {handle.filepath} failed: {response.error.message}")
+                results.append(None)
+                continue
+            labels = labels_from_response(response)
+            results.append((labels, objects_from_response(response)))
+            crop_boxes = schedule_crop_boxes(response, handle.size)
+            if not all_match(targets, labels) and crop_boxes:
+                pending[i] = crop_boxes
+
+        while pending:
+            indexes = list(pending)
+            crop_requests = list()
+            for i in indexes:
+                img = handles[i].crop_vision_image(pending[i].pop(0), quality=crop_quality,
+                                                   max_size=crop_max_size)
+                crop_requests.append({"image": img, "features": CROP_FEATURES})
+            logger.debug(f"Requesting label detection for {len(crop_requests)} crops...")
+            try:
+                crop_responses = utils.batch_annotate(v_client, crop_requests, batch_size=batch_size)
+            except exceptions.GoogleAPIError as e:
+                # Labels from the crops tried so far aren't a decision; leave
+                # this round's images unclassified for the next run.
+                logger.exception(e)
+                for i in indexes:
+                    results[i] = None
+                    del pending[i]
+                    handles[i].close()
+                continue
+            for i, r in zip(indexes, crop_responses):
+                if r.error.message:
+                    logger.error(f"Crop label detection for {filepaths[i]} failed: {r.error.message}")
+                elif r.label_annotations:
+                    results[i][0].update([a.description for a in r.label_annotations])
+                if all_match(targets, results[i][0]) or not pending[i]:
+                    # Found every target or ran out of crops.
+                    del pending[i]
+                    handles[i].close()
+    finally:
+        for handle in handles:
+            handle.close()
+    return results
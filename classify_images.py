@@ -1,19 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import io
-import json
 import logging
 import os
-import pathlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from google.api_core import exceptions
 from google.cloud import datastore
 from google.cloud import vision
-from PIL import Image, ImageDraw
 
+import asset_store
+import classifier
+import dedupe
+import metrics
+import prefilter
 import utils
+import vision_cache
 from flickr_to_datastore import write_entities_to_datastore
 
 ### LOGGING ####################################################################
@@ -44,132 +46,478 @@ def pull(ds_client, kind, key, val):
     return entities
 
 
-def move_neg(original_path):
-    """Given JPG location, moves to path/to/assets/negative/name.jpg."""
+def iter_pull(ds_client, kind, key, val, page_size=100):
+    """Like `pull`, but streams entities a page at a time: each page is a
+    keys-only query resumed from the previous page's cursor, followed by one
+    get_multi for the page's entities. The next page loads in the background
+    while the current one is being worked on.
+
+    Nothing is saved between calls: an interrupted run resumes by filtering on
+    a property that saving the entity changes (e.g., is_classified), so only
+    entities that were actually persisted drop out.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        kind (str): e.g., "Photo"
+        key (str): e.g., "is_classified"
+        val (bool): e.g., False
+        page_size (int, optional): Defaults to 100.
+
+    Yields:
+        google.cloud.datastore.entity.Entity
+    """
+    def fetch_page(cursor):
+        query = ds_client.query(kind=kind)
+        query.add_filter(key, "=", val)
+        query.keys_only()
+        iterator = query.fetch(limit=page_size, start_cursor=cursor)
+        keys = [e.key for e in next(iterator.pages)]
+        entities = ds_client.get_multi(keys) if keys else list()
+        return keys, entities, iterator.next_page_token
+
+    logger.debug(f"Retrieving {kind} entities where {key} is {val}, {page_size} at a time...")
+    retrieved = 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = executor.submit(fetch_page, None)
+        while page is not None:
+            keys, entities, cursor = page.result()
+            # Only go on if this page was full; a short page is the last one.
+            # Entities deleted since the keys query don't make it short.
+            more = cursor is not None and len(keys) == page_size
+            page = executor.submit(fetch_page, cursor) if more else None
+            retrieved += len(entities)
+            for entity in entities:
+                yield entity
+    logger.info(f"Retrieved {retrieved} {kind} entities where {key} is {val}.")
+
+
+def move_neg(original_path, folder="negative"):
+    """Given JPG location, moves to path/to/assets/negative/name.jpg (or to
+    another folder under assets). In a pack store (see asset_store.py) this
+    only retags the image."""
     name = utils.name_from_path(original_path)
-    if not os.path.exists("assets/negative"):
-        pathlib.Path("assets/negative").mkdir(parents=True)
-    neg_path = os.path.join(os.path.dirname(__file__), f'assets/negative/{name}.jpg')
+    neg_path = os.path.join(utils.ASSETS_DIR, folder, f'{name}.jpg')
     logger.debug(f"Moving from {original_path} to {neg_path}")
-    os.rename(original_path, neg_path)
-    return neg_path
+    return asset_store.get_store().move(original_path, neg_path)
+
+
+# What every classification run decides; add e.g. classifier.BAT to classify
+# for bats from the same Vision requests.
+TARGETS = [classifier.BIRD]
 
 
 def is_bird(labels):
     """Given a list of strings, returns True if any match."""
-    return any(x in labels for x in ["bird", "seabird", "beak", "egg"])
+    return classifier.BIRD.matches(labels)
+
+
+def download_entity_image(entity):
+    """Downloads entity's image (if not already on disk) and returns filepath."""
+    return utils.download_image(url=entity.get("download_url"),
+                                name=entity.key.name)
+
+
+def download_entity_images(entities, **kwargs):
+    """Downloads entities' images in parallel with `utils.download_images`.
+
+    Returns:
+        list of (entity, filepath) tuples for the images that downloaded.
+    """
+    filepaths = utils.download_images(((e.get("download_url"), e.key.name) for e in entities),
+                                      **kwargs)
+    return [(e, filepaths[e.key.name]) for e in entities if e.key.name in filepaths]
+
+
+def label_entity_image(v_client, entity, filepath, targets=TARGETS, **kwargs):
+    """Labels entity's image with `classifier.label_image`, which takes
+    crop_quality, crop_max_size, max_edge and upload_quality.
+
+    Returns:
+        tuple of set of str labels and list of objects
+    """
+    return classifier.label_image(v_client, filepath, targets, **kwargs)
+
+
+def label_images_batched(v_client, filepaths, batch_size=utils.VISION_BATCH_SIZE,
+                         targets=TARGETS, **kwargs):
+    """Labels many images with `classifier.label_images`, sharing Vision
+    requests between them.
+
+    Returns:
+        list of (labels, objects) tuples, or None for an image whose
+        annotation failed, in the same order as filepaths.
+    """
+    return classifier.label_images(v_client, filepaths, targets, batch_size=batch_size, **kwargs)
+
+
+def update_classified_entity(entity, labels, filepath, objects=None, targets=TARGETS):
+    """Records labels, objects and each target's decision on entity locally
+    (see `classifier.apply`), and moves non-birds' images to the negative
+    folder."""
+    classifier.apply(entity, labels, targets, objects)
+
+    # Move non-birds to different folder so that they are easier to manually review.
+    if entity.get("is_bird") == False:
+        move_neg(filepath)
+    return
 
 
-def classify_entity(v_client, entity):
+def classify_entity(v_client, entity, targets=TARGETS):
     """Classifies entity as bird (and therefore as classified), and updates
     entity locally.
 
     Args:
         v_client (google.cloud.vision_v1.ImageAnnotatorClient)
         entity: google.cloud.datastore.entity.Entity of kind 'Photo'
+        targets (list, optional): classifier.Target objects. Defaults to
+        TARGETS.
     
     Returns:
         None
     """
-    name = entity.key.name
     # Download from URL.
-    filepath = utils.download_image(url=entity.get("download_url"),
-                                    name=name)
-    # Instantiate google.cloud.vision_v1.types.Image.
-    image = utils.vision_img_from_path(v_client, filepath)
-
-    # Label image as a whole and find objects in image.
-    logger.info(f"Starting classification for {name}...")
-    response = v_client.annotate_image({
-        "image": image,
-        "features": [{'type': vision.enums.Feature.Type.LABEL_DETECTION},
-                     {'type': vision.enums.Feature.Type.OBJECT_LOCALIZATION}]
-    })
-    logger.debug(f"Response for {name} annotation request: {response}")
-
-    labels = set()
-    crop_boxes = set()
-    if response.label_annotations:
-        labels.update([a.description for a in response.label_annotations])
-    if response.localized_object_annotations:
-        labels.update([a.name.lower() for a in response.localized_object_annotations])
-        # While we're here, let's save crop boxes.
-        with Image.open(filepath) as im:
-            width, height = im.size
-        for a in response.localized_object_annotations:
-            verts = a.bounding_poly.normalized_vertices
-            crop_boxes.add(( round(verts[0].x * width),
-                             round(verts[0].y * height),
-                             round(verts[2].x * width),
-                             round(verts[2].y * height) ))
-    # If it's not a bird but there are crop boxes, let's crop and get new labels.
-    if not is_bird(labels) and crop_boxes:
-        logger.debug(f"Cropping {name}...")
-        im = Image.open(filepath)
-        for cb in crop_boxes:
-            with im.crop(box=cb) as im2:
-                # Convert PIL.Image.Image to bytes.
-                with io.BytesIO() as buffer:
-                    im2.save(buffer, format='JPEG')
-                    byts = buffer.getvalue()
-                    img = vision.types.Image(content=byts)
-            logger.debug(f"Requesting label detection for crop...")
-            try:
-                r = v_client.label_detection(image=img)
-                logger.debug(f"Response for crop label detection request: {r}")
-            except exceptions.GoogleAPIError as e:
-                logger.exception(e)
-                continue
-            if r and r.label_annotations:
-                labels.update([a.description for a in r.label_annotations])
-                if is_bird(labels):
-                    # We found a bird, let's stop cropping and labeling.
-                    break
-        im.close()
-        logger.debug(f"Done cropping {name}.")
-    
-    logger.debug(f"{name}'s labels: {labels}")
-    entity.update({
-        "is_bird": is_bird(labels),
-        "vision_labels": utils.trim(json.dumps(list(labels))),
-        "is_classified": True
-    })
-    logger.debug(entity)
-    
-    # Move non-birds to different folder so that they are easier to manually review.
-    if entity.get("is_bird") == False:
-        move_neg(filepath)
+    filepath = download_entity_image(entity)
+    labels, objects = label_entity_image(v_client, entity, filepath, targets)
+    update_classified_entity(entity, labels, filepath, objects, targets)
     return
 
 
-def classify_unclassified_entities(ds_client, v_client):
-    entities = pull(ds_client,
-                    kind="Photo",
-                    key="is_classified",
-                    val=False)
-    if entities:
-        classified = 0
-        non_birds = 0
+def classify_entities_batched(v_client, entities, batch_size=utils.VISION_BATCH_SIZE,
+                              targets=TARGETS, duplicates=None, local_filter=None):
+    """Downloads and classifies entities, sharing Vision requests between them
+    through `label_images_batched`, and updates them locally. Entities whose
+    image can't be downloaded or annotated are logged and left unclassified.
+
+    Args:
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        entities (list): google.cloud.datastore.entity.Entity of kind 'Photo'
+        batch_size (int, optional): Defaults to utils.VISION_BATCH_SIZE.
+        targets (list, optional): Defaults to TARGETS.
+        duplicates (dedupe.DuplicateIndex, optional): See
+        `label_downloaded_batched`. Defaults to None.
+        local_filter (prefilter.PreFilter, optional): See
+        `label_downloaded_batched`. Defaults to None.
+
+    Returns:
+        list of google.cloud.datastore.entity.Entity that were classified.
+    """
+    downloaded = download_entity_images(entities, session=utils.get_session())
+    return label_downloaded_batched(v_client, downloaded, batch_size=batch_size,
+                                    targets=targets, duplicates=duplicates,
+                                    local_filter=local_filter)
+
+
+def label_downloaded_batched(v_client, downloaded, batch_size=utils.VISION_BATCH_SIZE,
+                             targets=TARGETS, duplicates=None, local_filter=None):
+    """Classifies (entity, filepath) pairs with `label_images_batched` and
+    returns the entities that were classified.
+
+    If duplicates (a dedupe.DuplicateIndex) is given, only one photo per
+    cluster of near-duplicates goes to Vision. The rest inherit its labels,
+    and get `duplicate_of` set to its name.
+
+    If local_filter (a prefilter.PreFilter) is given, images it rejects don't
+    go to Vision at all: they're classified with no labels, so as non-birds,
+    and get `prefiltered` set so they can be found and re-checked. Their images
+    go to 'assets/negative/prefiltered/', which isn't trained on. The filter
+    only knows birds, so it's only used when targets is [classifier.BIRD].
+    """
+    rejected = list()
+    if local_filter is not None and targets != [classifier.BIRD]:
+        logger.debug("Pre-filter only decides birds; sending every image to Vision.")
+    elif local_filter is not None and downloaded:
+        keep = local_filter.keep([fp for _, fp in downloaded])
+        rejected = [d for d, k in zip(downloaded, keep) if not k]
+        downloaded = [d for d, k in zip(downloaded, keep) if k]
+        if rejected:
+            logger.debug(f"Pre-filter skipped {len(rejected)} of {len(keep)} images.")
+    classified = list()
+    for entity, filepath in rejected:
+        entity.update({"prefiltered": True})
+        classifier.apply(entity, set(), targets)
+        move_neg(filepath, folder=os.path.join("negative", "prefiltered"))
+        classified.append(entity)
+    if not downloaded:
+        return classified
+    representatives = dict()  # Name -> name of its cluster's representative.
+    to_label = list()
+    for entity, filepath in downloaded:
+        name = entity.key.name
+        rep = duplicates.assign(name, filepath) if duplicates else name
+        if rep == name or (rep not in representatives and duplicates.labels_of(rep) is None):
+            # A new photo, or one whose representative was never labeled.
+            to_label.append((entity, filepath))
+        representatives[name] = rep
+    labeled = label_images_batched(v_client, [fp for _, fp in to_label],
+                                   batch_size=batch_size, targets=targets)
+    results = dict()
+    for (entity, _), result in zip(to_label, labeled):
+        name = entity.key.name
+        if result is not None:
+            results[name] = result
+            if duplicates and representatives[name] == name:
+                duplicates.record(name, *result)
+
+    for entity, filepath in downloaded:
+        name = entity.key.name
+        rep = representatives[name]
+        result = results.get(name) or results.get(rep)
+        if result is None and rep != name:
+            result = duplicates.labels_of(rep)
+        if result is None:
+            continue
+        if rep != name:
+            entity.update({"duplicate_of": rep})
+        labels, objects = result
+        update_classified_entity(entity, set(labels), filepath, objects, targets)
+        classified.append(entity)
+    return classified
+
+
+def classify_entities_concurrently(ds_client, v_client, entities,
+                                   download_workers=8, annotate_workers=4,
+                                   persist_workers=2, batch_size=None,
+                                   writer=None, targets=TARGETS, duplicates=None,
+                                   local_filter=None, on_done=None):
+    """Classifies and saves entities with a separate pool of worker threads for
+    each of the download, annotate, and persist stages. An entity that fails in
+    any stage is logged and left unclassified.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        entities (iterable): google.cloud.datastore.entity.Entity of kind 'Photo'
+        download_workers (int, optional): Defaults to 8.
+        annotate_workers (int, optional): Defaults to 4.
+        persist_workers (int, optional): Defaults to 2.
+        batch_size (int, optional): If given, entities move through the stages
+        in groups of batch_size, annotated with `label_downloaded_batched` and
+        saved with one put_multi per group. Defaults to None.
+        writer (optional): What to save entities with, e.g., a
+        `utils.WriteBuffer`; anything with put and put_multi methods. Defaults
+        to ds_client.
+        targets (list, optional): Defaults to TARGETS.
+        duplicates (dedupe.DuplicateIndex, optional): Used with batch_size;
+        see `label_downloaded_batched`. Defaults to None.
+        local_filter (prefilter.PreFilter, optional): Used with batch_size; see
+        `label_downloaded_batched`. Defaults to None.
+        on_done (callable, optional): Called with each entity once it is
+        saved, from one thread at a time. Defaults to None.
+
+    Returns:
+        int count of entities that were classified and saved.
+    """
+    writer = writer or ds_client
+
+    def download(entity):
+        logger.debug(f"Downloading {entity.key.name}...")
+        return entity, download_entity_image(entity)
+
+    def annotate(item):
+        entity, filepath = item
+        logger.debug(f"Classifying {entity.key.name}...")
+        labels, objects = label_entity_image(v_client, entity, filepath, targets)
+        update_classified_entity(entity, labels, filepath, objects, targets)
+        return entity
+
+    def persist(entity):
+        logger.debug(f"Saving {entity.key.name} in datastore...")
+        writer.put(entity)
+        return entity
+
+    def download_batch(batch):
+        logger.debug(f"Downloading {len(batch)} images...")
+        return download_entity_images(batch, max_workers=len(batch),
+                                      session=utils.get_session()) or None
+
+    def annotate_batch(downloaded):
+        return label_downloaded_batched(v_client, downloaded, batch_size=batch_size,
+                                        targets=targets, duplicates=duplicates,
+                                        local_filter=local_filter) or None
+
+    def persist_batch(batch):
+        logger.debug(f"Saving {len(batch)} entities in datastore...")
+        writer.put_multi(batch)
+        return batch
+
+    if batch_size:
+        saved = 0
+
+        def sink_batch(batch):
+            nonlocal saved
+            saved += len(batch)
+            for entity in batch:
+                if on_done is not None:
+                    on_done(entity)
+
+        utils.run_stages(utils.ichunk(entities, batch_size),
+                         [(download_batch, download_workers),
+                          (annotate_batch, annotate_workers),
+                          (persist_batch, persist_workers)],
+                         sink=sink_batch)
+        return saved
+    return utils.run_stages(entities, [(download, download_workers),
+                                       (annotate, annotate_workers),
+                                       (persist, persist_workers)],
+                            sink=on_done)
+
+
+def classify_unclassified_entities(ds_client, v_client, concurrent=False,
+                                   batch_size=None, page_size=100, targets=TARGETS,
+                                   duplicates=None, local_filter=None, **workers):
+    """Classifies and saves every unclassified Photo entity, pulling them with
+    `iter_pull` so that work starts on the first page right away and an
+    interrupted run picks up where it stopped.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        concurrent (bool, optional): Classify with
+        `classify_entities_concurrently` instead of one entity at a time.
+        Defaults to False.
+        batch_size (int, optional): Share Vision requests between groups of
+        this many entities (see `label_images_batched`). Defaults to None.
+        page_size (int, optional): Entities per `iter_pull` page. Defaults to
+        100.
+        targets (list, optional): classifier.Target objects decided from the
+        same annotations. Defaults to TARGETS.
+        duplicates (dedupe.DuplicateIndex, optional): Send one photo per
+        cluster of near-duplicates to Vision. Used with batch_size. Defaults
+        to None.
+        local_filter (prefilter.PreFilter, optional): Don't send images it
+        rejects to Vision. Used with batch_size. Defaults to None.
+        **workers: `download_workers`, `annotate_workers` and `persist_workers`
+        passed on to `classify_entities_concurrently`.
+
+    Returns:
+        None
+    """
+    pulled = 0
+
+    def count(entities):
+        nonlocal pulled
         for entity in entities:
-            logger.debug(f"Classifying {entity.key.name}...")
-            classify_entity(v_client, entity)
-            logger.debug(f"Saving {entity.key.name} in datastore...")
-            ds_client.put(entity)
-            if entity.get("is_classified") == True: classified += 1
-            if entity.get("is_bird") == False: non_birds += 1
-        logger.info(f"Classified and updated {classified} entities.")
+            pulled += 1
+            yield entity
+
+    entities = count(iter_pull(ds_client,
+                               kind="Photo",
+                               key="is_classified",
+                               val=False,
+                               page_size=page_size))
+    classified = 0
+    non_birds = 0
+
+    def tally(entity):
+        nonlocal classified, non_birds
+        if entity.get("is_classified") == True:
+            classified += 1
+        if entity.get("is_bird") == False:
+            non_birds += 1
+
+    # Saves go through a write-behind buffer, which is flushed even if
+    # classification fails partway.
+    with utils.WriteBuffer(ds_client) as writer:
+        if concurrent:
+            classify_entities_concurrently(ds_client, v_client, entities,
+                                           batch_size=batch_size, writer=writer,
+                                           targets=targets, duplicates=duplicates,
+                                           local_filter=local_filter, on_done=tally,
+                                           **workers)
+        elif batch_size:
+            for batch in utils.ichunk(entities, batch_size):
+                batch = classify_entities_batched(v_client, batch, batch_size=batch_size,
+                                                  targets=targets, duplicates=duplicates,
+                                                  local_filter=local_filter)
+                logger.debug(f"Saving {len(batch)} entities in datastore...")
+                writer.put_multi(batch)
+                for entity in batch:
+                    tally(entity)
+        else:
+            for entity in entities:
+                logger.debug(f"Classifying {entity.key.name}...")
+                classify_entity(v_client, entity, targets)
+                logger.debug(f"Saving {entity.key.name} in datastore...")
+                writer.put(entity)
+                tally(entity)
+    if pulled:
+        logger.info(f"Classified {classified} entities and saved {writer.written}.")
         logger.warning(f"{non_birds} entities were classified as not birds.")
-        logger.warning(f"{(len(entities) - classified)} entities were not classified.")
+        logger.warning(f"{(pulled - classified)} entities were not classified.")
     return
 
+
+def reclassify_from_labels(ds_client, predicate=is_bird, field="is_bird",
+                           chunk_size=500):
+    """Re-evaluates predicate against the labels already stored on every
+    classified Photo entity, without downloading or annotating anything, and
+    writes back only the entities whose field changes. Use this after editing
+    a vocabulary like `is_bird`'s.
+
+    Streams a projection query over `vision_labels` and field, which needs a
+    composite index on both (see index.yaml). Entities that don't have field
+    yet aren't in that index and aren't reclassified.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        predicate (function, optional): Takes set of labels, returns bool.
+        Defaults to `is_bird`.
+        field (str, optional): Entity property predicate decides. Defaults to
+        "is_bird".
+        chunk_size (int, optional): Flipped entities to collect before fetching
+        and saving them. Defaults to 500.
+
+    Returns:
+        int: Number of entities whose field flipped.
+    """
+    query = ds_client.query(kind="Photo", projection=["vision_labels", field])
+    logger.info(f"Reclassifying {field} from stored labels...")
+    flipped = dict()  # Key -> new value.
+    seen = 0
+    total = 0
+
+    def flush():
+        entities = ds_client.get_multi(list(flipped))
+        for entity in entities:
+            entity.update({field: flipped[entity.key]})
+        write_entities_to_datastore(ds_client, entities)
+        flipped.clear()
+        return len(entities)
+
+    for projected in query.fetch():
+        seen += 1
+        value = predicate(utils.parse_labels(projected["vision_labels"]))
+        if projected.get(field) != value:
+            flipped[projected.key] = value
+            if len(flipped) >= chunk_size:
+                total += flush()
+    if flipped:
+        total += flush()
+    logger.info(f"Checked {seen} entities; {total} flipped {field}.")
+    return total
+
 ################################################################################
 if __name__ == "__main__":
     filename = os.path.basename(__file__)
     logger.info(f"Starting {filename}...")
     try:
-        ds_client = datastore.Client()
-        v_client = vision.ImageAnnotatorClient()
-        classify_unclassified_entities(ds_client, v_client)
+        ds_client = metrics.instrument(datastore.Client(), "datastore")
+        if "--reclassify" in sys.argv:
+            # Vocabulary changed; re-evaluate stored labels instead.
+            reclassify_from_labels(ds_client)
+        else:
+            v_client = vision_cache.CachedAnnotatorClient(
+                metrics.instrument(vision.ImageAnnotatorClient(), "vision"))
+            duplicates = dedupe.DuplicateIndex()
+            # None until one is trained with prefilter.py.
+            local_filter = prefilter.PreFilter.load()
+            classify_unclassified_entities(ds_client, v_client, concurrent=True,
+                                           batch_size=utils.VISION_BATCH_SIZE,
+                                           duplicates=duplicates, local_filter=local_filter)
+            logger.info(f"Vision cache: {v_client.cache.stats()}")
+            logger.info(f"Duplicates: {duplicates.stats()}")
         logger.info(f"Finished {filename}.")
     except Exception as e:
         logger.exception(e)
+    finally:
+        metrics.emit(filename)
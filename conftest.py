@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+# Modules configure their loggers on import; keep test runs out of the
+# repository's birbybot.log.
+os.environ.setdefault("BIRBYBOT_LOG_FILE", "")
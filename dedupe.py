@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from PIL import Image
+
+import utils
+
+### LOGGING ####################################################################
+logger = logging.getLogger(__name__)
+utils.configure_logger(logger, console_output=True)
+################################################################################
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "assets/duplicates.sqlite3")
+# Most bits two 64-bit dHashes can differ by and still count as the same shot.
+DUPLICATE_DISTANCE = 6
+
+
+def dhash(image, size=8):
+    """Returns the difference hash of an image as a size * size bit int: each
+    bit says whether a pixel of a tiny grayscale copy is brighter than its
+    right-hand neighbor, so re-encoding, resizing and small edits barely
+    change it.
+
+    Args:
+        image (str or utils.ImageHandle): 'path/to/assets/name.jpg'
+        size (int, optional): Defaults to 8.
+
+    Returns:
+        int
+    """
+    handle = utils.ImageHandle.of(image)
+    # A separate decode, so that draft() (which lets JPEGs decode at a fraction
+    # of full size) doesn't affect the handle's image.
+    with Image.open(io.BytesIO(handle.content)) as im:
+        im.draft("L", (size * 8, size * 8))
+        pixels = list(im.convert("L").resize((size + 1, size), Image.BILINEAR).getdata())
+    h = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            h = (h << 1) | (left > right)
+    return h
+
+
+def hamming(a, b):
+    """Returns the number of bits that differ between ints a and b."""
+    return bin(a ^ b).count("1")
+
+
+class BKTree(object):
+    """Burkhard-Keller tree of hashes under Hamming distance: finding every
+    hash within a small radius of a query visits only a few nodes, because
+    the triangle inequality rules out whole subtrees."""
+
+    def __init__(self):
+        self._root = None  # [hash, item, {distance: child}]
+        self.size = 0
+
+    def add(self, h, item):
+        self.size += 1
+        if self._root is None:
+            self._root = [h, item, dict()]
+            return
+        node = self._root
+        while True:
+            d = hamming(h, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, item, dict()]
+                return
+            node = child
+
+    def search(self, h, radius):
+        """Returns list of (distance, item) within radius of h, nearest first."""
+        found = list()
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                found.append((d, node[1]))
+            for child_d, child in node[2].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        found.sort(key=lambda f: f[0])
+        return found
+
+
+def image_version(name):
+    """Returns str identifying the image last downloaded as name (its URL,
+    ETag, Last-Modified and length, see `utils.download_record`), or None if
+    it has no download record."""
+    record = utils.download_record(name)
+    if record is None:
+        return None
+    return json.dumps([record[k] for k in ("url", "etag", "last_modified", "length")])
+
+
+class DuplicateIndex(object):
+    """Persistent index of photos' dHashes that groups near-duplicates into
+    clusters around the first photo seen (the representative), and keeps the
+    representatives' labels so the rest of a cluster can inherit them instead
+    of going to Vision. A photo whose image has been downloaded again since
+    it was hashed (see `image_version`) is hashed again.
+
+    Args:
+        path (str, optional): SQLite database file. Defaults to
+        'path/to/assets/duplicates.sqlite3'.
+        max_distance (int, optional): Defaults to DUPLICATE_DISTANCE.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_distance=DUPLICATE_DISTANCE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_distance = max_distance
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS photos ("
+                         "name TEXT PRIMARY KEY, "
+                         "hash TEXT NOT NULL, "
+                         "representative TEXT NOT NULL, "
+                         "labels TEXT, "
+                         "objects TEXT, "
+                         "version TEXT)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(photos)")]
+        if "version" not in columns:
+            # Indexes made before versions were recorded.
+            self._db.execute("ALTER TABLE photos ADD COLUMN version TEXT")
+        self._db.commit()
+        self._representatives = dict()  # Name -> representative.
+        self._versions = dict()  # Name -> `image_version` when hashed.
+        for name, representative, version in self._db.execute(
+                "SELECT name, representative, version FROM photos"):
+            self._representatives[name] = representative
+            self._versions[name] = version
+        self._build_tree()
+
+    def _build_tree(self):
+        self._tree = BKTree()
+        for name, h in self._db.execute("SELECT name, hash FROM photos "
+                                        "WHERE name = representative"):
+            self._tree.add(int(h, 16), name)
+
+    def assign(self, name, filepath):
+        """Hashes the image at filepath and returns the name of its cluster's
+        representative: the nearest existing one within max_distance, else
+        name itself, which becomes a new representative. A photo already
+        assigned keeps its representative unless its image has changed."""
+        version = image_version(name)
+        with self._lock:
+            if name in self._representatives:
+                if self._versions.get(name) == version:
+                    return self._representatives[name]
+                logger.info(f"{name}'s image has changed; hashing it again.")
+        h = dhash(filepath)
+        with self._lock:
+            if self._representatives.get(name) == name:
+                # Its old hash mustn't attract new duplicates.
+                self._db.execute("DELETE FROM photos WHERE name = ?", (name,))
+                self._build_tree()
+            nearest = self._tree.search(h, self.max_distance)
+            representative = nearest[0][1] if nearest else name
+            if nearest:
+                self.duplicates += 1
+                logger.debug("%s is a near-duplicate of %s.", name, representative)
+            else:
+                self._tree.add(h, name)
+            self._representatives[name] = representative
+            self._versions[name] = version
+            # Replacing the row also drops labels recorded for an old image.
+            self._db.execute("INSERT OR REPLACE INTO photos (name, hash, representative, version) "
+                             "VALUES (?, ?, ?, ?)",
+                             (name, format(h, "016x"), representative, version))
+            self._db.commit()
+        return representative
+
+    def record(self, name, labels, objects=None):
+        """Saves a representative's labels and objects for its cluster."""
+        with self._lock:
+            self._db.execute("UPDATE photos SET labels = ?, objects = ? WHERE name = ?",
+                             (json.dumps(sorted(labels)), json.dumps(objects or []), name))
+            self._db.commit()
+
+    def labels_of(self, name):
+        """Returns (labels, objects) recorded for name, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT labels, objects FROM photos WHERE name = ?",
+                                   (name,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return set(json.loads(row[0])), json.loads(row[1])
+
+    def stats(self):
+        """Returns dict of photos and clusters indexed, and duplicates found
+        by this instance."""
+        return {"photos": len(self._representatives),
+                "clusters": self._tree.size,
+                "duplicates": self.duplicates}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""In-process stand-ins for FlickrAPI, ImageAnnotatorClient, datastore.Client,
+Twython and the Flickr image CDN, for tests and `benchmark.py`. Each takes a
+`latency` (seconds slept per call) and an `error_rate` (fraction of calls that
+fail the way the real service would)."""
+
+import base64
+import collections
+import contextlib
+import datetime
+import functools
+import hashlib
+import io
+import itertools
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import requests
+from google.api_core import exceptions
+from google.cloud import datastore
+from google.cloud import vision
+from PIL import Image, ImageDraw
+
+import utils
+
+FAKE_CDN = "http://fake-flickr.test/"
+
+
+class LatencyTracker(object):
+    """Records how long items take from `start` (e.g., served by Flickr, read
+    from Datastore) to `finish` (written to Datastore)."""
+
+    def __init__(self):
+        self.latencies = list()
+        self._started = dict()
+        self._lock = threading.Lock()
+
+    def start(self, name):
+        with self._lock:
+            self._started.setdefault(name, time.monotonic())
+
+    def finish(self, name):
+        with self._lock:
+            started = self._started.pop(name, None)
+            if started is not None:
+                self.latencies.append(time.monotonic() - started)
+
+
+class FakeService(object):
+    """Shared latency, error injection and call counting."""
+
+    error = exceptions.ServiceUnavailable
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = collections.Counter()
+        self.tracker = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            fail = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise self.error(f"Injected {name} failure.")
+
+    def _start(self, name):
+        if self.tracker:
+            self.tracker.start(name)
+
+    def _finish(self, name):
+        if self.tracker:
+            self.tracker.finish(name)
+
+
+### IMAGES #####################################################################
+def make_fixtures(n=8, size=(96, 72), seed=0):
+    """Returns n distinct synthetic JPEGs as bytes."""
+    rand = random.Random(seed)
+    fixtures = list()
+    for _ in range(n):
+        im = Image.new("RGB", size, tuple(rand.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(im)
+        for _ in range(6):
+            x, y = rand.randrange(size[0]), rand.randrange(size[1])
+            draw.ellipse((x, y, x + size[0] // 4, y + size[1] // 4),
+                         fill=tuple(rand.randrange(256) for _ in range(3)))
+        with io.BytesIO() as buffer:
+            im.save(buffer, format="JPEG")
+            fixtures.append(buffer.getvalue())
+    return fixtures
+
+
+class FakeImageAdapter(requests.adapters.BaseAdapter):
+    """Serves fixtures for any URL mounted on it, picked by a hash of the URL,
+    with 503s at error_rate. Mount it on a session at FAKE_CDN."""
+
+    def __init__(self, fixtures, latency=0.0, error_rate=0.0, seed=0):
+        super(FakeImageAdapter, self).__init__()
+        self.fixtures = fixtures
+        self.service = FakeService(latency, error_rate, seed)
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        try:
+            self.service._call("GET")
+            body = self.fixtures[_digest(request.url.encode()) % len(self.fixtures)]
+            response.status_code = 200
+        except exceptions.ServiceUnavailable:
+            body = b""
+            response.status_code = 503
+        response.headers["Content-Length"] = str(len(body))
+        response.raw = io.BytesIO(body)
+        return response
+
+    def close(self):
+        pass
+
+
+def make_cdn_session(fixtures, latency=0.0, error_rate=0.0):
+    """Returns a new `utils.make_session` session with a FakeImageAdapter
+    mounted at FAKE_CDN, to stand in for `utils.get_session()`'s, e.g. with
+    monkeypatch.setattr(utils, "_session", ...)."""
+    session = utils.make_session()
+    session.mount(FAKE_CDN, FakeImageAdapter(fixtures, latency, error_rate))
+    return session
+
+
+def _digest(data):
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], "big")
+
+
+### FLICKR #####################################################################
+class FakePhotos(object):
+    def __init__(self, flickr):
+        self.flickr = flickr
+
+    def search(self, text, page=1, per_page=100, min_upload_date=None, **params):
+        """Returns <rsp><photos pages=...><photo .../>...</photos></rsp>."""
+        self.flickr._call("flickr.photos.search")
+        ids = [i for i in self.flickr.ids_for(text) if self.flickr.uploaded(i) >= _to_timestamp(min_upload_date)]
+        pages = max(1, -(-len(ids) // per_page))
+        rsp = ET.Element("rsp", stat="ok")
+        photos = ET.SubElement(rsp, "photos", page=str(page), pages=str(pages),
+                               perpage=str(per_page), total=str(len(ids)))
+        for i in ids[(page - 1) * per_page:page * per_page]:
+            photos.append(self.flickr.photo(i))
+            self.flickr._start(f"Flickr-{self.flickr.photo_id(i)}")
+        return rsp
+
+
+class FakeFlickrAPI(FakeService):
+    """Searches over `size` synthetic photos. Each search term finds the photos
+    whose index is congruent to the term's position modulo the number of terms,
+    plus every third photo of the next term's share, so terms overlap."""
+
+    def __init__(self, size, terms, latency=0.0, error_rate=0.0, seed=0):
+        super(FakeFlickrAPI, self).__init__(latency, error_rate, seed)
+        self.size = size
+        self.terms = list(terms)
+        self.photos = FakePhotos(self)
+        self.epoch = 1514764800  # 1/1/18
+
+    def ids_for(self, text):
+        t = self.terms.index(text) if text in self.terms else 0
+        n = len(self.terms)
+        return [i for i in range(self.size)
+                if i % n == t or (i % n == (t + 1) % n and i % 3 == 0)]
+
+    def photo_id(self, i):
+        return str(10000000000 + i)
+
+    def uploaded(self, i):
+        return self.epoch + i * 60
+
+    def photo(self, i):
+        photo_id = self.photo_id(i)
+        return ET.Element("photo", id=photo_id, owner="12345678@N00", secret="abc",
+                          server="1", farm="1", title=f"Plover chick {i}",
+                          ispublic="1", isfriend="0", isfamily="0", license="4",
+                          dateupload=str(self.uploaded(i)), ownername="Birder",
+                          url_l=f"{FAKE_CDN}{photo_id}_l.jpg",
+                          height_l="768", width_l="1024")
+
+    def data_walker(self, method, searchstring='*/photo', **params):
+        # Same as flickrapi's, without ElementTree's removed getchildren().
+        page = 1
+        total = 1
+        while page <= total:
+            rsp = method(page=page, **params)
+            total = int(rsp[0].get('pages'))
+            for photo in rsp.findall(searchstring):
+                yield photo
+            page += 1
+
+    def walk(self, per_page=50, **kwargs):
+        return self.data_walker(self.photos.search, per_page=per_page, **kwargs)
+
+
+def _to_timestamp(min_upload_date):
+    if not min_upload_date:
+        return 0
+    if str(min_upload_date).isdigit():
+        return int(min_upload_date)
+    d = datetime.datetime.strptime(min_upload_date, "%Y-%m-%d")
+    return int((d - datetime.datetime(1970, 1, 1)).total_seconds())
+
+
+### VISION #####################################################################
+class FakeImageAnnotatorClient(FakeService):
+    """Decides what an image shows from a hash of its bytes: bird_rate of whole
+    images contain a bird; the rest contain an animal and a rock, and
+    crop_bird_rate of crops turn out to be birds."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, bird_rate=0.6,
+                 crop_bird_rate=0.3, seed=0):
+        super(FakeImageAnnotatorClient, self).__init__(latency, error_rate, seed)
+        self.bird_rate = bird_rate
+        self.crop_bird_rate = crop_bird_rate
+
+    def annotate_image(self, request, **kwargs):
+        self._call("annotate_image")
+        return self._respond(request)
+
+    def batch_annotate_images(self, requests, **kwargs):
+        self._call("batch_annotate_images")
+        return vision.types.BatchAnnotateImagesResponse(
+            responses=[self._respond(r) for r in requests])
+
+    def label_detection(self, image, **kwargs):
+        return self.annotate_image({"image": image, "features": [
+            {"type": vision.enums.Feature.Type.LABEL_DETECTION}]})
+
+    def _respond(self, request):
+        if isinstance(request, dict):
+            request = vision.types.AnnotateImageRequest(**request)
+        roll = (_digest(request.image.content) % 1000) / 1000.0
+        types = {f.type for f in request.features}
+        if vision.enums.Feature.Type.OBJECT_LOCALIZATION not in types:
+            # Crop re-labeling.
+            if roll < self.crop_bird_rate:
+                return vision.types.AnnotateImageResponse(
+                    label_annotations=[{"description": "Bird", "score": 0.9},
+                                       {"description": "beak", "score": 0.8}])
+            return vision.types.AnnotateImageResponse(
+                label_annotations=[{"description": "Rock", "score": 0.7}])
+        if roll < self.bird_rate:
+            return vision.types.AnnotateImageResponse(
+                label_annotations=[{"description": "Bird", "score": 0.95},
+                                   {"description": "Shorebird", "score": 0.9}],
+                localized_object_annotations=[{"name": "Bird", "score": 0.9,
+                                               "bounding_poly": _box(0.2, 0.2, 0.7, 0.8)}])
+        return vision.types.AnnotateImageResponse(
+            label_annotations=[{"description": "Sand", "score": 0.9},
+                               {"description": "Beach", "score": 0.8}],
+            localized_object_annotations=[{"name": "Animal", "score": 0.6,
+                                           "bounding_poly": _box(0.1, 0.1, 0.5, 0.6)},
+                                          {"name": "Rock", "score": 0.5,
+                                           "bounding_poly": _box(0.5, 0.4, 0.9, 0.9)}])
+
+
+def _box(left, upper, right, lower):
+    return {"normalized_vertices": [{"x": left, "y": upper},
+                                    {"x": right, "y": upper},
+                                    {"x": right, "y": lower},
+                                    {"x": left, "y": lower}]}
+
+
+### DATASTORE ##################################################################
+class _Descending(object):
+    """Sorts its value in reverse."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+_OPS = {"=": lambda a, b: a == b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b}
+
+
+class FakeIterator(object):
+    def __init__(self, results, next_page_token):
+        self._results = results
+        self.pages = iter([results])
+        self.next_page_token = next_page_token
+
+    def __iter__(self):
+        return iter(self._results)
+
+
+class FakeQuery(object):
+    """Supports what the bot uses: filters, keys_only, projection, order,
+    limit and cursors (which, like Datastore's, point just past the last
+    result rather than at an offset)."""
+
+    def __init__(self, client, kind=None, projection=(), order=()):
+        self.client = client
+        self.kind = kind
+        self.projection = list(projection)
+        self.order = list(order)
+        self.filters = list()
+        self._keys_only = False
+
+    def add_filter(self, property_name, operator, value):
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def keys_only(self):
+        self._keys_only = True
+
+    def fetch(self, limit=None, start_cursor=None, **kwargs):
+        self.client._call("run_query")
+        needed = [f for f, _, _ in self.filters] + [o.lstrip("-") for o in self.order] + self.projection
+        matches = list()
+        for entity in self.client._snapshot(self.kind):
+            if any(p not in entity for p in needed):
+                continue
+            if all(_OPS[op](_naive(entity[p]), _naive(v)) for p, op, v in self.filters):
+                matches.append((self._sort_key(entity), entity))
+        matches.sort(key=lambda m: m[0])
+        if start_cursor:
+            after = self.client._cursors[_decode_cursor(start_cursor)]
+            matches = [m for m in matches if after < m[0]]
+        more = limit is not None and len(matches) > limit
+        matches = matches[:limit] if limit is not None else matches
+        token = self.client._cursor_for(matches[-1][0]) if more else None
+        results = [self._shape(entity) for _, entity in matches]
+        for result in results:
+            self.client._start(result.key.name)
+        return FakeIterator(results, token)
+
+    def _sort_key(self, entity):
+        key = list()
+        for o in self.order:
+            value = _naive(entity[o.lstrip("-")])
+            key.append(_Descending(value) if o.startswith("-") else value)
+        key.append(tuple(str(p) for p in entity.key.flat_path))
+        return tuple(key)
+
+    def _shape(self, entity):
+        if self._keys_only:
+            return datastore.Entity(key=entity.key)
+        if self.projection:
+            shaped = datastore.Entity(key=entity.key)
+            shaped.update({p: entity[p] for p in self.projection})
+            return shaped
+        return _copy(entity)
+
+
+class FakeDatastoreClient(FakeService):
+    """Keeps entities in a dict. Reads and writes copy entities, like the real
+    client's round trip through protobufs."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, project="birbybot-fake", seed=0):
+        super(FakeDatastoreClient, self).__init__(latency, error_rate, seed)
+        self.project = project
+        self.entities = dict()
+        self._cursors = dict()
+        self._cursor_ids = itertools.count()
+        self._store_lock = threading.Lock()
+
+    def key(self, *path_args, **kwargs):
+        return datastore.Key(*path_args, project=self.project)
+
+    def query(self, kind=None, projection=(), order=(), **kwargs):
+        return FakeQuery(self, kind, projection, order)
+
+    def get(self, key, **kwargs):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys, **kwargs):
+        self._call("lookup")
+        with self._store_lock:
+            found = [_copy(self.entities[k]) for k in keys if k in self.entities]
+        for entity in found:
+            self._start(entity.key.name)
+        return found
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        entities = list(entities)
+        if not entities:
+            return
+        self._call("commit")
+        with self._store_lock:
+            for entity in entities:
+                self.entities[entity.key] = _copy(entity)
+        for entity in entities:
+            self._finish(entity.key.name)
+
+    def delete(self, key):
+        self._call("commit")
+        with self._store_lock:
+            self.entities.pop(key, None)
+
+    @contextlib.contextmanager
+    def batch(self):
+        yield self
+
+    def _snapshot(self, kind):
+        with self._store_lock:
+            return [e for k, e in self.entities.items() if kind is None or k.kind == kind]
+
+    def _cursor_for(self, sort_key):
+        with self._store_lock:
+            cursor_id = str(next(self._cursor_ids))
+            self._cursors[cursor_id] = sort_key
+        return base64.urlsafe_b64encode(cursor_id.encode())
+
+
+def _decode_cursor(cursor):
+    if isinstance(cursor, str):
+        cursor = cursor.encode()
+    return base64.urlsafe_b64decode(cursor).decode()
+
+
+def _naive(value):
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    return value
+
+
+def _copy(entity):
+    copied = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    copied.update({k: list(v) if isinstance(v, list) else v for k, v in entity.items()})
+    return copied
+
+
+### TWITTER ####################################################################
+class FakeTwython(FakeService):
+    """Accepts media uploads, simple or chunked (INIT/APPEND/FINALIZE), and
+    status updates, failing with a 503 TwythonError at error_rate."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        super(FakeTwython, self).__init__(latency, error_rate, seed)
+        from twython import TwythonError
+        self.error = functools.partial(TwythonError, error_code=503)
+        self.media = dict()
+        self.statuses = list()
+        self._media_ids = itertools.count(1)
+        self._chunks = dict()
+
+    def upload_media(self, media=None, command=None, media_id=None, **params):
+        from twython import TwythonError
+        self._call(f"upload_media {command or ''}".strip())
+        if command is None:
+            media_id = next(self._media_ids)
+            self.media[media_id] = media.read()
+        elif command == "INIT":
+            media_id = next(self._media_ids)
+            self._chunks[media_id] = (int(params["total_bytes"]), dict())
+            return {"media_id": media_id}
+        elif command == "APPEND":
+            self._chunks[media_id][1][int(params["segment_index"])] = media.read()
+            return None
+        elif command == "FINALIZE":
+            total_bytes, chunks = self._chunks.pop(media_id)
+            content = b"".join(chunks[i] for i in sorted(chunks))
+            if len(content) != total_bytes:
+                raise TwythonError(f"Expected {total_bytes} bytes, got {len(content)}.",
+                                   error_code=400)
+            self.media[media_id] = content
+        return {"media_id": media_id, "size": len(self.media[media_id])}
+
+    def update_status(self, status, media_ids=(), **params):
+        self._call("update_status")
+        self.statuses.append((status, list(media_ids)))
+        now = datetime.datetime.utcnow()
+        return {"id": len(self.statuses),
+                "text": status,
+                "created_at": now.strftime("%a %b %d %H:%M:%S +0000 %Y")}
@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import calendar
 import datetime
 import logging
 import os
+import queue
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from dateutil.relativedelta import relativedelta
 from flickrapi import FlickrAPI
 from google.cloud import datastore
 
+import metrics
 import utils
 
 ### LOGGING ####################################################################
@@ -37,72 +43,353 @@ def create_entities_from_search(ds_client, search_terms, min_upload_date=None):
         keys are patterned after 'Flickr-{photo.id}'. Example: [<Entity('Photo',
         'Flickr-36092472285') {'source': 'Flickr', 'license': '4', ...}>, ...]
     """
-    # Explanation of Flickr search parameters:
-    # https://www.flickr.com/services/api/flickr.photos.search.html
-    # https://www.flickr.com/services/api/flickr.photos.licenses.getInfo.html
-    # https://www.flickr.com/services/api/misc.urls.html
-    
-    # Walking Flickr search results and creating Datastore entities:
-    # https://github.com/sybrenstuvel/flickrapi/blob/master/doc/7-util.rst#walking-through-a-search-result
-    # https://github.com/GoogleCloudPlatform/python-docs-samples/tree/master/datastore/cloud-client
+    entities = list(iter_entities_from_search(ds_client, search_terms, min_upload_date))
+    logger.info(f"Found {len(entities)} photos of '{search_terms}' uploaded since {min_upload_date}.")
+    logger.debug(entities)
+    return entities
 
+
+def make_flickr():
+    """Returns FlickrAPI client configured from the environment."""
     try:
         FLICKR_PUBLIC = os.environ['FLICKR_KEY']
         FLICKR_SECRET = os.environ['FLICKR_SECRET']
     except KeyError as e:
         logger.exception(e)
         raise
+    return FlickrAPI(FLICKR_PUBLIC, FLICKR_SECRET, format="etree")  # Walk requires ElementTree
+
+
+def search_params(search_terms, min_upload_date=None):
+    """Returns flickr.photos.search parameters for `search_terms`."""
+    # Explanation of Flickr search parameters:
+    # https://www.flickr.com/services/api/flickr.photos.search.html
+    # https://www.flickr.com/services/api/flickr.photos.licenses.getInfo.html
+    # https://www.flickr.com/services/api/misc.urls.html
+    return {"text": search_terms,
+            "license": "1,2,3,4,5,6,8,9,10",  # All licenses except All Rights Reserved & 'No known copyright restrictions' (latter excluded due to poor quality results)
+            "media": "photos",
+            "content_type": "1",  # Photos only
+            "safe_search": "1",
+            "extras": "license,date_upload,owner_name,url_z,url_c,url_l,url_o",
+            "min_upload_date": min_upload_date}
+
+
+def iter_entities_from_search(ds_client, search_terms, min_upload_date=None,
+                              flickr=None):
+    """Like `create_entities_from_search`, but yields each entity as soon as
+    its search results page arrives instead of collecting them all first.
+    Searches with flickr if given, else with `make_flickr()`."""
+    # Walking Flickr search results and creating Datastore entities:
+    # https://github.com/sybrenstuvel/flickrapi/blob/master/doc/7-util.rst#walking-through-a-search-result
+    # https://github.com/GoogleCloudPlatform/python-docs-samples/tree/master/datastore/cloud-client
 
     logger.debug(f"Searching for photos of '{search_terms}' uploaded since {min_upload_date}...")
-    flickr = FlickrAPI(FLICKR_PUBLIC, FLICKR_SECRET, format="etree")  # Walk requires ElementTree
-    params = {"text": search_terms,
-              "license": "1,2,3,4,5,6,8,9,10",  # All licenses except All Rights Reserved & 'No known copyright restrictions' (latter excluded due to poor quality results)
-              "media": "photos",
-              "content_type": "1",  # Photos only
-              "safe_search": "1",
-              "extras": "license,date_upload,owner_name,url_z,url_c,url_l,url_o",
-              "min_upload_date": min_upload_date}
-    entities = list()
-    exclude_from_indexes = ["secret",
-                            "server",
-                            "farm",
-                            "ispublic",
-                            "isfriend",
-                            "isfamily",
-                            "url_z",
-                            "url_c",
-                            "url_l",
-                            "url_o",
-                            "height_z",
-                            "height_c",
-                            "height_l",
-                            "height_o",
-                            "width_z",
-                            "width_c",
-                            "width_l",
-                            "width_o",
-                            "download_url"]
+    flickr = flickr or make_flickr()
+    params = search_params(search_terms, min_upload_date)
     for photo in flickr.walk(**params):  # Creates a generator
-        kind = "Photo"
-        name = "Flickr-" + photo.get("id")
-        key = ds_client.key(kind, name)
-        entity = datastore.Entity(key=key, exclude_from_indexes=exclude_from_indexes)
-        entity.update({
-            "source": "Flickr",
-            "search_terms": search_terms,
-            "last_tweeted": datetime.datetime.utcfromtimestamp(1514764800),  # 1/1/18
-            "is_classified": False
-        })
-        for k, v in photo.items():
-            if not k == "dateupload":
-                entity.update({k: v})
-            else:
-                entity.update({k: datetime.datetime.utcfromtimestamp(int(v))})
-        entity.update({"download_url": get_download_url(entity)})
-        entities.append(entity)
-    logger.info(f"Found {len(entities)} photos of '{search_terms}' uploaded since {min_upload_date}.")
-    logger.debug(entities)
-    return entities
+        yield entity_from_photo(ds_client, photo, search_terms)
+
+
+EXCLUDE_FROM_INDEXES = ["secret",
+                        "server",
+                        "farm",
+                        "ispublic",
+                        "isfriend",
+                        "isfamily",
+                        "url_z",
+                        "url_c",
+                        "url_l",
+                        "url_o",
+                        "height_z",
+                        "height_c",
+                        "height_l",
+                        "height_o",
+                        "width_z",
+                        "width_c",
+                        "width_l",
+                        "width_o",
+                        "download_url"]
+
+# Photos get a random shard in [0, RANDOM_SHARDS) so that `tweet.py` can pick
+# one at random by querying a single shard instead of every eligible photo.
+RANDOM_SHARDS = 64
+
+
+def entity_from_photo(ds_client, photo, search_terms):
+    """Creates Photo entity from a Flickr search result.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        photo (xml.etree.ElementTree.Element): <photo> from Flickr search
+        search_terms (str or list): Search(es) that found the photo.
+
+    Returns:
+        google.cloud.datastore.entity.Entity of kind 'Photo'
+    """
+    kind = "Photo"
+    name = "Flickr-" + photo.get("id")
+    key = ds_client.key(kind, name)
+    entity = datastore.Entity(key=key, exclude_from_indexes=EXCLUDE_FROM_INDEXES)
+    entity.update({
+        "source": "Flickr",
+        "search_terms": search_terms,
+        "last_tweeted": datetime.datetime.utcfromtimestamp(1514764800),  # 1/1/18
+        "is_classified": False,
+        "random_shard": random.randrange(RANDOM_SHARDS)
+    })
+    for k, v in photo.items():
+        if not k == "dateupload":
+            entity.update({k: v})
+        else:
+            entity.update({k: datetime.datetime.utcfromtimestamp(int(v))})
+    entity.update({"download_url": get_download_url(entity)})
+    return entity
+
+
+def iter_entities_from_searches(ds_client, search_terms, min_upload_date=None,
+                                max_workers=3, calls_per_second=1.0, flickr=None):
+    """Searches Flickr for each of `search_terms` at the same time, sharing one
+    rate limit between them, and yields each photo's entity as soon as its
+    results page arrives. A photo found again by another search is yielded
+    again with `search_terms` listing every term that has found it so far;
+    found again by the same search, it's dropped.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        search_terms (list): e.g., ["plover chick", "plover baby"]
+        min_upload_date (str or dict, optional): See
+        `create_entities_from_search`. A dict maps each term to its own
+        min_upload_date. Defaults to None.
+        max_workers (int, optional): Searches paginating at once. Defaults to 3.
+        calls_per_second (float, optional): Flickr API calls per second across
+        all searches. Defaults to 1.0, Flickr's 3600 queries per hour.
+        flickr (flickrapi.FlickrAPI, optional): Defaults to `make_flickr()`.
+
+    Yields:
+        google.cloud.datastore.entity.Entity of kind 'Photo'
+    """
+    flickr = flickr or make_flickr()
+    search = utils.RateLimiter(calls_per_second).limit(
+        metrics.timed("flickr.photos.search")(flickr.photos.search))
+    found = queue.Queue(maxsize=1000)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Gives up once the consumer has, instead of blocking on a full queue.
+        while not stop.is_set():
+            try:
+                found.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def walk_term(term):
+        count = 0
+        since = min_upload_date.get(term) if isinstance(min_upload_date, dict) else min_upload_date
+        for photo in flickr.data_walker(search, per_page=250, **search_params(term, since)):
+            if stop.is_set():
+                return
+            count += 1
+            put((term, entity_from_photo(ds_client, photo, [term])))
+        logger.info(f"Found {count} photos of '{term}' uploaded since {since}.")
+
+    def run(term):
+        try:
+            walk_term(term)
+        finally:
+            put(done)
+
+    seen = dict()  # Key name -> terms that found it.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run, term) for term in search_terms]
+        try:
+            remaining = len(futures)
+            while remaining:
+                item = found.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                term, entity = item
+                terms = seen.setdefault(entity.key.name, list())
+                if term in terms:
+                    continue
+                terms.append(term)
+                entity["search_terms"] = list(terms)
+                yield entity
+        finally:
+            stop.set()
+        # Calling result() re-raises any search's exception.
+        for future in futures:
+            future.result()
+    logger.info(f"Found {len(seen)} distinct photos for {len(search_terms)} searches.")
+
+
+def create_entities_from_searches(ds_client, search_terms, min_upload_date=None, **kwargs):
+    """Collects `iter_entities_from_searches` into one entity per Flickr photo,
+    with `search_terms` a list of every term that found it.
+
+    Returns:
+        list of google.cloud.datastore.entity.Entity of kind 'Photo'
+    """
+    entities = dict()
+    for entity in iter_entities_from_searches(ds_client, search_terms, min_upload_date, **kwargs):
+        entities[entity.key.name] = entity
+    return list(entities.values())
+
+
+# Properties that belong to the bot rather than to Flickr, and so are never
+# overwritten by a new search result for a photo that's already stored.
+STATE_PROPERTIES = {"last_tweeted", "is_classified", "is_bird", "vision_labels",
+                    "vision_objects", "search_terms", "random_shard"}
+
+
+def filter_new_or_changed(ds_client, entities):
+    """Looks up entities' keys in Cloud Datastore (1000 per get_multi) and
+    returns only what needs writing: new photos as they are, and photos whose
+    Flickr metadata changed merged into the stored entity, so that their
+    classification, tweet history and state are preserved.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        entities (list): google.cloud.datastore.entity.Entity from a search
+
+    Returns:
+        list of google.cloud.datastore.entity.Entity to write.
+    """
+    to_write = list()
+    new = 0
+    for chunk in utils.chunk(entities, 1000):
+        stored = {e.key: e for e in ds_client.get_multi([e.key for e in chunk])}
+        for entity in chunk:
+            existing = stored.get(entity.key)
+            if existing is None:
+                to_write.append(entity)
+                new += 1
+                continue
+            changed = False
+            if "random_shard" not in existing:
+                # Stored before shards existed.
+                existing["random_shard"] = entity["random_shard"]
+                changed = True
+            for k, v in entity.items():
+                if k not in STATE_PROPERTIES and not _same_value(existing.get(k), v):
+                    existing[k] = v
+                    changed = True
+            terms = _as_list(existing.get("search_terms"))
+            for term in _as_list(entity.get("search_terms")):
+                if term not in terms:
+                    terms.append(term)
+                    changed = True
+            if changed:
+                existing["search_terms"] = terms
+                existing.exclude_from_indexes.update(entity.exclude_from_indexes)
+                to_write.append(existing)
+    logger.info(f"{new} new and {len(to_write) - new} changed of {len(entities)} photos found.")
+    return to_write
+
+
+def _as_list(value):
+    if value is None:
+        return list()
+    if isinstance(value, list):
+        return list(value)
+    return [value]
+
+
+def _same_value(a, b):
+    # Datastore hands back timezone-aware datetimes; ours are naive UTC.
+    if isinstance(a, datetime.datetime) and isinstance(b, datetime.datetime):
+        return a.replace(tzinfo=None) == b.replace(tzinfo=None)
+    return a == b
+
+
+def get_high_water_marks(ds_client, search_terms):
+    """Returns dict of search term: latest `dateupload` (datetime.datetime) of
+    a photo already ingested for that term. Terms never ingested are left out.
+    """
+    keys = [ds_client.key("IngestState", term) for term in search_terms]
+    return {e.key.name: e["max_dateupload"] for e in ds_client.get_multi(keys)}
+
+
+def raise_high_water_marks(marks, entities):
+    """Raises each search term's mark in marks (a dict, updated in place) to
+    the newest `dateupload` among entities, and returns marks."""
+    for entity in entities:
+        uploaded = entity.get("dateupload")
+        if uploaded is None:
+            continue
+        uploaded = uploaded.replace(tzinfo=None)
+        for term in _as_list(entity.get("search_terms")):
+            mark = marks.get(term)
+            if mark is None or uploaded > mark.replace(tzinfo=None):
+                marks[term] = uploaded
+    return marks
+
+
+def save_high_water_marks(ds_client, entities, marks=None):
+    """Raises each search term's high-water mark to the newest `dateupload`
+    among entities, and saves the marks as IngestState entities.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        entities (list): google.cloud.datastore.entity.Entity that were written
+        marks (dict, optional): Current marks from `get_high_water_marks`.
+
+    Returns:
+        dict of search term: datetime.datetime
+    """
+    marks = raise_high_water_marks(dict(marks or {}), entities)
+    states = list()
+    for term, mark in marks.items():
+        state = datastore.Entity(key=ds_client.key("IngestState", term))
+        state.update({"max_dateupload": mark})
+        states.append(state)
+    if states:
+        ds_client.put_multi(states)
+    return marks
+
+
+def ingest_incrementally(ds_client, search_terms, min_upload_date=None,
+                         on_written=None, **kwargs):
+    """Searches Flickr for each term from where its last ingest left off (or
+    from min_upload_date, for terms never ingested), writes new or changed
+    photos 500 at a time as the searches find them, and once every search has
+    finished, moves the high-water marks forward. An interrupted run keeps
+    what it wrote, and the next one searches the same dates again.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        search_terms (list)
+        min_upload_date (str, optional): For terms without a high-water mark.
+        on_written (callable, optional): Called with each list of entities
+        once it is written, e.g. to classify them next. Defaults to None.
+        **kwargs: Passed on to `iter_entities_from_searches`.
+
+    Returns:
+        int: Number of entities written.
+    """
+    marks = get_high_water_marks(ds_client, search_terms)
+    since = {term: min_upload_date for term in search_terms}
+    for term, mark in marks.items():
+        # min_upload_date is inclusive, so the photos at the mark come back and
+        # are skipped by `filter_new_or_changed`.
+        since[term] = str(calendar.timegm(mark.utctimetuple()))
+    found = iter_entities_from_searches(ds_client, search_terms, min_upload_date=since, **kwargs)
+    new_marks = dict(marks)
+
+    def to_write():
+        for chunk in utils.ichunk(found, 500):
+            # A commit can't change one entity twice; the last copy of a photo
+            # lists the most search terms.
+            chunk = list({e.key.name: e for e in chunk}.values())
+            raise_high_water_marks(new_marks, chunk)
+            yield from filter_new_or_changed(ds_client, chunk)
+
+    written = stream_entities_to_datastore(ds_client, to_write(), on_written=on_written)
+    save_high_water_marks(ds_client, [], new_marks)
+    return written
 
 
 def get_download_url(entity):
@@ -155,6 +442,38 @@ def write_entities_to_datastore(ds_client, entities):
     logger.info(f"Wrote {len(entities)} entities to Cloud Datastore for project beachbirbys.")
     return
 
+def stream_entities_to_datastore(ds_client, entities, chunk_size=500, on_written=None):
+    """Writes entities to Cloud Datastore chunk_size at a time as they arrive
+    from an iterable (e.g., `iter_entities_from_search`), so memory use stays
+    flat and everything written before an interruption stays written.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        entities (iterable): google.cloud.datastore.entity.Entity
+        chunk_size (int, optional): Defaults to 500, the most entities a
+        Datastore commit takes.
+        on_written (callable, optional): Called with each chunk once it is
+        written. Defaults to None.
+
+    Returns:
+        int: Number of entities written.
+    """
+    written = 0
+    for chunk in utils.ichunk(entities, chunk_size):
+        try:
+            with ds_client.batch():
+                logger.debug(f"Writing chunk of {len(chunk)}...")
+                ds_client.put_multi(chunk)
+        except Exception as e:
+            logger.exception(e)
+            logger.error(chunk)
+            raise
+        written += len(chunk)
+        if on_written is not None:
+            on_written(chunk)
+    logger.info(f"Wrote {written} entities to Cloud Datastore for project beachbirbys.")
+    return written
+
 ################################################################################
 if __name__ == "__main__":
     filename = os.path.basename(__file__)
@@ -162,14 +481,14 @@ if __name__ == "__main__":
     try:
         # This script is designed to be run on the first of the month in order
         # to find photos uploaded to Flickr during the previous month.
-        ds_client = datastore.Client()
+        ds_client = metrics.instrument(datastore.Client(), "datastore")
         search_terms = ["plover chick", "plover hatchling", "plover baby",
                         "sandpiper chick", "sandpiper hatchling", "sandpiper baby"]
         first_day_of_previous_month = (datetime.datetime.utcnow().replace(day=1) - relativedelta(months=1)).strftime("%Y-%m-%d")
-        for term in search_terms:
-            entities = create_entities_from_search(ds_client, term, min_upload_date=first_day_of_previous_month)
-            if entities:
-                write_entities_to_datastore(ds_client, entities)
+        ingest_incrementally(ds_client, search_terms,
+                             min_upload_date=first_day_of_previous_month)
         logger.info(f"Finished {filename}.")
     except Exception as e:
         logger.exception(e)
+    finally:
+        metrics.emit(filename)
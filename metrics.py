@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Counters and latency histograms for calls to Flickr, image downloads,
+Vision, Datastore and Twitter, summarized as JSON at the end of each run.
+
+    ds_client = metrics.instrument(datastore.Client(), "datastore")
+    with metrics.timer("download.image"):
+        ...
+    metrics.emit("classify_images")
+"""
+
+import bisect
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from google.cloud import vision
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PATH = os.path.join(os.path.dirname(__file__), "metrics.jsonl")
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class Histogram(object):
+    """Fixed-bucket latency histogram, so memory doesn't grow with calls."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the pth percentile
+        (or the max, for the overflow bucket)."""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean_ms": round(self.total / self.count, 1) if self.count else None,
+                "p50_ms": self.percentile(50),
+                "p90_ms": self.percentile(90),
+                "p99_ms": self.percentile(99),
+                "max_ms": round(self.max, 1)}
+
+
+class Metrics(object):
+    """Thread-safe registry of named counters and latency histograms."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.Counter()
+            self.histograms = collections.defaultdict(Histogram)
+            self.started = time.time()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.histograms[name].observe(seconds * 1000)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Times the block as name, counting calls and errors."""
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.count(f"{name}.errors")
+            raise
+        finally:
+            self.observe(name, time.monotonic() - started)
+            self.count(f"{name}.calls")
+
+    def timed(self, name):
+        """Decorator version of `timer`."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self, run=None):
+        """Returns dict of counters and latency histograms."""
+        with self._lock:
+            return {"run": run,
+                    "started": datetime.datetime.utcfromtimestamp(self.started).isoformat() + "Z",
+                    "seconds": round(time.time() - self.started, 3),
+                    "counters": dict(sorted(self.counters.items())),
+                    "latency": {name: h.summary() for name, h in sorted(self.histograms.items())}}
+
+
+METRICS = Metrics()
+count = METRICS.count
+observe = METRICS.observe
+timer = METRICS.timer
+timed = METRICS.timed
+summary = METRICS.summary
+reset = METRICS.reset
+
+
+def emit(run, path=SUMMARY_PATH):
+    """Appends this run's `summary` to path as one line of JSON, logs it, and
+    returns it."""
+    s = summary(run)
+    line = json.dumps(s, sort_keys=True)
+    logger.info(line)
+    if path:
+        with open(path, "a") as f:
+            f.write(line + "\n")
+    return s
+
+
+# Methods of each instrumented client that make a network call, and so are
+# worth timing. Others, like datastore's key() and batch(), are passed through.
+RPC_METHODS = {"datastore": {"get", "get_multi", "put", "put_multi", "delete",
+                             "delete_multi", "allocate_ids"},
+               "twitter": {"upload_media", "update_status", "get_home_timeline",
+                           "get_user_timeline", "destroy_status"},
+               "vision": {"label_detection", "object_localization",
+                          "safe_search_detection", "crop_hints"}}
+
+
+class InstrumentedClient(object):
+    """Wraps a client so every call to one of its RPC methods is timed as
+    '{prefix}.{method}'. Queries' pages are timed as '{prefix}.query' when
+    they're fetched.
+
+    Args:
+        client: e.g., google.cloud.datastore.client.Client or twython.Twython
+        prefix (str): e.g., "datastore"
+        metrics (Metrics, optional): Defaults to METRICS.
+        methods (set, optional): Names of the methods to time. Defaults to
+        RPC_METHODS[prefix], or none for other prefixes.
+    """
+
+    def __init__(self, client, prefix, metrics=None, methods=None):
+        self._client = client
+        self._prefix = prefix
+        self._metrics = metrics or METRICS
+        self._methods = RPC_METHODS.get(prefix, set()) if methods is None else set(methods)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name == "query" and callable(attr):
+            return self._query(attr)
+        if name not in self._methods or not callable(attr):
+            return attr
+        return self._metrics.timed(f"{self._prefix}.{name}")(attr)
+
+    def _query(self, make_query):
+        @functools.wraps(make_query)
+        def wrapper(*args, **kwargs):
+            return _InstrumentedQuery(make_query(*args, **kwargs), f"{self._prefix}.query", self._metrics)
+        return wrapper
+
+
+class _InstrumentedQuery(object):
+    def __init__(self, query, name, metrics):
+        self._query = query
+        self._name = name
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._query, name, value)
+
+    def fetch(self, *args, **kwargs):
+        return _TimedIterator(self._query.fetch(*args, **kwargs), self._name, self._metrics)
+
+
+class _TimedIterator(object):
+    """Times each page of a query iterator as it's fetched."""
+
+    def __init__(self, iterator, name, metrics):
+        self._iterator = iterator
+        self._name = name
+        self._metrics = metrics
+        self.pages = self._pages()
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+    def _pages(self):
+        pages = iter(self._iterator.pages)
+        while True:
+            started = time.monotonic()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except Exception:
+                self._metrics.count(f"{self._name}.errors")
+                raise
+            self._metrics.observe(self._name, time.monotonic() - started)
+            self._metrics.count(f"{self._name}.calls")
+            yield page
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class InstrumentedAnnotatorClient(InstrumentedClient):
+    """InstrumentedClient for google.cloud.vision_v1.ImageAnnotatorClient that
+    also counts images and features requested, e.g.
+    'vision.feature.LABEL_DETECTION'."""
+
+    def __init__(self, client, prefix="vision", metrics=None):
+        super(InstrumentedAnnotatorClient, self).__init__(client, prefix, metrics)
+
+    def annotate_image(self, request, **kwargs):
+        self._count_features([request])
+        with self._metrics.timer(f"{self._prefix}.annotate_image"):
+            return self._client.annotate_image(request, **kwargs)
+
+    def batch_annotate_images(self, requests, **kwargs):
+        requests = list(requests)
+        self._count_features(requests)
+        with self._metrics.timer(f"{self._prefix}.batch_annotate_images"):
+            return self._client.batch_annotate_images(requests, **kwargs)
+
+    def _count_features(self, requests):
+        self._metrics.count(f"{self._prefix}.images", len(requests))
+        for request in requests:
+            features = request["features"] if isinstance(request, dict) else request.features
+            for feature in features:
+                feature_type = feature["type"] if isinstance(feature, dict) else feature.type
+                self._metrics.count(f"{self._prefix}.feature.{vision.enums.Feature.Type(feature_type).name}")
+
+
+def instrument(client, prefix):
+    """Returns client wrapped in InstrumentedAnnotatorClient if prefix is
+    'vision', else InstrumentedClient."""
+    if prefix == "vision":
+        return InstrumentedAnnotatorClient(client, prefix)
+    return InstrumentedClient(client, prefix)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Runs ingest, classify and tweet as one long-lived asyncio process instead
+of three cron jobs: photos found by a search flow straight into
+classification, and birds straight into the tweet queue. The Google, Flickr
+and Twitter clients block, so every call to them runs in a thread pool.
+
+    python pipeline.py            # run forever
+    python pipeline.py --once     # one ingest, classify everything, one tweet
+"""
+
+import asyncio
+import datetime
+import functools
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from dateutil.relativedelta import relativedelta
+from google.cloud import datastore
+from google.cloud import vision
+
+import classify_images
+import dedupe
+import flickr_to_datastore
+import metrics
+import prefilter
+import tweet
+import utils
+import vision_cache
+
+### LOGGING ####################################################################
+logger = logging.getLogger(__name__)
+utils.configure_logger(logger, console_output=True)
+################################################################################
+
+SEARCH_TERMS = ["plover chick", "plover hatchling", "plover baby",
+                "sandpiper chick", "sandpiper hatchling", "sandpiper baby"]
+DAY = 24 * 60 * 60
+
+# Put on a queue when the stage feeding it is done.
+_DONE = object()
+
+
+class Pipeline(object):
+    """Ingest, classify and tweet stages connected by bounded asyncio queues.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        search_terms (list, optional): Defaults to SEARCH_TERMS.
+        min_upload_date (str, optional): For terms never ingested before.
+        flickr (flickrapi.FlickrAPI, optional): Defaults to
+        `flickr_to_datastore.make_flickr()`.
+        twitter (twython.Twython, optional): Defaults to `tweet.make_twitter()`.
+        ingest_every (float, optional): Seconds between Flickr searches.
+        Defaults to a day.
+        calls_per_second (float, optional): Flickr rate limit. Defaults to 1.0.
+        tweet_every (float, optional): Seconds between tweets. Defaults to a
+        day.
+        queue_size (int, optional): Most entities waiting between two stages;
+        a full queue makes the stage before it wait. Defaults to 256.
+        classify_workers (int, optional): Batches classified at once. Defaults
+        to 2.
+        batch_size (int, optional): Entities per classify batch. Defaults to
+        utils.VISION_BATCH_SIZE.
+        threads (int, optional): Threads for blocking calls. Defaults to 8.
+        targets (list, optional): Defaults to classify_images.TARGETS.
+        duplicates (dedupe.DuplicateIndex, optional): Send one photo per
+        cluster of near-duplicates to Vision. Defaults to None.
+        local_filter (prefilter.PreFilter, optional): Don't send images it
+        rejects to Vision. Defaults to None.
+        queue_path (str, optional): Tweet queue. Defaults to tweet.QUEUE_PATH.
+    """
+
+    def __init__(self, ds_client, v_client, search_terms=SEARCH_TERMS,
+                 min_upload_date=None, flickr=None, twitter=None,
+                 ingest_every=DAY, calls_per_second=1.0, tweet_every=DAY, queue_size=256,
+                 classify_workers=2, batch_size=utils.VISION_BATCH_SIZE,
+                 threads=8, targets=classify_images.TARGETS, duplicates=None,
+                 local_filter=None, queue_path=tweet.QUEUE_PATH):
+        self.ds_client = ds_client
+        self.v_client = v_client
+        self.search_terms = search_terms
+        self.min_upload_date = min_upload_date
+        self.flickr = flickr
+        self.twitter = twitter
+        self.ingest_every = ingest_every
+        self.calls_per_second = calls_per_second
+        self.tweet_every = tweet_every
+        self.queue_size = queue_size
+        self.classify_workers = classify_workers
+        self.batch_size = batch_size
+        self.targets = targets
+        self.duplicates = duplicates
+        self.local_filter = local_filter
+        self.queue_path = queue_path
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.counts = {"ingested": 0, "classified": 0, "birds": 0, "tweeted": 0}
+        self.writer = None
+        # Names of entities queued or being classified, which a backlog pull
+        # mustn't queue again.
+        self.in_flight = set()
+
+    async def _blocking(self, func, *args, **kwargs):
+        """Runs func in the thread pool and waits for it."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def _count_written(self, entities):
+        """Counts classified entities once they're saved (see
+        `utils.WriteBuffer`), and lets backlog pulls see them again."""
+        self.counts["classified"] += len(entities)
+        self.in_flight.difference_update(entity.key.name for entity in entities)
+
+    async def run(self, once=False):
+        """Runs every stage until cancelled, or, if once, until one ingest has
+        been classified and one tweet sent.
+
+        Returns:
+            dict of counts of entities ingested, classified, birds and tweeted.
+        """
+        to_classify = asyncio.Queue(maxsize=self.queue_size)
+        to_tweet = asyncio.Queue(maxsize=self.queue_size)
+        try:
+            with utils.WriteBuffer(self.ds_client, on_written=self._count_written) as writer:
+                self.writer = writer
+                classifiers = [asyncio.ensure_future(self.classify(to_classify, to_tweet, writer))
+                               for _ in range(self.classify_workers)]
+                tasks = [asyncio.ensure_future(self.ingest(to_classify, once)),
+                         asyncio.ensure_future(self.tweet(to_tweet, once))]
+                try:
+                    await tasks[0]
+                    await asyncio.gather(*classifiers)
+                    await to_tweet.put(_DONE)
+                    await tasks[1]
+                finally:
+                    for task in tasks + classifiers:
+                        task.cancel()
+                    # Let them finish cancelling before the writer flushes.
+                    await asyncio.gather(*tasks, *classifiers, return_exceptions=True)
+        finally:
+            self.executor.shutdown(wait=False)
+        logger.info(f"Pipeline finished: {self.counts}")
+        return self.counts
+
+    async def queue_backlog(self, to_classify):
+        """Queues every unclassified entity in Datastore that isn't already in
+        flight, including any whose classification failed since the last
+        time."""
+        # Entities classified but still buffered would come around again.
+        await self._blocking(self.writer.flush)
+        backlog = classify_images.iter_pull(self.ds_client, kind="Photo", key="is_classified",
+                                            val=False)
+        while True:
+            entity = await self._blocking(next, backlog, None)
+            if entity is None:
+                break
+            if entity.key.name in self.in_flight:
+                continue
+            self.in_flight.add(entity.key.name)
+            await to_classify.put(entity)
+
+    async def ingest(self, to_classify, once=False):
+        """Every ingest_every seconds, searches Flickr, then queues the
+        unclassified backlog, which includes whatever the search wrote."""
+        while True:
+            try:
+                self.counts["ingested"] += await self._blocking(
+                    flickr_to_datastore.ingest_incrementally, self.ds_client,
+                    self.search_terms, self.min_upload_date, flickr=self.flickr,
+                    calls_per_second=self.calls_per_second)
+            except Exception as e:
+                logger.exception(e)
+            try:
+                await self.queue_backlog(to_classify)
+            except Exception as e:
+                logger.exception(e)
+            if once:
+                break
+            await asyncio.sleep(self.ingest_every)
+        for _ in range(self.classify_workers):
+            await to_classify.put(_DONE)
+
+    async def classify(self, to_classify, to_tweet, writer):
+        """Classifies queued entities up to batch_size at a time, saves them,
+        and passes birds on to be tweeted."""
+        done = False
+        while not done:
+            batch = list()
+            item = await to_classify.get()
+            while True:
+                if item is _DONE:
+                    # Each worker takes exactly one.
+                    done = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size or to_classify.empty():
+                    break
+                item = to_classify.get_nowait()
+            if not batch:
+                continue
+            try:
+                classified = await self._blocking(classify_images.classify_entities_batched,
+                                                  self.v_client, batch,
+                                                  batch_size=self.batch_size,
+                                                  targets=self.targets,
+                                                  duplicates=self.duplicates,
+                                                  local_filter=self.local_filter)
+                await self._blocking(writer.put_multi, classified)
+            except Exception as e:
+                logger.exception(e)
+                # Left for the next backlog pull to retry.
+                self.in_flight.difference_update(entity.key.name for entity in batch)
+                continue
+            # Entities saved are in flight until the writer flushes them (see
+            # `_count_written`); the rest are left for the next pull.
+            saved = {entity.key.name for entity in classified}
+            self.in_flight.difference_update(entity.key.name for entity in batch
+                                             if entity.key.name not in saved)
+            for entity in classified:
+                if entity.get("is_bird"):
+                    self.counts["birds"] += 1
+                    await to_tweet.put(entity)
+
+    async def tweet(self, to_tweet, once=False):
+        """Tweets from the tweet queue every tweet_every seconds (or, if once,
+        after everything upstream is done), adding new birds to the queue
+        while it's short, and topping it up after each tweet."""
+        loop = asyncio.get_running_loop()
+        next_tweet = loop.time() + self.tweet_every
+        upstream_done = False
+        while True:
+            timeout = None if once else max(0, next_tweet - loop.time())
+            if not upstream_done:
+                try:
+                    entity = await asyncio.wait_for(to_tweet.get(), timeout)
+                except asyncio.TimeoutError:
+                    entity = None
+                if entity is _DONE:
+                    upstream_done = True
+                elif entity is not None:
+                    queue = await self._blocking(tweet.load_queue, self.queue_path)
+                    if len(queue) < tweet.QUEUE_LENGTH:
+                        cutoff = datetime.datetime.utcnow() - relativedelta(months=1)
+                        await self._blocking(tweet.stage_entities, [entity], self.queue_path,
+                                             ds_client=self.ds_client, tweeted_before=cutoff)
+                    continue
+            elif not once:
+                await asyncio.sleep(max(0, next_tweet - loop.time()))
+            if not once and loop.time() < next_tweet:
+                continue
+            cutoff = datetime.datetime.utcnow() - relativedelta(months=1)
+            try:
+                # Buffered classifications would overwrite last_tweeted.
+                await self._blocking(self.writer.flush)
+                if not await self._blocking(tweet.load_queue, self.queue_path):
+                    await self._blocking(tweet.stage_tweets, self.ds_client,
+                                         tweeted_before=cutoff, path=self.queue_path)
+                if await self._blocking(tweet.tweet_next, self.ds_client, self.twitter,
+                                        self.queue_path, tweeted_before=cutoff):
+                    self.counts["tweeted"] += 1
+                await self._blocking(tweet.stage_tweets, self.ds_client,
+                                     tweeted_before=cutoff, path=self.queue_path)
+            except Exception as e:
+                logger.exception(e)
+            if once:
+                return
+            next_tweet = loop.time() + self.tweet_every
+
+################################################################################
+
+if __name__ == "__main__":
+    filename = os.path.basename(__file__)
+    logger.info(f"Starting {filename}...")
+    try:
+        ds_client = metrics.instrument(datastore.Client(), "datastore")
+        v_client = vision_cache.CachedAnnotatorClient(
+            metrics.instrument(vision.ImageAnnotatorClient(), "vision"))
+        first_day_of_previous_month = (datetime.datetime.utcnow().replace(day=1) - relativedelta(months=1)).strftime("%Y-%m-%d")
+        pipeline = Pipeline(ds_client, v_client, min_upload_date=first_day_of_previous_month,
+                            twitter=tweet.make_twitter(), duplicates=dedupe.DuplicateIndex(),
+                            local_filter=prefilter.PreFilter.load())
+        asyncio.run(pipeline.run(once="--once" in sys.argv))
+        logger.info(f"Finished {filename}.")
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        metrics.emit(filename)
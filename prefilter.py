@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local pre-filter that keeps obvious non-birds away from Vision: logistic
+regression over color histograms, trained on photos already classified:
+those in 'assets/' marked is_bird, and those in 'assets/negative/' (not
+birds, see `classify_images.move_neg`).
+
+    python prefilter.py                      # train, report, save
+    python prefilter.py --min-recall 0.99    # keep more birds, skip fewer photos
+
+Once a model is saved, classify_images.py loads it and labels photos scoring
+below its threshold as non-birds without calling Vision.
+"""
+
+import argparse
+import io
+import logging
+import os
+
+import numpy as np
+from google.cloud import datastore
+from PIL import Image
+
+import asset_store
+import utils
+
+### LOGGING ####################################################################
+logger = logging.getLogger(__name__)
+utils.configure_logger(logger, console_output=True)
+################################################################################
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "assets/prefilter.npz")
+# Images are shrunk to this before their histograms are taken.
+THUMBNAIL_EDGE = 64
+# Fraction of birds in the held-out set that must still be sent to Vision.
+MIN_RECALL = 0.98
+
+
+def image_features(filepath):
+    """Returns 1-D float array describing an image's colors: a 4x4x4 joint RGB
+    histogram, hue, saturation and brightness histograms, and how busy it is
+    (mean gradient of brightness).
+
+    Args:
+        filepath (str): 'path/to/assets/name.jpg'
+    """
+    with Image.open(io.BytesIO(asset_store.get_store().read(filepath))) as original:
+        original.draft("RGB", (THUMBNAIL_EDGE, THUMBNAIL_EDGE))
+        im = original.convert("RGB")
+    im.thumbnail((THUMBNAIL_EDGE, THUMBNAIL_EDGE))
+    rgb = np.asarray(im, dtype=np.uint8).reshape(-1, 3)
+    hsv = np.asarray(im.convert("HSV"), dtype=np.uint8).reshape(-1, 3)
+    gray = np.asarray(im.convert("L"), dtype=np.float32) / 255.0
+
+    joint = (rgb[:, 0] // 64) * 16 + (rgb[:, 1] // 64) * 4 + rgb[:, 2] // 64
+    parts = [np.bincount(joint, minlength=64),
+             np.bincount(hsv[:, 0] // 16, minlength=16),
+             np.bincount(hsv[:, 1] // 32, minlength=8),
+             np.bincount(hsv[:, 2] // 32, minlength=8)]
+    parts = [p / float(len(rgb)) for p in parts]
+    busyness = np.array([np.abs(np.diff(gray, axis=0)).mean() if gray.shape[0] > 1 else 0.0,
+                         np.abs(np.diff(gray, axis=1)).mean() if gray.shape[1] > 1 else 0.0])
+    return np.concatenate(parts + [busyness])
+
+
+def features(filepaths):
+    """Returns (len(filepaths), n_features) array of `image_features`."""
+    return np.vstack([image_features(fp) for fp in filepaths])
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+
+def fit_logistic(X, y, l2=1e-3, learning_rate=0.5, epochs=500):
+    """Fits L2-regularized logistic regression by full-batch gradient descent,
+    weighting classes equally however unbalanced they are.
+
+    Args:
+        X (numpy.ndarray): (n, d) standardized features
+        y (numpy.ndarray): (n,) 1 for birds, 0 for not
+
+    Returns:
+        tuple of (d,) weights and float bias
+    """
+    n, d = X.shape
+    positives = max(1, int(y.sum()))
+    negatives = max(1, n - positives)
+    sample_weights = np.where(y == 1, n / (2.0 * positives), n / (2.0 * negatives))
+    weights = np.zeros(d)
+    bias = 0.0
+    for _ in range(epochs):
+        error = (_sigmoid(X @ weights + bias) - y) * sample_weights
+        weights -= learning_rate * (X.T @ error / n + l2 * weights)
+        bias -= learning_rate * error.mean()
+    return weights, bias
+
+
+class PreFilter(object):
+    """Trained pre-filter: scores images by how likely they are to show a bird,
+    and keeps those scoring at least threshold.
+
+    Args:
+        mean (numpy.ndarray): Per-feature mean of the training set.
+        std (numpy.ndarray): Per-feature standard deviation.
+        weights (numpy.ndarray)
+        bias (float)
+        threshold (float, optional): Defaults to 0.5.
+    """
+
+    def __init__(self, mean, std, weights, bias, threshold=0.5):
+        self.mean = mean
+        self.std = std
+        self.weights = weights
+        self.bias = float(bias)
+        self.threshold = float(threshold)
+
+    @classmethod
+    def train(cls, X, y, **kwargs):
+        """Standardizes X and fits `fit_logistic` to it."""
+        mean = X.mean(axis=0)
+        std = X.std(axis=0)
+        std[std == 0] = 1.0
+        weights, bias = fit_logistic((X - mean) / std, y, **kwargs)
+        return cls(mean, std, weights, bias)
+
+    def score_features(self, X):
+        """Returns (n,) array of bird probabilities for rows of features."""
+        return _sigmoid(((X - self.mean) / self.std) @ self.weights + self.bias)
+
+    def scores(self, filepaths):
+        return self.score_features(features(filepaths)) if filepaths else np.zeros(0)
+
+    def keep(self, filepaths):
+        """Returns list of bools: whether each image should go to Vision."""
+        return [bool(s) for s in self.scores(filepaths) >= self.threshold]
+
+    def save(self, path=DEFAULT_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(f, mean=self.mean, std=self.std, weights=self.weights,
+                     bias=self.bias, threshold=self.threshold)
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        """Returns the PreFilter saved at path, or None if there isn't one."""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            return cls(saved["mean"], saved["std"], saved["weights"],
+                       float(saved["bias"]), float(saved["threshold"]))
+
+
+def tradeoff(scores, y, thresholds=None):
+    """Returns list of dicts, one per threshold, of the precision and recall
+    of sending images scoring at least threshold to Vision, and the fraction
+    of all images that would be skipped."""
+    if thresholds is None:
+        thresholds = np.round(np.linspace(0.05, 0.95, 19), 2)
+    rows = list()
+    for threshold in thresholds:
+        sent = scores >= threshold
+        true_positives = int((sent & (y == 1)).sum())
+        rows.append({"threshold": float(threshold),
+                     "precision": true_positives / sent.sum() if sent.any() else 1.0,
+                     "recall": true_positives / y.sum() if y.any() else 1.0,
+                     "skipped": 1.0 - sent.mean() if len(sent) else 0.0})
+    return rows
+
+
+def choose_threshold(rows, min_recall=MIN_RECALL):
+    """Returns the highest threshold in `tradeoff` rows whose recall is at
+    least min_recall, or the lowest threshold if none is."""
+    ok = [r["threshold"] for r in rows if r["recall"] >= min_recall]
+    return max(ok) if ok else min(r["threshold"] for r in rows)
+
+
+def training_files(ds_client, assets_dir=None):
+    """Returns (bird filepaths, non-bird filepaths): the images in assets_dir
+    whose Photo entities are marked is_bird, and those in its 'negative'
+    folder. Images that were never classified, and copies made for tweets,
+    are left out.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        assets_dir (str, optional): Defaults to utils.ASSETS_DIR.
+    """
+    assets_dir = assets_dir or utils.ASSETS_DIR
+    store = asset_store.get_store()
+    candidates = {os.path.basename(fp)[:-len(".jpg")]: fp for fp in store.list(assets_dir)
+                  if not fp.endswith("_tweet.jpg")}
+    birds = list()
+    # Datastore looks up at most 1000 keys at a time.
+    for names in utils.chunk(sorted(candidates), 1000):
+        entities = ds_client.get_multi([ds_client.key("Photo", name) for name in names])
+        birds.extend(candidates[e.key.name] for e in entities if e.get("is_bird") == True)
+    non_birds = store.list(os.path.join(assets_dir, "negative"))
+    return sorted(birds), non_birds
+
+
+def train_from_assets(ds_client, assets_dir=None, holdout=0.25, min_recall=MIN_RECALL,
+                      seed=0):
+    """Trains a PreFilter on sorted photos (see `training_files`), and sets its
+    threshold from a held-out fraction of them.
+
+    Returns:
+        tuple of PreFilter and `tradeoff` rows for the held-out photos
+    """
+    birds, non_birds = training_files(ds_client, assets_dir)
+    if not birds or not non_birds:
+        raise ValueError(f"Need both birds and non-birds to train; found {len(birds)} "
+                         f"and {len(non_birds)}.")
+    X = features(birds + non_birds)
+    y = np.concatenate([np.ones(len(birds)), np.zeros(len(non_birds))])
+    order = np.random.RandomState(seed).permutation(len(y))
+    n_test = max(1, int(len(y) * holdout))
+    test, train = order[:n_test], order[n_test:]
+    model = PreFilter.train(X[train], y[train])
+    rows = tradeoff(model.score_features(X[test]), y[test])
+    model.threshold = choose_threshold(rows, min_recall)
+    logger.info(f"Trained on {len(train)} photos; threshold {model.threshold}.")
+    return model, rows
+
+
+def print_report(rows, chosen=None):
+    print(f"{'threshold':>10}{'precision':>11}{'recall':>9}{'skipped':>9}")
+    for r in rows:
+        mark = "  <-" if r["threshold"] == chosen else ""
+        print(f"{r['threshold']:>10.2f}{r['precision']:>11.3f}{r['recall']:>9.3f}"
+              f"{r['skipped']:>9.3f}{mark}")
+
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--min-recall", type=float, default=MIN_RECALL,
+                        help="Fraction of held-out birds that must still go to Vision.")
+    parser.add_argument("--holdout", type=float, default=0.25)
+    parser.add_argument("--output", default=DEFAULT_PATH)
+    args = parser.parse_args()
+    model, rows = train_from_assets(datastore.Client(), holdout=args.holdout,
+                                    min_recall=args.min_recall)
+    print_report(rows, model.threshold)
+    model.save(args.output)
+    logger.info(f"Saved to {args.output}.")
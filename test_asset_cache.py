@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import asset_cache
+import asset_store
+
+
+def _cache(tmp_path, **kwargs):
+    return asset_cache.AssetCache(asset_store.DirectoryStore(),
+                                  path=str(tmp_path / "cache.sqlite3"),
+                                  root=str(tmp_path), **kwargs)
+
+
+def test_negatives_go_first_then_least_recently_used(tmp_path):
+    root = str(tmp_path)
+    queue_path = tmp_path / "queue.json"
+    queue_path.write_text(json.dumps([{"name": "Flickr-queued"}]))
+    cache = _cache(tmp_path, max_bytes=1000,
+                   pinned=lambda: asset_cache.queued_names(str(queue_path)))
+    cache.write(os.path.join(root, "Flickr-queued.jpg"), b"q" * 300)
+    cache.write(os.path.join(root, "Flickr-old.jpg"), b"o" * 300)
+    cache.write(os.path.join(root, "Flickr-new.jpg"), b"n" * 100)
+    cache.move(os.path.join(root, "Flickr-new.jpg"), os.path.join(root, "negative", "Flickr-new.jpg"))
+    cache.read(os.path.join(root, "Flickr-queued.jpg"))
+    assert cache.stats()["bytes"] == 700
+
+    # Over budget: the negative goes, then the older unpinned positive.
+    cache.write(os.path.join(root, "Flickr-another.jpg"), b"a" * 400)
+    assert not os.path.exists(os.path.join(root, "negative", "Flickr-new.jpg"))
+    assert not os.path.exists(os.path.join(root, "Flickr-old.jpg"))
+    assert os.path.exists(os.path.join(root, "Flickr-queued.jpg"))
+    assert os.path.exists(os.path.join(root, "Flickr-another.jpg"))
+    assert cache.stats() == {"images": 2, "bytes": 700, "max_bytes": 1000, "evicted": 2}
+
+
+def test_total_is_shared_and_new_images_stay(tmp_path):
+    """Every handle on the database should see the same total, and a write
+    shouldn't evict the image it just wrote."""
+    cache = _cache(tmp_path, max_bytes=100, pinned=None)
+    other = _cache(tmp_path, max_bytes=100, pinned=None)
+    cache.write(str(tmp_path / "Flickr-1.jpg"), b"a" * 40)
+    assert other.stats()["bytes"] == 40
+    other.write(str(tmp_path / "Flickr-2.jpg"), b"b" * 95)
+    assert not os.path.exists(str(tmp_path / "Flickr-1.jpg"))
+    assert os.path.exists(str(tmp_path / "Flickr-2.jpg"))
+    assert cache.stats()["bytes"] == other.stats()["bytes"] == 95
+    other.close()
+    cache.close()
+
+
+def test_existing_files_are_found_and_aged_out(tmp_path):
+    files = asset_store.DirectoryStore()
+    files.write(str(tmp_path / "Flickr-1.jpg"), b"x" * 10)
+    files.write(str(tmp_path / "cropped" / "Flickr-1_cropped.jpg"), b"y" * 5)
+    cache = _cache(tmp_path, max_age=60, pinned=None)
+    assert cache.stats()["bytes"] == 15
+    cache.write(str(tmp_path / "Flickr-2.jpg"), b"z")
+    assert sorted(cache.evict()) == [str(tmp_path / "Flickr-1.jpg"),
+                                     str(tmp_path / "cropped" / "Flickr-1_cropped.jpg")]
+    assert os.path.exists(str(tmp_path / "Flickr-2.jpg"))
+
+
+def test_evicting_from_a_pack_leaves_compacting_for_later(tmp_path):
+    pack = asset_store.PackStore(str(tmp_path))
+    cache = asset_cache.AssetCache(pack, max_bytes=100, path=str(tmp_path / "cache.sqlite3"),
+                                   root=str(tmp_path), pinned=None)
+    for i in range(5):
+        cache.write(str(tmp_path / f"Flickr-{i}.jpg"), bytes([i]) * 40)
+    # Writes only drop index rows; the pack isn't rewritten under them.
+    assert pack.stats()["live_bytes"] <= 100
+    assert pack.stats()["pack_bytes"] == 200
+    pack.compact()
+    assert pack.stats()["pack_bytes"] <= 100
+    assert pack.read(str(tmp_path / "Flickr-4.jpg")) == bytes([4]) * 40
+    pack.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+
+import pytest
+
+import asset_store
+import classify_images
+import fakes
+import utils
+
+
+@pytest.fixture
+def pack(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    store = asset_store.PackStore(str(tmp_path))
+    previous = asset_store.set_store(store)
+    yield store
+    asset_store.set_store(previous)
+    store.close()
+
+
+def test_pack_reads_writes_and_retags(pack, tmp_path):
+    path = os.path.join(str(tmp_path), "Flickr-1.jpg")
+    pack.write(path, b"first")
+    assert pack.read(path) == b"first"
+    # Appends after the pack was mapped are read through a new map.
+    pack.write(os.path.join(str(tmp_path), "Flickr-2.jpg"), b"second")
+    assert pack.read(os.path.join(str(tmp_path), "Flickr-2.jpg")) == b"second"
+
+    neg_path = classify_images.move_neg(path)
+    assert neg_path == os.path.join(str(tmp_path), "negative", "Flickr-1.jpg")
+    assert not pack.exists(path) and pack.read(neg_path) == b"first"
+    assert pack.list(str(tmp_path)) == [os.path.join(str(tmp_path), "Flickr-2.jpg")]
+    assert pack.list(os.path.join(str(tmp_path), "negative")) == [neg_path]
+    # Nothing but the pack, its lock and its index.
+    assert sorted(os.listdir(tmp_path)) == ["assets.pack", "assets.pack.lock", "assets.sqlite3"]
+
+
+def test_compact_drops_overwritten_copies(pack, tmp_path):
+    path = os.path.join(str(tmp_path), "Flickr-1.jpg")
+    pack.write(path, b"old" * 10)
+    pack.write(path, b"new")
+    pack.write(os.path.join(str(tmp_path), "Flickr-2.jpg"), b"other")
+    assert pack.compact() == 30
+    assert pack.stats() == {"images": 2, "live_bytes": 8, "pack_bytes": 8}
+    reopened = asset_store.PackStore(str(tmp_path))
+    assert reopened.read(path) == b"new"
+    reopened.close()
+
+
+def test_handles_see_each_others_compactions(pack, tmp_path):
+    """A second handle (as in another process) compacting the pack shouldn't
+    leave the first reading a stale map or appending to a deleted file."""
+    first = os.path.join(str(tmp_path), "Flickr-1.jpg")
+    second = os.path.join(str(tmp_path), "Flickr-2.jpg")
+    pack.write(first, b"old" * 10)
+    pack.write(first, b"new")
+    pack.write(second, b"other")
+    assert pack.read(second) == b"other"
+
+    other = asset_store.PackStore(str(tmp_path))
+    assert other.compact() == 30
+    assert pack.read(second) == b"other"
+    pack.write(os.path.join(str(tmp_path), "Flickr-3.jpg"), b"third")
+    assert other.read(os.path.join(str(tmp_path), "Flickr-3.jpg")) == b"third"
+    assert other.stats() == pack.stats() == {"images": 3, "live_bytes": 13, "pack_bytes": 13}
+    other.close()
+    assert sorted(os.listdir(tmp_path)) == ["assets.1.pack", "assets.pack.lock", "assets.sqlite3"]
+
+
+def test_read_stream_outlives_a_compaction(pack, tmp_path):
+    """A stream started before a compaction should keep reading the bytes it
+    looked up."""
+    path = os.path.join(str(tmp_path), "Flickr-1.jpg")
+    pack.write(path, b"old" * 10)
+    pack.write(path, b"0123456789")
+    chunks = pack.read_stream(path, 4)
+    assert next(chunks) == b"0123"
+    assert pack.compact() == 30
+    assert list(chunks) == [b"4567", b"89"]
+    assert b"".join(pack.read_stream(path, 4)) == b"0123456789"
+
+
+def test_migrate_from_folders(tmp_path):
+    files = asset_store.DirectoryStore()
+    layout = {"Flickr-1.jpg": b"bird", os.path.join("negative", "Flickr-2.jpg"): b"rock",
+              os.path.join("cropped", "Flickr-1_cropped.jpg"): b"crop"}
+    for relative, content in layout.items():
+        files.write(os.path.join(str(tmp_path), relative), content)
+    pack = asset_store.PackStore(str(tmp_path))
+    assert asset_store.migrate(str(tmp_path), pack, delete=True) == 3
+    for relative, content in layout.items():
+        filepath = os.path.join(str(tmp_path), relative)
+        assert pack.read(filepath) == content
+        assert not os.path.exists(filepath)
+    assert asset_store.tag_of(os.path.join(str(tmp_path), "cropped", "x.jpg")) == "cropped"
+    pack.close()
+
+
+def test_migrate_keeps_same_name_in_two_folders(tmp_path):
+    """A photo kept both as a bird and in negative/ is two images, so deleting
+    either file once migrated mustn't lose the other."""
+    files = asset_store.DirectoryStore()
+    layout = {"Flickr-1.jpg": b"bird", os.path.join("negative", "Flickr-1.jpg"): b"rock"}
+    for relative, content in layout.items():
+        files.write(os.path.join(str(tmp_path), relative), content)
+    pack = asset_store.PackStore(str(tmp_path))
+    assert asset_store.migrate(str(tmp_path), pack, delete=True) == 2
+    for relative, content in layout.items():
+        assert pack.read(os.path.join(str(tmp_path), relative)) == content
+    assert pack.stats()["images"] == 2
+    pack.close()
+
+
+def test_rename_moves_the_index_entry(pack, tmp_path):
+    path = os.path.join(str(tmp_path), "Flickr-1.jpg")
+    new_path = os.path.join(str(tmp_path), "cropped", "Flickr-1_cropped.jpg")
+    pack.write(path, b"bird")
+    assert pack.move(path, new_path) == new_path
+    assert not pack.exists(path) and pack.read(new_path) == b"bird"
+    assert pack.stats() == {"images": 1, "live_bytes": 4, "pack_bytes": 4}
+
+
+def test_rekeys_an_index_keyed_by_name(tmp_path):
+    db = sqlite3.connect(str(tmp_path / "assets.sqlite3"))
+    db.execute("CREATE TABLE assets (name TEXT PRIMARY KEY, offset INTEGER NOT NULL, "
+               "length INTEGER NOT NULL, tag TEXT NOT NULL)")
+    db.execute("INSERT INTO assets VALUES ('Flickr-1', 0, 4, 'negative')")
+    db.commit()
+    db.close()
+    (tmp_path / "assets.pack").write_bytes(b"rock")
+    pack = asset_store.PackStore(str(tmp_path))
+    neg_path = os.path.join(str(tmp_path), "negative", "Flickr-1.jpg")
+    assert pack.read(neg_path) == b"rock"
+    pack.write(os.path.join(str(tmp_path), "Flickr-1.jpg"), b"bird")
+    assert pack.read(neg_path) == b"rock"
+    pack.close()
+
+
+def test_download_into_pack(pack, tmp_path):
+    fixtures = fakes.make_fixtures(2)
+    session = utils.make_session()
+    session.mount(fakes.FAKE_CDN, fakes.FakeImageAdapter(fixtures))
+    filepath = utils.download_image(f"{fakes.FAKE_CDN}1_l.jpg", "Flickr-1", session=session)
+    assert pack.read(filepath) in fixtures
+    assert utils.ImageHandle(filepath).size == (96, 72)
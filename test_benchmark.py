@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import benchmark
+import utils
+
+
+def test_run_covers_every_stage():
+    session = utils._session
+    results = benchmark.run(30, tweets=3)
+    # The fake CDN shouldn't outlive the run.
+    assert utils._session is session
+    by_stage = {r["stage"]: r for r in results}
+    assert by_stage["ingest"]["items"] == 30
+    assert by_stage["classify"]["items"] == 30
+    assert by_stage["tweet"]["items"] == 3
+    assert by_stage["classify"]["p99_ms"] >= by_stage["classify"]["p50_ms"]
+
+
+def test_regressions():
+    baseline = [{"size": 100, "stage": "classify", "per_second": 100.0}]
+    assert benchmark.regressions([{"size": 100, "stage": "classify", "per_second": 90.0}],
+                                 baseline, 0.2) == []
+    assert len(benchmark.regressions([{"size": 100, "stage": "classify", "per_second": 70.0}],
+                                     baseline, 0.2)) == 1
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from google.api_core import exceptions
+from google.cloud import datastore
+
+import classifier
+import fakes
+
+
+def test_target_matches():
+    assert classifier.BIRD.matches({"Sand", "beak"})
+    assert not classifier.BIRD.matches({"Sand", "Bird"})
+    assert classifier.decide([classifier.BIRD, classifier.BAT], {"bat"}) == {"is_bird": False,
+                                                                          "is_bat": True}
+
+
+def test_one_annotation_pass_decides_every_target(tmp_path):
+    filepaths = list()
+    for i, content in enumerate(fakes.make_fixtures(6, size=(64, 48))):
+        path = tmp_path / f"Flickr-{i}.jpg"
+        path.write_bytes(content)
+        filepaths.append(str(path))
+    v_client = fakes.FakeImageAnnotatorClient()
+    targets = [classifier.BIRD, classifier.BAT]
+    results = classifier.label_images(v_client, filepaths, targets, batch_size=16)
+    # One whole-image batch, then at most one batch per crop round.
+    assert v_client.calls["batch_annotate_images"] <= 1 + classifier.MAX_CROPS
+
+    entity = datastore.Entity(key=datastore.Key("Photo", "Flickr-0", project="test"))
+    labels, objects = results[0]
+    classifier.apply(entity, labels, targets, objects)
+    assert set(entity) >= {"is_bird", "is_bat", "vision_labels", "vision_objects"}
+    assert entity["is_classified"]
+
+
+class _FailingCrops(fakes.FakeImageAnnotatorClient):
+    def batch_annotate_images(self, requests, **kwargs):
+        if all(len(r["features"]) == len(classifier.CROP_FEATURES) for r in requests):
+            raise exceptions.ServiceUnavailable("crops unavailable")
+        return super(_FailingCrops, self).batch_annotate_images(requests, **kwargs)
+
+
+def test_failed_crop_round_leaves_images_unclassified(tmp_path):
+    filepaths = list()
+    for i, content in enumerate(fakes.make_fixtures(4, size=(64, 48))):
+        path = tmp_path / f"Flickr-{i}.jpg"
+        path.write_bytes(content)
+        filepaths.append(str(path))
+    # No whole image is a bird, so every image needs crops.
+    v_client = _FailingCrops(bird_rate=0.0)
+    results = classifier.label_images(v_client, filepaths, [classifier.BIRD], batch_size=16)
+    assert results == [None] * 4
+
+
+def test_cropping_continues_until_every_target_matches(tmp_path):
+    """A whole-image match for one target shouldn't stop crops from deciding
+    another."""
+    filepaths = list()
+    for i, content in enumerate(fakes.make_fixtures(3, size=(64, 48))):
+        path = tmp_path / f"Flickr-{i}.jpg"
+        path.write_bytes(content)
+        filepaths.append(str(path))
+    # Whole images are birds; crops are rocks.
+    v_client = fakes.FakeImageAnnotatorClient(bird_rate=1.0, crop_bird_rate=0.0)
+    targets = [classifier.BIRD, classifier.Target("is_rock", ["Rock"])]
+    for labels, _ in classifier.label_images(v_client, filepaths, targets, batch_size=16):
+        assert classifier.decide(targets, labels) == {"is_bird": True, "is_rock": True}
+    labels, _ = classifier.label_image(v_client, filepaths[0], targets)
+    assert classifier.decide(targets, labels) == {"is_bird": True, "is_rock": True}
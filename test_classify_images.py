@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+from google.cloud import datastore
+from google.cloud import vision
+from PIL import Image
+
+import utils
+from fakes import FakeDatastoreClient
+from classifier import IMAGE_FEATURES, crop_boxes_from_response, schedule_crop_boxes
+from classify_images import is_bird, iter_pull, label_images_batched
+
+RED, BLUE, GREEN, GRAY = (200, 0, 0), (0, 0, 200), (0, 200, 0), (128, 128, 128)
+
+
+def box(left, upper, right, lower):
+    return {"normalized_vertices": [{"x": left, "y": upper},
+                                    {"x": right, "y": upper},
+                                    {"x": right, "y": lower},
+                                    {"x": left, "y": lower}]}
+
+
+class FakeImageAnnotatorClient(object):
+    """Stands in for google.cloud.vision.ImageAnnotatorClient. Decides what it
+    sees from the colors of the image it's sent: green is a bird, red and blue
+    halves are an animal of some sort on either side, and gray is sand."""
+
+    def __init__(self):
+        self.batches = list()
+
+    def batch_annotate_images(self, requests):
+        self.batches.append(len(requests))
+        return vision.types.BatchAnnotateImagesResponse(
+            responses=[self.annotate(r) for r in requests])
+
+    def annotate(self, request):
+        if isinstance(request, dict):
+            request = vision.types.AnnotateImageRequest(**request)
+        im = Image.open(io.BytesIO(request.image.content)).convert("RGB")
+        width, height = im.size
+        left = im.getpixel((width // 4, height // 2))
+        right = im.getpixel((3 * width // 4, height // 2))
+        if len(request.features) == 1:
+            # Label detection for a crop.
+            if self.near(left, BLUE):
+                return vision.types.AnnotateImageResponse(label_annotations=[{"description": "beak"}])
+            return vision.types.AnnotateImageResponse(label_annotations=[{"description": "Rock"}])
+        if self.near(left, GREEN):
+            return vision.types.AnnotateImageResponse(
+                label_annotations=[{"description": "Grass"}],
+                localized_object_annotations=[{"name": "Bird", "bounding_poly": box(0, 0, 1, 1)}])
+        if self.near(left, RED) and self.near(right, BLUE):
+            return vision.types.AnnotateImageResponse(
+                label_annotations=[{"description": "Sand"}],
+                localized_object_annotations=[{"name": "Animal", "bounding_poly": box(0, 0, 0.5, 1)},
+                                              {"name": "Animal", "bounding_poly": box(0.5, 0, 1, 1)}])
+        return vision.types.AnnotateImageResponse(label_annotations=[{"description": "Sand"}])
+
+    @staticmethod
+    def near(a, b):
+        return all(abs(x - y) < 40 for x, y in zip(a, b))
+
+
+def save_jpg(path, left, right):
+    im = Image.new("RGB", (64, 32), left)
+    im.paste(right, (32, 0, 64, 32))
+    im.save(path, "JPEG")
+    return str(path)
+
+
+def test_label_images_batched(tmp_path):
+    """`label_images_batched` should send whole images and crops in batches of
+    at most VISION_BATCH_SIZE and map each response back to its image."""
+    filepaths = list()
+    for i in range(10):
+        filepaths.append(save_jpg(tmp_path / f"bird-{i}.jpg", GREEN, GREEN))
+    for i in range(10):
+        filepaths.append(save_jpg(tmp_path / f"hidden-{i}.jpg", RED, BLUE))
+    filepaths.append(save_jpg(tmp_path / "sand.jpg", GRAY, GRAY))
+
+    v_client = FakeImageAnnotatorClient()
+    results = label_images_batched(v_client, filepaths)
+
+    assert [is_bird(labels) for labels, _ in results] == [True] * 20 + [False]
+    assert all("beak" in labels for labels, _ in results[10:20])
+    assert results[0][1] == [["bird", 0.0, 0.0, 0.0, 1.0, 1.0]]
+    assert results[20] == ({"Sand"}, [])
+    # 21 whole images take two calls; each crop round takes one.
+    assert max(v_client.batches) <= utils.VISION_BATCH_SIZE
+    assert v_client.batches[:2] == [16, 5]
+    assert len(v_client.batches) <= 4
+
+
+def test_iter_pull_resumes():
+    """`iter_pull` should page through every match, and after an interruption
+    start again from whatever wasn't saved."""
+    ds_client = FakeDatastoreClient()
+    for i in range(25):
+        entity = datastore.Entity(key=ds_client.key("Photo", f"Flickr-{i:02}"))
+        entity.update({"is_classified": i % 5 == 0})
+        ds_client.entities[entity.key] = entity
+
+    pulled = iter_pull(ds_client, "Photo", "is_classified", False, page_size=4)
+    first = [next(pulled) for _ in range(9)]
+    pulled.close()
+    # Only the first six were saved before the interruption.
+    for entity in first[:6]:
+        entity["is_classified"] = True
+        ds_client.put(entity)
+    resumed = [e.key.name for e in iter_pull(ds_client, "Photo", "is_classified", False,
+                                             page_size=4)]
+    assert [e.key.name for e in first[:6]] + resumed == [f"Flickr-{i:02}" for i in range(25) if i % 5]
+
+
+def test_downscaled_upload_keeps_original_crop_boxes(tmp_path):
+    """Shrinking an image before upload should shrink what Vision sees, but
+    crop boxes should still land on the original image."""
+    filepath = save_jpg(tmp_path / "hidden.jpg", RED, BLUE)
+    v_client = FakeImageAnnotatorClient()
+    with utils.ImageHandle(filepath) as handle:
+        image = handle.vision_image(max_edge=16)
+        assert Image.open(io.BytesIO(image.content)).size == (16, 8)
+        response = v_client.annotate({"image": image, "features": IMAGE_FEATURES})
+        assert crop_boxes_from_response(response, handle.size) == {(0, 0, 32, 32), (32, 0, 64, 32)}
+
+    results = label_images_batched(v_client, [filepath], max_edge=16)
+    assert is_bird(results[0][0])
+
+
+def test_schedule_crop_boxes():
+    """`schedule_crop_boxes` should drop tiny and duplicate objects, try likely
+    animals first, then by score, and stop at max_crops."""
+    objects = [{"name": "Rock", "score": 0.99, "bounding_poly": box(0, 0, 0.5, 0.5)},
+               {"name": "Animal", "score": 0.6, "bounding_poly": box(0.5, 0.5, 1, 1)},
+               {"name": "Bird", "score": 0.7, "bounding_poly": box(0.5, 0, 1, 0.5)},
+               {"name": "Bird", "score": 0.65, "bounding_poly": box(0.51, 0, 1, 0.5)},
+               {"name": "Bird", "score": 0.9, "bounding_poly": box(0, 0.9, 0.05, 0.95)}]
+    response = vision.types.AnnotateImageResponse(localized_object_annotations=objects)
+    assert schedule_crop_boxes(response, (100, 100)) == [(50, 0, 100, 50),
+                                                        (50, 50, 100, 100),
+                                                        (0, 0, 50, 50)]
+    assert schedule_crop_boxes(response, (100, 100), max_crops=1) == [(50, 0, 100, 50)]
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import io
+import random
+
+from google.cloud import datastore
+from PIL import Image
+
+import classify_images
+import dedupe
+import fakes
+import metrics
+import tweet
+import utils
+
+
+def _write_fixtures(tmp_path, n=4):
+    paths = list()
+    for i, content in enumerate(fakes.make_fixtures(n, size=(128, 96))):
+        path = tmp_path / f"Flickr-{i}.jpg"
+        path.write_bytes(content)
+        paths.append(str(path))
+    return paths
+
+
+def _reencode(src, dst, size=(80, 60), quality=60):
+    with Image.open(src) as im:
+        with io.BytesIO() as buffer:
+            im.resize(size).save(buffer, format="JPEG", quality=quality)
+            dst.write_bytes(buffer.getvalue())
+    return str(dst)
+
+
+def test_dhash_survives_resizing_but_not_a_different_photo(tmp_path):
+    paths = _write_fixtures(tmp_path)
+    copy = _reencode(paths[0], tmp_path / "copy.jpg")
+    assert dedupe.hamming(dedupe.dhash(paths[0]), dedupe.dhash(copy)) <= dedupe.DUPLICATE_DISTANCE
+    assert dedupe.hamming(dedupe.dhash(paths[0]), dedupe.dhash(paths[1])) > dedupe.DUPLICATE_DISTANCE
+
+
+def test_bktree_search_matches_brute_force():
+    rand = random.Random(0)
+    hashes = [rand.getrandbits(64) for _ in range(500)]
+    tree = dedupe.BKTree()
+    for i, h in enumerate(hashes):
+        tree.add(h, i)
+    for query in hashes[:20] + [rand.getrandbits(64) for _ in range(20)]:
+        expected = sorted((dedupe.hamming(query, h), i) for i, h in enumerate(hashes)
+                          if dedupe.hamming(query, h) <= 20)
+        assert sorted(tree.search(query, 20)) == expected
+
+
+def test_duplicates_inherit_labels_and_persist(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    paths = _write_fixtures(tmp_path, n=3)
+    paths.append(_reencode(paths[0], tmp_path / "Flickr-copy.jpg"))
+    index = dedupe.DuplicateIndex(str(tmp_path / "duplicates.sqlite3"))
+    entities = [datastore.Entity(key=datastore.Key("Photo", f"Flickr-{i}", project="test"))
+                for i in range(len(paths))]
+    m = metrics.Metrics()
+    v_client = metrics.InstrumentedAnnotatorClient(fakes.FakeImageAnnotatorClient(), metrics=m)
+    classified = classify_images.label_downloaded_batched(v_client, list(zip(entities, paths)),
+                                                          batch_size=16, duplicates=index)
+    assert len(classified) == 4
+    # Whole images; crops are only requested for some.
+    assert m.summary()["counters"]["vision.feature.OBJECT_LOCALIZATION"] == 3
+    assert entities[3]["duplicate_of"] == "Flickr-0"
+    assert entities[3]["vision_labels"] == entities[0]["vision_labels"]
+    assert index.stats() == {"photos": 4, "clusters": 3, "duplicates": 1}
+    index.close()
+
+    reopened = dedupe.DuplicateIndex(str(tmp_path / "duplicates.sqlite3"))
+    assert reopened.assign("Flickr-3", paths[3]) == "Flickr-0"
+    assert reopened.labels_of("Flickr-0")[0] == utils.parse_labels(entities[0]["vision_labels"])
+
+
+def test_changed_image_is_hashed_again(tmp_path, monkeypatch):
+    """A photo whose image was downloaded again should be re-assigned, not
+    keep the cluster its old image was in."""
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    paths = _write_fixtures(tmp_path, n=2)
+    copy = _reencode(paths[0], tmp_path / "Flickr-copy.jpg")
+    index = dedupe.DuplicateIndex(str(tmp_path / "duplicates.sqlite3"))
+    assert index.assign("Flickr-0", paths[0]) == "Flickr-0"
+    assert index.assign("Flickr-copy", copy) == "Flickr-0"
+
+    # Same download record: the cached cluster stands, whatever's on disk.
+    (tmp_path / "Flickr-copy.jpg").write_bytes((tmp_path / "Flickr-1.jpg").read_bytes())
+    assert index.assign("Flickr-copy", copy) == "Flickr-0"
+    utils._save_download_record("Flickr-copy", "http://example.com/copy.jpg", '"v2"', None, 1)
+    assert index.assign("Flickr-copy", copy) == "Flickr-copy"
+    index.close()
+
+
+def test_siblings_of_recently_tweeted_photos_are_skipped():
+    ds_client = fakes.FakeDatastoreClient()
+    now = datetime.datetime.utcnow()
+    never = datetime.datetime(2018, 1, 1)
+    for name, extra in (("Flickr-0", {"last_tweeted": now}),
+                        ("Flickr-1", {"duplicate_of": "Flickr-0", "last_tweeted": never}),
+                        ("Flickr-2", {"last_tweeted": never})):
+        entity = datastore.Entity(key=ds_client.key("Photo", name))
+        entity.update(dict({"is_bird": True, "random_shard": 0}, **extra))
+        ds_client.put(entity)
+    cutoff = now - datetime.timedelta(days=30)
+    sibling = ds_client.get(ds_client.key("Photo", "Flickr-1"))
+    assert tweet.has_recently_tweeted_sibling(ds_client, sibling, cutoff)
+    for _ in range(10):
+        assert tweet.pick_random_bird_entity(ds_client, cutoff).key.name == "Flickr-2"
+
+
+def test_staging_skips_siblings_of_recently_tweeted_photos(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "_session", fakes.make_cdn_session(fakes.make_fixtures(2)))
+    ds_client = fakes.FakeDatastoreClient()
+    now = datetime.datetime.utcnow()
+    for name, extra in (("Flickr-0", {"last_tweeted": now}),
+                        ("Flickr-1", {"duplicate_of": "Flickr-0"}),
+                        ("Flickr-2", {})):
+        entity = datastore.Entity(key=ds_client.key("Photo", name))
+        entity.update(dict({"is_bird": True, "id": name[-1], "title": "Chick",
+                            "ownername": "Birder",
+                            "download_url": f"{fakes.FAKE_CDN}{name}.jpg"}, **extra))
+        ds_client.put(entity)
+    cutoff = now - datetime.timedelta(days=30)
+    entities = [ds_client.get(ds_client.key("Photo", n)) for n in ("Flickr-1", "Flickr-2")]
+    queue = tweet.stage_entities(entities, str(tmp_path / "queue.json"), ds_client=ds_client,
+                                 tweeted_before=cutoff)
+    assert [staged["name"] for staged in queue] == ["Flickr-2"]
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from google.api_core import exceptions
+
+import fakes
+import flickr_to_datastore
+
+TERMS = ["plover chick", "plover baby"]
+
+
+def test_interrupted_ingest_keeps_what_it_wrote():
+    """Pages written before a search fails should stay written, and the
+    high-water marks shouldn't move until every search has finished."""
+    ds_client = fakes.FakeDatastoreClient()
+    flickr = fakes.FakeFlickrAPI(1500, TERMS)
+    search = flickr.photos.search
+
+    def failing_search(page=1, **params):
+        if page == 3:
+            raise exceptions.ServiceUnavailable("Injected failure.")
+        return search(page=page, **params)
+
+    flickr.photos.search = failing_search
+    with pytest.raises(exceptions.ServiceUnavailable):
+        flickr_to_datastore.ingest_incrementally(ds_client, TERMS, flickr=flickr,
+                                                 calls_per_second=1000)
+    written = ds_client.query(kind="Photo").fetch()
+    assert 0 < len(list(written)) < 1500
+    assert flickr_to_datastore.get_high_water_marks(ds_client, TERMS) == {}
+
+    flickr.photos.search = search
+    chunks = list()
+    written = flickr_to_datastore.ingest_incrementally(ds_client, TERMS, flickr=flickr,
+                                                       calls_per_second=1000,
+                                                       on_written=chunks.append)
+    photos = list(ds_client.query(kind="Photo").fetch())
+    assert len(photos) == 1500
+    assert written < 1500
+    assert sum(len(chunk) for chunk in chunks) == written
+    # Photo 0 is found by both terms.
+    photo = ds_client.get(ds_client.key("Photo", "Flickr-" + flickr.photo_id(0)))
+    assert sorted(photo["search_terms"]) == sorted(TERMS)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from google.cloud import datastore
+from google.cloud import vision
+
+import metrics
+from fakes import FakeDatastoreClient, FakeImageAnnotatorClient
+
+
+def test_histogram_percentiles():
+    h = metrics.Histogram()
+    for ms in [1] * 90 + [40] * 9 + [3000]:
+        h.observe(ms)
+    assert h.percentile(50) == 1
+    assert h.percentile(99) == 50
+    assert h.percentile(100) == 3000
+    assert h.summary()["count"] == 100
+
+
+def test_timer_counts_calls_and_errors():
+    m = metrics.Metrics()
+    with m.timer("thing"):
+        pass
+    with pytest.raises(ValueError):
+        with m.timer("thing"):
+            raise ValueError()
+    s = m.summary("test")
+    assert s["counters"] == {"thing.calls": 2, "thing.errors": 1}
+    assert s["latency"]["thing"]["count"] == 2
+
+
+def test_instrumented_datastore_client_times_query_pages():
+    m = metrics.Metrics()
+    fake = FakeDatastoreClient()
+    ds_client = metrics.InstrumentedClient(fake, "datastore", m)
+    entities = [datastore.Entity(key=ds_client.key("Photo", f"Flickr-{i}")) for i in range(5)]
+    ds_client.put_multi(entities)
+    query = ds_client.query(kind="Photo")
+    query.keys_only()
+    assert len(list(query.fetch())) == 5
+    assert m.counters["datastore.put_multi.calls"] == 1
+    assert m.counters["datastore.query.calls"] == 1
+    # Local helpers aren't RPCs.
+    assert "datastore.key.calls" not in m.counters
+
+
+def test_instrumented_annotator_client_counts_features():
+    m = metrics.Metrics()
+    v_client = metrics.InstrumentedAnnotatorClient(FakeImageAnnotatorClient(), metrics=m)
+    request = {"image": {"content": b"jpg"},
+               "features": [{"type": vision.enums.Feature.Type.LABEL_DETECTION},
+                            {"type": vision.enums.Feature.Type.OBJECT_LOCALIZATION}]}
+    v_client.batch_annotate_images([request, request])
+    assert m.counters["vision.images"] == 2
+    assert m.counters["vision.feature.LABEL_DETECTION"] == 2
+    assert m.counters["vision.batch_annotate_images.calls"] == 1
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+
+import pytest
+
+import classify_images
+import fakes
+import pipeline
+import utils
+
+
+def test_run_once_flows_from_search_to_tweet(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "_session", fakes.make_cdn_session(fakes.make_fixtures(4)))
+    ds_client = fakes.FakeDatastoreClient()
+    flickr = fakes.FakeFlickrAPI(40, pipeline.SEARCH_TERMS)
+    twitter = fakes.FakeTwython()
+    p = pipeline.Pipeline(ds_client, fakes.FakeImageAnnotatorClient(), flickr=flickr,
+                          twitter=twitter, min_upload_date="2018-01-01", calls_per_second=1000,
+                          queue_size=4,
+                          batch_size=8, queue_path=str(tmp_path / "queue.json"))
+    loop = asyncio.new_event_loop()
+    try:
+        counts = loop.run_until_complete(p.run(once=True))
+    finally:
+        loop.close()
+    assert counts["ingested"] == 40
+    assert counts["classified"] == 40
+    assert counts["birds"] > 0
+    assert counts["tweeted"] == 1
+    assert len(twitter.statuses) == 1
+    assert all(e.get("is_classified") for e in ds_client.entities.values() if e.key.kind == "Photo")
+
+
+class _FailsOnce(fakes.FakeImageAnnotatorClient):
+    def batch_annotate_images(self, requests, **kwargs):
+        if not self.calls["batch_annotate_images"]:
+            self.calls["batch_annotate_images"] += 1
+            raise fakes.FakeService.error("Injected failure.")
+        return super(_FailsOnce, self).batch_annotate_images(requests, **kwargs)
+
+
+def test_run_forever_retries_failed_classifications(tmp_path, monkeypatch):
+    """Entities whose classification failed should be picked up again by the
+    next backlog pull."""
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "_session", fakes.make_cdn_session(fakes.make_fixtures(4)))
+    ds_client = fakes.FakeDatastoreClient()
+    flickr = fakes.FakeFlickrAPI(8, pipeline.SEARCH_TERMS)
+    p = pipeline.Pipeline(ds_client, _FailsOnce(), flickr=flickr, twitter=fakes.FakeTwython(),
+                          min_upload_date="2018-01-01", calls_per_second=1000,
+                          ingest_every=0.2, batch_size=16, classify_workers=1,
+                          queue_path=str(tmp_path / "queue.json"))
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(asyncio.wait_for(p.run(), 1.5))
+    finally:
+        loop.close()
+    photos = [e for e in ds_client.entities.values() if e.key.kind == "Photo"]
+    assert len(photos) == 8
+    assert all(e.get("is_classified") for e in photos)
+
+
+def test_backlog_pulls_skip_entities_in_flight(tmp_path, monkeypatch):
+    """A backlog pull while earlier entities are still queued shouldn't queue
+    them, and so classify them, again."""
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "_session", fakes.make_cdn_session(fakes.make_fixtures(4)))
+    classified = collections.Counter()
+    classify = classify_images.classify_entities_batched
+
+    def counting(v_client, entities, **kwargs):
+        classified.update(e.key.name for e in entities)
+        return classify(v_client, entities, **kwargs)
+
+    monkeypatch.setattr(classify_images, "classify_entities_batched", counting)
+    ds_client = fakes.FakeDatastoreClient()
+    flickr = fakes.FakeFlickrAPI(12, pipeline.SEARCH_TERMS)
+    p = pipeline.Pipeline(ds_client, fakes.FakeImageAnnotatorClient(latency=0.03), flickr=flickr,
+                          twitter=fakes.FakeTwython(), min_upload_date="2018-01-01",
+                          calls_per_second=1000, ingest_every=0.05, batch_size=2,
+                          classify_workers=1, queue_path=str(tmp_path / "queue.json"))
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(asyncio.wait_for(p.run(), 1.5))
+    finally:
+        loop.close()
+    assert len(classified) > 4
+    assert max(classified.values()) == 1
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+
+from google.cloud import datastore
+from PIL import Image, ImageDraw
+
+import classifier
+import classify_images
+import fakes
+import metrics
+import prefilter
+import utils
+
+
+def _photo(path, rand, bird):
+    """Sandy or leafy photo with a brown blob, or a gray-blue seascape."""
+    if bird:
+        background = rand.choice([(194, 178, 128), (90, 130, 60)])
+        fill = (120 + rand.randrange(40), 80 + rand.randrange(30), 40)
+    else:
+        background = (100, 120 + rand.randrange(40), 170 + rand.randrange(60))
+        fill = (150, 150, 160)
+    im = Image.new("RGB", (96, 72), background)
+    x, y = rand.randrange(60), rand.randrange(40)
+    ImageDraw.Draw(im).ellipse((x, y, x + 30, y + 24), fill=fill)
+    im.save(path, format="JPEG")
+    return str(path)
+
+
+def _sorted_assets(ds_client, assets_dir, n=30, seed=0):
+    rand = random.Random(seed)
+    (assets_dir / "negative").mkdir(parents=True)
+    for i in range(n):
+        _photo(assets_dir / f"Flickr-bird-{i}.jpg", rand, bird=True)
+        entity = datastore.Entity(key=ds_client.key("Photo", f"Flickr-bird-{i}"))
+        entity.update({"is_classified": True, "is_bird": True})
+        ds_client.put(entity)
+        _photo(assets_dir / "negative" / f"Flickr-other-{i}.jpg", rand, bird=False)
+    _photo(assets_dir / "Flickr-bird-0_tweet.jpg", rand, bird=False)
+    # Downloaded, but not classified yet.
+    _photo(assets_dir / "Flickr-new-0.jpg", rand, bird=False)
+
+
+def test_train_sets_threshold_from_held_out_recall(tmp_path):
+    ds_client = fakes.FakeDatastoreClient()
+    _sorted_assets(ds_client, tmp_path)
+    birds, non_birds = prefilter.training_files(ds_client, str(tmp_path))
+    assert len(birds) == len(non_birds) == 30
+    assert not any("Flickr-new" in fp for fp in birds)
+    model, rows = prefilter.train_from_assets(ds_client, str(tmp_path), min_recall=0.95)
+    chosen = [r for r in rows if r["threshold"] == model.threshold][0]
+    assert chosen["recall"] >= 0.95
+    assert chosen["skipped"] > 0
+
+    model.save(str(tmp_path / "prefilter.npz"))
+    loaded = prefilter.PreFilter.load(str(tmp_path / "prefilter.npz"))
+    assert loaded.threshold == model.threshold
+    assert list(loaded.scores(birds[:3])) == list(model.scores(birds[:3]))
+    assert prefilter.PreFilter.load(str(tmp_path / "missing.npz")) is None
+
+
+def test_rejected_images_skip_vision(tmp_path, monkeypatch):
+    ds_client = fakes.FakeDatastoreClient()
+    _sorted_assets(ds_client, tmp_path / "train")
+    model, _ = prefilter.train_from_assets(ds_client, str(tmp_path / "train"))
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path / "assets"))
+    os.makedirs(utils.ASSETS_DIR)
+    rand = random.Random(1)
+    downloaded = list()
+    for i in range(8):
+        name = f"Flickr-{i}"
+        entity = datastore.Entity(key=datastore.Key("Photo", name, project="test"))
+        path = _photo(os.path.join(utils.ASSETS_DIR, f"{name}.jpg"), rand, bird=i % 2 == 0)
+        downloaded.append((entity, path))
+    m = metrics.Metrics()
+    v_client = metrics.InstrumentedAnnotatorClient(fakes.FakeImageAnnotatorClient(), metrics=m)
+    classified = classify_images.label_downloaded_batched(v_client, downloaded, batch_size=16,
+                                                          local_filter=model)
+    assert len(classified) == 8
+    skipped = [e for e, _ in downloaded if e.get("prefiltered")]
+    assert skipped and all(e["is_bird"] is False and e["is_classified"] for e in skipped)
+    sent = m.summary()["counters"]["vision.feature.OBJECT_LOCALIZATION"]
+    assert sent == 8 - len(skipped)
+    assert os.path.exists(os.path.join(utils.ASSETS_DIR, "negative", "prefiltered",
+                                       f"{skipped[0].key.name}.jpg"))
+
+
+def test_prefilter_is_skipped_for_other_targets(tmp_path, monkeypatch):
+    """A filter trained on birds shouldn't decide anything else."""
+    class RejectAll(object):
+        def keep(self, filepaths):
+            return [False] * len(filepaths)
+
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path / "assets"))
+    os.makedirs(utils.ASSETS_DIR)
+    rand = random.Random(2)
+    downloaded = list()
+    for i in range(4):
+        name = f"Flickr-{i}"
+        entity = datastore.Entity(key=datastore.Key("Photo", name, project="test"))
+        downloaded.append((entity, _photo(os.path.join(utils.ASSETS_DIR, f"{name}.jpg"), rand,
+                                          bird=True)))
+    classified = classify_images.label_downloaded_batched(
+        fakes.FakeImageAnnotatorClient(), downloaded, batch_size=16,
+        targets=[classifier.BIRD, classifier.BAT], local_filter=RejectAll())
+    assert len(classified) == 4
+    assert not any(e.get("prefiltered") for e, _ in downloaded)
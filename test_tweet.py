@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import functools
+import os
+import random
+
+import pytest
+from google.cloud import datastore
+from twython import TwythonError
+
+import fakes
+import tweet
+import utils
+from fakes import FakeDatastoreClient
+
+LONG_AGO = datetime.datetime(2018, 1, 1)
+CUTOFF = datetime.datetime(2019, 1, 1)
+
+
+def put_photo(ds_client, name, shard=None, is_bird=True, last_tweeted=LONG_AGO):
+    entity = datastore.Entity(key=ds_client.key("Photo", name))
+    entity.update({"is_bird": is_bird, "last_tweeted": last_tweeted})
+    if shard is not None:
+        entity["random_shard"] = shard
+    ds_client.put(entity)
+
+
+def test_pick_random_bird_entity_skips_empty_shards_and_cooldown():
+    ds_client = FakeDatastoreClient()
+    put_photo(ds_client, "recent", shard=1, last_tweeted=datetime.datetime(2019, 6, 1))
+    put_photo(ds_client, "not-bird", shard=2, is_bird=False)
+    put_photo(ds_client, "eligible", shard=5)
+    for _ in range(10):
+        entity = tweet.pick_random_bird_entity(ds_client, tweeted_before=CUTOFF, shards=8)
+        assert entity.key.name == "eligible"
+
+
+def test_pick_random_bird_entity_falls_back_without_shards():
+    ds_client = FakeDatastoreClient()
+    put_photo(ds_client, "unsharded")
+    entity = tweet.pick_random_bird_entity(ds_client, tweeted_before=CUTOFF, shards=4)
+    assert entity.key.name == "unsharded"
+    assert tweet.backfill_random_shards(ds_client, shards=4) == 1
+    assert 0 <= ds_client.get(entity.key)["random_shard"] < 4
+
+
+def test_pick_random_bird_entity_none_eligible():
+    ds_client = FakeDatastoreClient()
+    put_photo(ds_client, "recent", shard=0, last_tweeted=datetime.datetime(2019, 6, 1))
+    assert tweet.pick_random_bird_entity(ds_client, tweeted_before=CUTOFF, shards=2) is None
+
+
+def test_fit_for_twitter(tmp_path):
+    path = str(tmp_path / "Flickr-1.jpg")
+    with open(path, "wb") as f:
+        f.write(fakes.make_fixtures(1, size=(640, 480))[0])
+    assert tweet.fit_for_twitter(path, max_bytes=10 ** 7) == path
+    fitted = tweet.fit_for_twitter(path, max_bytes=2000)
+    assert fitted.endswith("Flickr-1_tweet.jpg")
+    assert os.path.getsize(fitted) <= 2000
+
+
+def test_stage_then_tweet_from_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "_session", fakes.make_cdn_session(fakes.make_fixtures(2)))
+    ds_client = FakeDatastoreClient()
+    for i in range(3):
+        put_photo(ds_client, f"Flickr-{i}", shard=i)
+        entity = ds_client.get(ds_client.key("Photo", f"Flickr-{i}"))
+        entity.update({"id": str(i), "title": "Chick", "ownername": "Birder",
+                       "download_url": f"{fakes.FAKE_CDN}{i}.jpg"})
+        ds_client.put(entity)
+    path = str(tmp_path / "queue.json")
+    random.seed(0)
+
+    queue = tweet.stage_tweets(ds_client, n=2, tweeted_before=CUTOFF, path=path)
+    assert len(queue) == 2
+    assert all(os.path.exists(staged["filepath"]) for staged in queue)
+
+    twitter = fakes.FakeTwython()
+    entity = tweet.tweet_next(ds_client, twitter=twitter, path=path)
+    assert entity.key.name == queue[0]["name"]
+    assert ds_client.get(entity.key)["last_tweeted"] > CUTOFF
+    assert twitter.statuses[0][0] == queue[0]["message"]
+    assert [s["name"] for s in tweet.load_queue(path)] == [queue[1]["name"]]
+
+
+def test_tweet_next_skips_stale_entries(tmp_path):
+    """Entries whose entity was deleted, stopped being a bird, or was tweeted
+    since staging shouldn't go out."""
+    ds_client = FakeDatastoreClient()
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"jpg")
+    queue = list()
+    put_photo(ds_client, "Flickr-1", is_bird=False)
+    put_photo(ds_client, "Flickr-2", last_tweeted=CUTOFF + datetime.timedelta(days=1))
+    put_photo(ds_client, "Flickr-3")
+    for i in range(4):
+        name = f"Flickr-{i}"
+        queue.append({"name": name, "message": name, "filepath": str(image)})
+    path = str(tmp_path / "queue.json")
+    tweet.save_queue(queue, path)
+
+    twitter = fakes.FakeTwython()
+    entity = tweet.tweet_next(ds_client, twitter=twitter, path=path, tweeted_before=CUTOFF)
+    assert entity.key.name == "Flickr-3"
+    assert [s[0] for s in twitter.statuses] == ["Flickr-3"]
+    assert tweet.load_queue(path) == []
+
+
+def test_upload_media_chunked_with_retries(tmp_path):
+    path = tmp_path / "big.jpg"
+    content = os.urandom(10 * 1024 + 7)
+    path.write_bytes(content)
+    twitter = fakes.FakeTwython(error_rate=0.3, seed=1)
+    response = tweet.upload_media(str(path), twitter, chunk_size=1024, retries=10, backoff=0)
+    assert twitter.media[response["media_id"]] == content
+    assert twitter.calls["upload_media APPEND"] >= 11
+    assert twitter.calls["upload_media"] == 0
+
+
+def test_upload_media_gives_up_on_client_errors(tmp_path):
+    """Only connection errors, 429s and 5xxs are worth retrying."""
+    path = tmp_path / "small.jpg"
+    path.write_bytes(b"jpg")
+    twitter = fakes.FakeTwython(error_rate=1.0)
+    twitter.error = functools.partial(TwythonError, error_code=400)
+    with pytest.raises(TwythonError):
+        tweet.upload_media(str(path), twitter, chunk_size=1024, retries=3, backoff=0)
+    assert twitter.calls["upload_media"] == 1
+
+
+def test_upload_media_small_file_in_one_request(tmp_path):
+    path = tmp_path / "small.jpg"
+    path.write_bytes(b"jpg")
+    twitter = fakes.FakeTwython()
+    response = tweet.upload_media(str(path), twitter, chunk_size=1024)
+    assert twitter.media[response["media_id"]] == b"jpg"
+    assert set(twitter.calls) == {"upload_media"}
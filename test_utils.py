@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import http.server
+import io
+import os
+import threading
+import time
+
 import pytest
+from PIL import Image
 
-from utils import is_safe
+import asset_store
+import metrics
+import utils
+from utils import WriteBuffer, compact_labels, ichunk, is_safe, parse_labels, run_stages
 
 def test_is_safe():
     """`is_safe` should return False if any categories are LIKELY or VERY_LIKELY;
@@ -19,3 +29,265 @@ def test_is_safe():
                     'spoofed': 'POSSIBLE',
                     'violence': 'UNLIKELY',
                     'racy': 'VERY_UNLIKELY'}) == True
+
+
+def test_run_stages():
+    """`run_stages` should pass every item through every stage to the sink,
+    dropping items whose stage returns None or raises, and count them."""
+    def halve(n):
+        if n % 2:
+            return None
+        return n // 2
+
+    def invert(n):
+        return 10 // n
+
+    results = list()
+    count = run_stages(range(12), [(halve, 3), (invert, 2)], queue_size=2,
+                       sink=results.append)
+    assert count == 5
+    assert sorted(results) == [2, 2, 3, 5, 10]
+
+
+def test_compact_labels():
+    """`compact_labels` should stay valid JSON under the byte limit, and
+    `parse_labels` should read it back, as well as salvage labels from
+    `trim`med JSON."""
+    labels = {"Bird", "Beak", "Sand", "Charadriiformes"}
+    assert parse_labels(compact_labels(labels)) == labels
+    assert len(compact_labels([str(i) * 10 for i in range(500)]).encode()) <= 1500
+    assert parse_labels('["Bird", "Sand", "Charadr') == {"Bird", "Sand"}
+    assert parse_labels(None) == set()
+
+
+@pytest.fixture
+def image_server():
+    """Serves /ok/<name>.jpg as a few bytes, /flaky/... as a 503 the first time
+    it's asked for, and everything else as a 404."""
+    requested = list()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            if self.path.startswith("/ok/") or (self.path.startswith("/flaky/") and requested.count(self.path) > 1):
+                body = self.path.encode() * 100
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif self.path.startswith("/flaky/"):
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_error(404)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", requested
+    server.shutdown()
+
+
+def test_download_images(image_server, tmp_path, monkeypatch):
+    """`download_images` should save what downloads, retry 503s, leave out
+    failures, and leave no temporary files behind."""
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    base, requested = image_server
+    pairs = [(f"{base}/ok/{i}.jpg", f"ok-{i}") for i in range(6)]
+    pairs.append((f"{base}/flaky/a.jpg", "flaky"))
+    pairs.append((f"{base}/missing/b.jpg", "missing"))
+    filepaths = utils.download_images(pairs, max_workers=4, per_host=2, backoff=0)
+    assert sorted(filepaths) == ["flaky"] + [f"ok-{i}" for i in range(6)]
+    with open(filepaths["ok-3"], "rb") as f:
+        assert f.read() == b"/ok/3.jpg" * 100
+    images = sorted(f for f in os.listdir(tmp_path) if f.endswith(".jpg"))
+    assert images == sorted(f"{name}.jpg" for name in filepaths)
+    assert sorted(set(os.listdir(tmp_path)) - set(images)) == ["downloads.sqlite3", "partial"]
+    assert os.listdir(tmp_path / "partial") == []
+    # Already-downloaded images aren't requested again.
+    before = len(requested)
+    utils.download_images(pairs[:6])
+    assert len(requested) == before
+
+
+@pytest.fixture
+def range_server():
+    """Serves /cut/<name>.jpg with an ETag and Range support, cutting the
+    connection halfway through the first full response; answers 304 when
+    If-None-Match matches."""
+    requests_seen = list()
+    body = bytes(range(256)) * 2048
+    etag = '"v1"'
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            requests_seen.append(dict(self.headers))
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start = 0
+            if self.headers.get("Range") and self.headers.get("If-Range") == etag:
+                start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            part = body[start:]
+            self.send_response(206 if start else 200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(part)))
+            if start:
+                self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            self.end_headers()
+            if len(requests_seen) == 1:
+                self.wfile.write(part[:len(part) // 2])
+                self.close_connection = True
+                return
+            self.wfile.write(part)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", requests_seen, body
+    server.shutdown()
+
+
+def test_download_resumes_and_revalidates(range_server, tmp_path, monkeypatch):
+    """A download cut short should resume with a Range request, and a stored
+    image should be revalidated with If-None-Match, and downloaded again if
+    it's the wrong size."""
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    base, seen, body = range_server
+    session = utils.make_session(retries=0)
+    downloaded = metrics.METRICS.counters["download.bytes"]
+    filepath = utils.download_image(f"{base}/cut/a.jpg", "a", session=session)
+    with open(filepath, "rb") as f:
+        assert f.read() == body
+    # Both attempts' bytes count, and neither was compressed in transit.
+    assert metrics.METRICS.counters["download.bytes"] - downloaded == len(body)
+    assert all(s["Accept-Encoding"] == "identity" for s in seen)
+    # Whole blocks received before the cut aren't asked for again.
+    assert 0 < int(seen[1]["Range"][len("bytes="):-1]) <= len(body) // 2
+    assert utils.download_record("a")["length"] == len(body)
+
+    assert utils.download_image(f"{base}/cut/a.jpg", "a", session=session, revalidate=True) == filepath
+    assert seen[2]["If-None-Match"] == '"v1"' and len(seen) == 3
+
+    with open(filepath, "wb") as f:
+        f.write(body[:10])
+    utils.download_image(f"{base}/cut/a.jpg", "a", session=session)
+    with open(filepath, "rb") as f:
+        assert f.read() == body
+
+
+def test_stale_partials_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "ASSETS_DIR", str(tmp_path))
+    (tmp_path / "partial").mkdir()
+    for name in ("old", "fresh"):
+        (tmp_path / "partial" / f"{name}.jpg.part").write_bytes(b"jpg")
+    long_ago = time.time() - utils.PARTIAL_MAX_AGE - 60
+    os.utime(tmp_path / "partial" / "old.jpg.part", (long_ago, long_ago))
+    assert utils.download_images([]) == {}
+    assert os.listdir(tmp_path / "partial") == ["fresh.jpg.part"]
+
+
+def test_ichunk():
+    """`ichunk` should chunk any iterable, including generators."""
+    assert list(ichunk((i for i in range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(ichunk([], 3)) == []
+
+
+def test_write_buffer():
+    """`WriteBuffer` should write in chunks of at most 500 and flush what's
+    left on the way out of a `with` block, even when leaving with an error."""
+    class Client(object):
+        def __init__(self):
+            self.writes = list()
+
+        def put_multi(self, entities):
+            self.writes.append(list(entities))
+
+    ds_client = Client()
+    with WriteBuffer(ds_client, max_size=500) as writer:
+        for i in range(1100):
+            writer.put(i)
+        writer.put_multi(range(1100, 1300))
+    assert [len(w) for w in ds_client.writes] == [500, 500, 300]
+    assert sum(ds_client.writes, []) == list(range(1300))
+
+    ds_client = Client()
+    with pytest.raises(ValueError):
+        with WriteBuffer(ds_client) as writer:
+            writer.put(1)
+            raise ValueError
+    assert ds_client.writes == [[1]]
+
+
+def test_write_buffer_counts_only_saved_entities():
+    """A failed flush shouldn't count its entities as written, and should
+    keep them, in order, for the next flush."""
+    class FlakyClient(object):
+        def __init__(self):
+            self.writes = list()
+            self.fail = True
+
+        def put_multi(self, entities):
+            if self.fail:
+                self.fail = False
+                raise RuntimeError
+            self.writes.append(list(entities))
+
+    ds_client = FlakyClient()
+    saved = list()
+    writer = WriteBuffer(ds_client, on_written=saved.extend)
+    writer.put_multi([1, 2])
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert writer.written == 0
+    writer.put(3)
+    writer.close()
+    assert ds_client.writes == [[1, 2, 3]]
+    assert writer.written == 3
+    assert saved == [1, 2, 3]
+
+
+def test_image_handle(tmp_path, monkeypatch):
+    """`ImageHandle` should read the size from the header, cut crops from one
+    decoded copy, and be closed by `crop_to_box` only if it made it."""
+    filepath = str(tmp_path / "handle.jpg")
+    Image.new("RGB", (40, 30), (200, 10, 10)).save(filepath)
+    previous = asset_store.set_store(asset_store.DirectoryStore())
+    try:
+        handle = utils.ImageHandle(filepath)
+        assert handle.size == (40, 30)
+        # Still undecoded: the tile list empties once pixels are loaded.
+        assert handle.image.tile
+        assert handle.crop((0, 0, 10, 5)).size == (10, 5)
+        with Image.open(io.BytesIO(handle.crop_bytes((0, 0, 10, 5), max_size=4))) as crop:
+            assert crop.format == "JPEG"
+            assert max(crop.size) == 4
+        handle.close()
+        assert handle._image is None and handle._content is None
+
+        monkeypatch.setattr(utils, "__file__", str(tmp_path / "utils.py"))
+        closed = list()
+        close = utils.ImageHandle.close
+        monkeypatch.setattr(utils.ImageHandle, "close",
+                            lambda self: closed.append(self) or close(self))
+        with utils.ImageHandle(filepath) as handle:
+            utils.crop_to_box((0, 0, 10, 5), handle)
+            assert not closed
+        utils.crop_to_box((0, 0, 10, 5), filepath)
+        # The with block's handle, and the one crop_to_box opened.
+        assert len(closed) == 2
+        assert os.path.exists(tmp_path / "assets" / "cropped" / "handle_cropped.jpg")
+    finally:
+        asset_store.set_store(previous)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from google.cloud import vision
+
+from vision_cache import CachedAnnotatorClient, VisionCache
+
+
+class CountingAnnotatorClient(object):
+    """Labels every image with its own bytes and counts annotated images."""
+
+    def __init__(self):
+        self.annotated = 0
+
+    def annotate_image(self, request):
+        self.annotated += 1
+        return self.respond(request)
+
+    def batch_annotate_images(self, requests):
+        self.annotated += len(requests)
+        return vision.types.BatchAnnotateImagesResponse(
+            responses=[self.respond(r) for r in requests])
+
+    @staticmethod
+    def respond(request):
+        label = request.image.content.decode() * 20
+        return vision.types.AnnotateImageResponse(label_annotations=[{"description": label}])
+
+
+def test_cached_annotator_client(tmp_path):
+    """Repeated requests for the same bytes and features should be answered
+    from the cache, even after reopening it, while different features miss."""
+    v_client = CountingAnnotatorClient()
+    labels = {"type": vision.enums.Feature.Type.LABEL_DETECTION}
+    objects = {"type": vision.enums.Feature.Type.OBJECT_LOCALIZATION}
+    image = vision.types.Image(content=b"a")
+
+    cached = CachedAnnotatorClient(v_client, VisionCache(str(tmp_path / "cache.sqlite3")))
+    first = cached.annotate_image({"image": image, "features": [labels]})
+    cached.label_detection(image=image)
+    cached.annotate_image({"image": image, "features": [labels, objects]})
+    assert v_client.annotated == 2
+    assert cached.cache.stats()["hits"] == 1
+    cached.cache.close()
+
+    cached = CachedAnnotatorClient(v_client, VisionCache(str(tmp_path / "cache.sqlite3")))
+    responses = cached.batch_annotate_images([
+        {"image": image, "features": [labels]},
+        {"image": vision.types.Image(content=b"b"), "features": [labels]}]).responses
+    assert v_client.annotated == 3
+    assert responses[0] == first
+    assert responses[1].label_annotations[0].description == "b" * 20
+
+
+def test_vision_cache_eviction(tmp_path):
+    """The least recently used responses should go once the cache is full,
+    down to LOW_WATER of it."""
+    response = vision.types.AnnotateImageResponse(label_annotations=[{"description": "Bird"}])
+    size = len(response.SerializeToString())
+    cache = VisionCache(str(tmp_path / "cache.sqlite3"), max_bytes=int(size * 2.5))
+    cache.put("a", response)
+    cache.put("b", response)
+    cache.get("a")
+    cache.put("c", response)
+    assert cache.get("b") is None
+    assert cache.get("a") == response
+    assert cache.get("c") == response
+    assert cache.stats()["evictions"] == 1
@@ -2,18 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import io
+import json
 import logging
 import os
-import pathlib
 import random
+import sys
+import time
 
 from dateutil.relativedelta import relativedelta
 from flickrapi import shorturl
 from google.cloud import datastore
-from twython import Twython
+from twython import Twython, TwythonError
 
+import asset_store
+import metrics
 import utils
-from flickr_to_datastore import write_entities_to_datastore
+from flickr_to_datastore import (RANDOM_SHARDS, stream_entities_to_datastore,
+                                  write_entities_to_datastore)
 
 ### LOGGING ####################################################################
 logger = logging.getLogger(__name__)
@@ -42,6 +48,94 @@ def pull_keyonly_bird_entities(ds_client, tweeted_before=None):
     return keyonly_entities
 
 
+def pick_random_bird_entity(ds_client, tweeted_before=None, shards=RANDOM_SHARDS,
+                            sample_size=20):
+    """Picks a random bird Photo entity without reading every eligible key:
+    queries `random_shard`s one at a time, in random order, until one has
+    eligible photos, then picks among up to sample_size of them (the
+    least recently tweeted, since results are ordered by last_tweeted). If no
+    shard has any, e.g. because shards haven't been backfilled, falls back to
+    `pull_keyonly_bird_entities`. Photos with a near-duplicate tweeted since
+    tweeted_before are skipped (see `has_recently_tweeted_sibling`).
+
+    Args:
+        tweeted_before (datetime.datetime, optional)
+        shards (int, optional): Defaults to RANDOM_SHARDS.
+        sample_size (int, optional): Defaults to 20.
+
+    Returns:
+        google.cloud.datastore.entity.Entity of kind Photo, or None if nothing
+        is eligible.
+    """
+    for shard in random.sample(range(shards), shards):
+        query = ds_client.query(kind="Photo")
+        query.add_filter("is_bird", "=", True)
+        query.add_filter("random_shard", "=", shard)
+        if tweeted_before:
+            query.add_filter("last_tweeted", "<=", tweeted_before)
+        query.keys_only()
+        keys = [e.key for e in query.fetch(limit=sample_size)]
+        if keys:
+            logger.debug("Picking from %d entities in shard %d.", len(keys), shard)
+            entity = _pick_without_recent_sibling(ds_client, keys, tweeted_before)
+            if entity is not None:
+                return entity
+    logger.warning("No eligible entities in any shard; checking all keys.")
+    keyonly_entities = pull_keyonly_bird_entities(ds_client, tweeted_before=tweeted_before)
+    return _pick_without_recent_sibling(ds_client, [e.key for e in keyonly_entities],
+                                        tweeted_before)
+
+
+def _pick_without_recent_sibling(ds_client, keys, tweeted_before):
+    keys = list(keys)
+    random.shuffle(keys)
+    for key in keys:
+        entity = ds_client.get(key)
+        if not (tweeted_before and has_recently_tweeted_sibling(ds_client, entity, tweeted_before)):
+            return entity
+    return None
+
+
+def cluster_of(entity):
+    """Returns the name of the representative of entity's cluster of
+    near-duplicates (see dedupe.py), which is its own name if it has none."""
+    return entity.get("duplicate_of") or entity.key.name
+
+
+def has_recently_tweeted_sibling(ds_client, entity, tweeted_before):
+    """Returns True if another photo in entity's cluster of near-duplicates
+    was tweeted after tweeted_before."""
+    representative = cluster_of(entity)
+    query = ds_client.query(kind="Photo")
+    query.add_filter("duplicate_of", "=", representative)
+    siblings = list(query.fetch())
+    if representative != entity.key.name:
+        siblings.append(ds_client.get(ds_client.key("Photo", representative)))
+    for sibling in siblings:
+        if sibling is None or sibling.key == entity.key or not sibling.get("last_tweeted"):
+            continue
+        if sibling["last_tweeted"].replace(tzinfo=None) > tweeted_before:
+            return True
+    return False
+
+
+def backfill_random_shards(ds_client, shards=RANDOM_SHARDS):
+    """Gives every Photo entity stored without a `random_shard` one.
+
+    Returns:
+        int: Number of entities updated.
+    """
+    logger.info("Backfilling random_shard...")
+
+    def missing():
+        for entity in ds_client.query(kind="Photo").fetch():
+            if "random_shard" not in entity:
+                entity["random_shard"] = random.randrange(shards)
+                yield entity
+
+    return stream_entities_to_datastore(ds_client, missing())
+
+
 def create_message(entity):
     """Takes Photo entity and returns message string."""
     title = entity.get("title")
@@ -52,20 +146,109 @@ def create_message(entity):
     return message
 
 
-def tweet_photo(message, filepath):
+def make_twitter():
+    """Returns Twython client configured from the environment, with its calls
+    timed by `metrics`."""
     try:
-        twitter = Twython(
+        return metrics.instrument(Twython(
             os.environ['TWITTER_CONSUMER_KEY'],
             os.environ['TWITTER_CONSUMER_SECRET'],
             os.environ['TWITTER_ACCESS_TOKEN'],
             os.environ['TWITTER_ACCESS_SECRET']
-        )
+        ), "twitter")
     except KeyError as e:
         logger.exception(e)
         raise
-    img = open(filepath, 'rb')
+
+
+# https://developer.twitter.com/en/docs/media/upload-media/uploading-media/media-best-practices
+TWITTER_MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+
+def fit_for_twitter(filepath, max_bytes=TWITTER_MAX_IMAGE_BYTES):
+    """Returns filepath if the image is within Twitter's size limit, else the
+    path of a recompressed copy that is ('path/to/assets/name_tweet.jpg')."""
+    if asset_store.get_store().size(filepath) <= max_bytes:
+        return filepath
+    with utils.ImageHandle(filepath) as handle:
+        content = handle.fit_bytes(max_bytes)
+    fitted = f"{filepath[:-4]}_tweet.jpg"
+    logger.info(f"Recompressed {filepath} to {len(content)} bytes for Twitter.")
+    return asset_store.get_store().write(fitted, content)
+
+
+# Bytes per APPEND in a chunked upload; Twitter takes up to 5 MB.
+MEDIA_CHUNK_SIZE = 1024 * 1024
+
+
+def upload_media(filepath, twitter=None, chunk_size=MEDIA_CHUNK_SIZE, retries=3,
+                 backoff=1.0, media_type="image/jpeg"):
+    """Uploads an image to Twitter. Files of up to chunk_size bytes go in one
+    request; bigger ones go through the chunked INIT/APPEND/FINALIZE flow,
+    read from the store and sent chunk_size at a time. Each request is
+    retried on its own after connection errors, 429s and 5xxs.
+
+    Args:
+        filepath (str): 'path/to/assets/name.jpg'
+        twitter (twython.Twython, optional): Defaults to `make_twitter()`.
+        chunk_size (int, optional): Defaults to MEDIA_CHUNK_SIZE.
+        retries (int, optional): Retries per request. Defaults to 3.
+        backoff (float, optional): Seconds before the first retry, doubling
+        after each. Defaults to 1.0.
+        media_type (str, optional): Defaults to "image/jpeg".
+
+    Returns:
+        dict: Twitter's response, including 'media_id'.
+    """
+    twitter = twitter or make_twitter()
+    store = asset_store.get_store()
+    total_bytes = store.size(filepath)
+    chunks = store.read_stream(filepath, chunk_size)
+    if total_bytes <= chunk_size:
+        with io.BytesIO(b"".join(chunks)) as img:
+            return _with_retries(lambda: twitter.upload_media(media=img), retries, backoff,
+                                 rewind=img)
+    logger.debug("Uploading %s in %d byte chunks...", filepath, chunk_size)
+    init = _with_retries(lambda: twitter.upload_media(command="INIT",
+                                                      total_bytes=total_bytes,
+                                                      media_type=media_type,
+                                                      media_category="tweet_image"),
+                         retries, backoff)
+    media_id = init["media_id"]
+    for segment_index, data in enumerate(chunks):
+        _with_retries(lambda: twitter.upload_media(command="APPEND",
+                                                   media_id=media_id,
+                                                   segment_index=segment_index,
+                                                   media=io.BytesIO(data)),
+                      retries, backoff)
+    return _with_retries(lambda: twitter.upload_media(command="FINALIZE", media_id=media_id),
+                         retries, backoff)
+
+
+def _is_transient(error):
+    """Whether a TwythonError is worth retrying: a connection error, which
+    Twython raises without an HTTP status, a 429 or a 5xx."""
+    code = error.error_code
+    return code is None or code == 429 or code >= 500
+
+
+def _with_retries(request, retries, backoff, rewind=None):
+    for attempt in range(retries + 1):
+        try:
+            return request()
+        except TwythonError as e:
+            if attempt == retries or not _is_transient(e):
+                raise
+            logger.warning(f"Twitter upload failed ({e}); retrying.")
+            time.sleep(backoff * 2 ** attempt)
+            if rewind is not None:
+                rewind.seek(0)
+
+
+def tweet_photo(message, filepath, twitter=None):
+    twitter = twitter or make_twitter()
     try:
-        response = twitter.upload_media(media=img)
+        response = upload_media(filepath, twitter)
         logger.debug(response)
         r = twitter.update_status(status=message, media_ids=[response['media_id']])
         logger.info(r)
@@ -75,16 +258,16 @@ def tweet_photo(message, filepath):
         raise
 
 
-def tweet_and_update(ds_client, entity):
+def tweet_and_update(ds_client, entity, twitter=None):
     logger.info(f"Tweeting {entity.key.name}...")
     logger.debug(entity)
     message = create_message(entity)
-    filepath = os.path.join(os.path.dirname(__file__), f'assets/{entity.key.name}.jpg')
+    filepath = os.path.join(utils.ASSETS_DIR, f'{entity.key.name}.jpg')
     logger.debug(filepath)
-    if not pathlib.Path(filepath).exists():
+    if not asset_store.get_store().exists(filepath):
         filepath = utils.download_image(url=entity.get("download_url"),
                                         name=entity.key.name)
-    r = tweet_photo(message, filepath)
+    r = tweet_photo(message, fit_for_twitter(filepath), twitter)
     # TODO: Parse r['created_at'] and use that for last tweeted?
     entity.update({
         "last_tweeted": datetime.datetime.utcnow()
@@ -92,14 +275,150 @@ def tweet_and_update(ds_client, entity):
     write_entities_to_datastore(ds_client, [entity])
     return
 
+### QUEUE ######################################################################
+# Tweets are picked and their images downloaded and fitted ahead of time, so
+# the daily run only reads a staged file and uploads it.
+QUEUE_PATH = os.path.join(os.path.dirname(__file__), "tweet_queue.json")
+QUEUE_LENGTH = 7
+
+
+def load_queue(path=QUEUE_PATH):
+    """Returns list of staged tweets (dicts of name, message and filepath)."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return list()
+
+
+def save_queue(queue, path=QUEUE_PATH):
+    utils.write_atomically(path, json.dumps(queue, indent=2).encode())
+
+
+def stage_tweets(ds_client, n=QUEUE_LENGTH, tweeted_before=None, path=QUEUE_PATH):
+    """Tops the queue up to n tweets: picks photos with
+    `pick_random_bird_entity`, downloads their images in parallel, and fits
+    them to Twitter's size limit.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        n (int, optional): Defaults to QUEUE_LENGTH.
+        tweeted_before (datetime.datetime, optional)
+        path (str, optional): Defaults to QUEUE_PATH.
+
+    Returns:
+        list: The queue.
+    """
+    queue = load_queue(path)
+    queued = {staged["name"] for staged in queue}
+    picked = dict()
+    # Small archives keep turning up the same photos; don't try forever.
+    for _ in range(3 * n):
+        if len(queue) + len(picked) >= n:
+            break
+        entity = pick_random_bird_entity(ds_client, tweeted_before=tweeted_before)
+        if entity is None:
+            break
+        if entity.key.name not in queued:
+            picked[entity.key.name] = entity
+    if not picked:
+        return queue
+    return stage_entities(list(picked.values()), path)
+
+
+def stage_entities(entities, path=QUEUE_PATH, ds_client=None, tweeted_before=None):
+    """Appends entities to the queue, downloading their images in parallel
+    and fitting them to Twitter's size limit. Entities already queued, or
+    whose image won't download, are skipped, and so, if ds_client and
+    tweeted_before are given, are those with a near-duplicate tweeted since
+    tweeted_before (see `has_recently_tweeted_sibling`).
+
+    Returns:
+        list: The queue.
+    """
+    queue = load_queue(path)
+    # Near-duplicates of a queued photo would go out on consecutive days.
+    queued = {staged.get("cluster", staged["name"]) for staged in queue}
+    picked = list()
+    for entity in entities:
+        if ds_client and tweeted_before and has_recently_tweeted_sibling(ds_client, entity,
+                                                                          tweeted_before):
+            logger.debug(f"{entity.key.name} has a recently tweeted near-duplicate; skipping.")
+            continue
+        if cluster_of(entity) not in queued:
+            queued.add(cluster_of(entity))
+            picked.append(entity)
+    entities = picked
+    filepaths = utils.download_images(((e.get("download_url"), e.key.name) for e in entities),
+                                      session=utils.get_session())
+    for entity in entities:
+        name = entity.key.name
+        if name not in filepaths:
+            continue
+        queue.append({"name": name,
+                      "cluster": cluster_of(entity),
+                      "message": create_message(entity),
+                      "filepath": fit_for_twitter(filepaths[name])})
+    save_queue(queue, path)
+    logger.info(f"Staged {len(filepaths)} tweets; {len(queue)} in queue.")
+    return queue
+
+
+def is_eligible(entity, tweeted_before=None):
+    """Returns True if entity is still a bird that hasn't been tweeted since
+    tweeted_before, e.g. when it was staged a while ago."""
+    if entity is None or entity.get("is_bird") != True:
+        return False
+    last_tweeted = entity.get("last_tweeted")
+    return not (tweeted_before and last_tweeted
+                and last_tweeted.replace(tzinfo=None) > tweeted_before)
+
+
+def tweet_next(ds_client, twitter=None, path=QUEUE_PATH, tweeted_before=None):
+    """Tweets the first staged tweet and updates its entity's last_tweeted.
+    Tweets whose image has gone missing, or whose entity has been deleted or
+    is no longer eligible (see `is_eligible`), are dropped. The queue is saved
+    as soon as the tweet is out, so a failure after that can't tweet it again.
+
+    Returns:
+        google.cloud.datastore.entity.Entity tweeted, or None if the queue ran
+        out.
+    """
+    queue = load_queue(path)
+    while queue:
+        staged = queue.pop(0)
+        if not asset_store.get_store().exists(staged["filepath"]):
+            logger.warning(f"Staged image {staged['filepath']} is missing; skipping.")
+            continue
+        entity = ds_client.get(ds_client.key("Photo", staged["name"]))
+        if not is_eligible(entity, tweeted_before):
+            logger.warning(f"Staged {staged['name']} is gone or no longer eligible; skipping.")
+            continue
+        logger.info(f"Tweeting {staged['name']}...")
+        tweet_photo(staged["message"], staged["filepath"], twitter)
+        save_queue(queue, path)
+        entity.update({"last_tweeted": datetime.datetime.utcnow()})
+        write_entities_to_datastore(ds_client, [entity])
+        return entity
+    save_queue(queue, path)
+    return None
+
 ################################################################################
 
 if __name__ == "__main__":
     try:
-        ds_client = datastore.Client()
-        one_month_ago = datetime.datetime.utcnow() - relativedelta(months=1)
-        keyonly_entities = pull_keyonly_bird_entities(ds_client, tweeted_before=one_month_ago)
-        entity = ds_client.get(random.choice(keyonly_entities).key)
-        tweet_and_update(ds_client, entity)
+        ds_client = metrics.instrument(datastore.Client(), "datastore")
+        if "--backfill-shards" in sys.argv:
+            backfill_random_shards(ds_client)
+        else:
+            one_month_ago = datetime.datetime.utcnow() - relativedelta(months=1)
+            if not load_queue():
+                stage_tweets(ds_client, tweeted_before=one_month_ago)
+            if tweet_next(ds_client, tweeted_before=one_month_ago) is None:
+                logger.warning("Nothing to tweet.")
+            # Stage tomorrow's tweets now, while nobody's waiting on them.
+            stage_tweets(ds_client, tweeted_before=one_month_ago)
     except Exception as e:
         logger.exception(e)
+    finally:
+        metrics.emit(os.path.basename(__file__))
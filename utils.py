@@ -1,23 +1,43 @@
+import functools
 import io
+import itertools
+import json
 import logging
 import os
 import pathlib
+import queue
+import re
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.api_core import exceptions
 from google.cloud import vision
 from PIL import Image, ImageDraw
 
+import asset_store
+import metrics
+
 ### LOGGING ####################################################################
 def configure_logger(logger, console_output=False):
-    logger.setLevel(logging.DEBUG)
-    path = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-    fh = logging.FileHandler(os.path.join(path, "birbybot.log"))
-    fh.setLevel(logging.INFO)
+    # DEBUG output includes whole API responses; only ask for it when needed.
+    logger.setLevel(os.environ.get("BIRBYBOT_LOG_LEVEL", "INFO").upper())
     formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(module)s | %(funcName)s | %(message)s')
-    fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    # BIRBYBOT_LOG_FILE moves the log; set to "" it turns the file off.
+    log_file = os.environ.get("BIRBYBOT_LOG_FILE")
+    if log_file is None:
+        path = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+        log_file = os.path.join(path, "birbybot.log")
+    if log_file:
+        fh = logging.FileHandler(log_file)
+        fh.setLevel(logging.INFO)
+        fh.setFormatter(formatter)
+        logger.addHandler(fh)
     if console_output:
         ch = logging.StreamHandler()
         ch.setLevel(logging.DEBUG)
@@ -34,6 +54,214 @@ def chunk(l, n):
         yield l[i:i + n]
 
 
+def ichunk(iterable, n):
+    """Yield successive n-sized lists from any iterable, without reading ahead
+    more than n items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
+class WriteBuffer(object):
+    """Collects entities and saves them with put_multi, up to 500 (the most a
+    Datastore commit takes) at a time, once max_size are waiting or the oldest
+    has waited max_seconds. Use it as a context manager: whatever is still
+    waiting is flushed on the way out, even if an exception is on its way
+    through.
+
+    Entities are only counted in `written` (and passed to on_written) once
+    put_multi has returned; a failed flush puts them back to be retried.
+
+    Args:
+        ds_client (google.cloud.datastore.client.Client)
+        max_size (int, optional): Defaults to 500.
+        max_seconds (float, optional): Defaults to 30.
+        on_written (callable, optional): Called with each list of entities
+        saved. Defaults to None.
+    """
+
+    def __init__(self, ds_client, max_size=500, max_seconds=30, on_written=None):
+        self.ds_client = ds_client
+        self.max_size = max_size
+        self.max_seconds = max_seconds
+        self.on_written = on_written
+        self.written = 0
+        self._pending = list()
+        self._oldest = None
+        # _lock guards _pending; _flush_lock keeps flushes in order, so that a
+        # flush returns only after everything put before it has been saved.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._timer.start()
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.extend(entities)
+            full = len(self._pending) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Saves everything waiting. Puts made meanwhile wait for the next
+        flush rather than for this one's put_multi calls."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, list()
+                oldest, self._oldest = self._oldest, None
+            saved = 0
+            try:
+                for batch in chunk(pending, 500):
+                    logger.debug(f"Writing {len(batch)} entities...")
+                    self.ds_client.put_multi(batch)
+                    saved += len(batch)
+                    with self._lock:
+                        self.written += len(batch)
+                    if self.on_written:
+                        self.on_written(batch)
+            except BaseException:
+                # Ahead of anything put since, to keep the order entities
+                # were put in.
+                with self._lock:
+                    self._pending[:0] = pending[saved:]
+                    self._oldest = oldest if self._oldest is None else min(oldest, self._oldest)
+                raise
+
+    def _flush_periodically(self):
+        while not self._closed.wait(min(self.max_seconds, 1)):
+            with self._lock:
+                stale = self._oldest is not None and time.monotonic() - self._oldest >= self.max_seconds
+            if stale:
+                try:
+                    self.flush()
+                except Exception as e:
+                    # Left pending; the next flush tries again.
+                    logger.exception(e)
+
+    def close(self):
+        """Stops the timer and flushes."""
+        self._closed.set()
+        self._timer.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception as e:
+            # Don't hide the original exception.
+            logger.exception(e)
+
+
+class RateLimiter(object):
+    """Spaces calls at least 1 / calls_per_second seconds apart, across all
+    threads sharing the limiter."""
+
+    def __init__(self, calls_per_second):
+        self.interval = 1.0 / calls_per_second
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the next call is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+    def limit(self, func):
+        """Returns func wrapped to `wait` before every call."""
+        @functools.wraps(func)
+        def limited(*args, **kwargs):
+            self.wait()
+            return func(*args, **kwargs)
+        return limited
+
+
+_DONE = object()
+
+
+def run_stages(items, stages, queue_size=64, sink=None):
+    """Passes items through stages of worker threads connected by bounded
+    queues, so that every stage works at the same time.
+
+    Args:
+        items (iterable): Inputs to the first stage.
+        stages (list): (func, workers) tuples. Each func takes one output of the
+        previous stage and returns the input for the next one; returning None
+        drops the item. Exceptions are logged and drop the item.
+        queue_size (int, optional): Maximum items waiting for each stage.
+        Defaults to 64.
+        sink (callable, optional): Called with each output of the last stage,
+        one at a time, as it completes. Outputs are not kept. Defaults to None.
+
+    Returns:
+        int count of outputs of the last stage.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    completed = 0
+    sink_lock = threading.Lock()
+
+    def work(func, inbox, outbox):
+        nonlocal completed
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # Pass it on so that this stage's other workers stop too.
+                inbox.put(_DONE)
+                return
+            try:
+                result = func(item)
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if result is None:
+                continue
+            if outbox is None:
+                with sink_lock:
+                    completed += 1
+                    if sink is not None:
+                        sink(result)
+            else:
+                outbox.put(result)
+
+    pools = list()
+    for i, (func, workers) in enumerate(stages):
+        outbox = queues[i + 1] if i + 1 < len(queues) else None
+        threads = [threading.Thread(target=work, args=(func, queues[i], outbox), daemon=True)
+                   for _ in range(max(1, workers))]
+        for t in threads:
+            t.start()
+        pools.append(threads)
+
+    for item in items:
+        queues[0].put(item)
+    queues[0].put(_DONE)
+    # Once a stage's workers are done, nothing more can reach the next stage.
+    for i, threads in enumerate(pools):
+        for t in threads:
+            t.join()
+        if i + 1 < len(queues):
+            queues[i + 1].put(_DONE)
+    return completed
+
+
 def trim(s):
     """Recursively get s under 1500 bytes by dividing it in half."""
     if sys.getsizeof(s) < 1500:
@@ -41,6 +269,29 @@ def trim(s):
     return trim(s[:int(len(s)/2)])
 
 
+def compact_labels(labels, max_bytes=1500):
+    """Returns labels as a compact, sorted JSON list that stays valid JSON while
+    fitting in an indexed Datastore string property (1500 bytes), dropping
+    labels from the end if it has to."""
+    labels = sorted(labels)
+    s = json.dumps(labels, separators=(",", ":"))
+    while len(s.encode()) > max_bytes:
+        labels.pop()
+        s = json.dumps(labels, separators=(",", ":"))
+    return s
+
+
+def parse_labels(s):
+    """Returns set of labels stored by `compact_labels`. Also salvages the
+    complete labels from older values that `trim` cut off mid-JSON."""
+    if not s:
+        return set()
+    try:
+        return set(json.loads(s))
+    except ValueError:
+        return set(json.loads(f'"{l}"') for l in re.findall(r'"((?:[^"\\]|\\.)*)"', s))
+
+
 def name_from_path(filepath):
     """Given str 'path/to/assets/name.jpg', returns 'name'."""
     return filepath.split("/")[-1][:-4]
@@ -57,44 +308,470 @@ def vision_img_from_path(v_client, filepath):
         google.cloud.vision_v1.types.Image
     """
     logger.debug(f"Opening {filepath}...")
-    with io.open(filepath, 'rb') as image_file:
-        content = image_file.read()
+    content = asset_store.get_store().read(filepath)
     image = vision.types.Image(content=content)
     return image
 
 
-def download_image(url, name):
+# JPEG quality crops are encoded at; PIL's default.
+CROP_QUALITY = 75
+# JPEG quality images are re-encoded at when downscaled before upload.
+UPLOAD_QUALITY = 85
+
+
+class ImageHandle(object):
+    """Reads an image file once and shares it between everything that needs
+    it: the raw bytes for Vision, the size (read from the header, without
+    decoding), and crops, all cut from one decoded copy made the first time a
+    crop is asked for.
+
+    Args:
+        filepath (str): 'path/to/assets/name.jpg'
+        content (bytes, optional): The file's bytes, if already read.
+    """
+
+    def __init__(self, filepath, content=None):
+        self.filepath = filepath
+        self._content = content
+        self._image = None
+
+    @classmethod
+    def of(cls, image):
+        """Returns image if it's already an ImageHandle, else opens it as a
+        filepath."""
+        return image if isinstance(image, cls) else cls(image)
+
+    @property
+    def content(self):
+        """The file's bytes, read on first use."""
+        if self._content is None:
+            logger.debug(f"Opening {self.filepath}...")
+            self._content = asset_store.get_store().read(self.filepath)
+        return self._content
+
+    @property
+    def image(self):
+        """PIL.Image.Image over content. Opening only parses the header; pixels
+        are decoded when something first needs them."""
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.content))
+        return self._image
+
+    @property
+    def size(self):
+        """(width, height), from the header."""
+        return self.image.size
+
+    def vision_image(self, max_edge=None, quality=UPLOAD_QUALITY):
+        """Returns google.cloud.vision_v1.types.Image of the file's bytes, or,
+        if max_edge is given and the image is bigger, of a copy shrunk to fit in
+        a max_edge square and re-encoded at quality. Vision reports positions
+        normalized to [0, 1], so they apply to the original's `size` either way.
+        """
+        if max_edge and max(self.size) > max_edge:
+            return vision.types.Image(content=self.downscaled_bytes(max_edge, quality))
+        return vision.types.Image(content=self.content)
+
+    def downscaled_bytes(self, max_edge, quality=UPLOAD_QUALITY):
+        """Returns JPEG bytes of the image shrunk to fit in a max_edge square."""
+        self.image.load()
+        with self.image.copy() as im:
+            im.thumbnail((max_edge, max_edge))
+            logger.debug(f"Downscaled {self.filepath} from {self.size} to {im.size}.")
+            return _jpeg_bytes(im, quality)
+
+    def fit_bytes(self, max_bytes, quality=UPLOAD_QUALITY, step=0.8):
+        """Returns the file's bytes if there are at most max_bytes of them,
+        else JPEG bytes re-encoded at quality and shrunk by step until they fit.
+        """
+        if len(self.content) <= max_bytes:
+            return self.content
+        max_edge = max(self.size)
+        while True:
+            content = self.downscaled_bytes(max_edge, quality)
+            if len(content) <= max_bytes or max_edge <= 1:
+                return content
+            max_edge = int(max_edge * step)
+
+    def crop(self, box):
+        """Returns PIL.Image.Image cropped to box from the decoded image."""
+        self.image.load()
+        return self.image.crop(box=box)
+
+    def crop_bytes(self, box, quality=CROP_QUALITY, max_size=None):
+        """Returns crop to box encoded as JPEG bytes.
+
+        Args:
+            box (tuple): (left, upper, right, lower) pixels
+            quality (int, optional): JPEG quality. Defaults to CROP_QUALITY.
+            max_size (int, optional): If given, the crop is shrunk to fit in a
+            max_size square first. Defaults to None.
+
+        Returns:
+            bytes
+        """
+        with self.crop(box) as im:
+            if max_size:
+                im.thumbnail((max_size, max_size))
+            return _jpeg_bytes(im, quality)
+
+    def crop_vision_image(self, box, **kwargs):
+        """Returns `crop_bytes` as a google.cloud.vision_v1.types.Image."""
+        return vision.types.Image(content=self.crop_bytes(box, **kwargs))
+
+    def close(self):
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+        self._content = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _jpeg_bytes(im, quality):
+    """Returns PIL.Image.Image im encoded as JPEG, through an RGB copy (closed
+    once encoded) if JPEG can't hold its mode."""
+    if im.mode not in ("RGB", "L"):
+        with im.convert("RGB") as converted:
+            return _jpeg_bytes(converted, quality)
+    with io.BytesIO() as buffer:
+        im.save(buffer, format='JPEG', quality=quality)
+        return buffer.getvalue()
+
+
+# Most images the Vision API accepts in one images:annotate request.
+# https://cloud.google.com/vision/quotas
+VISION_BATCH_SIZE = 16
+
+
+def batch_annotate(v_client, annotate_requests, batch_size=VISION_BATCH_SIZE):
+    """Sends annotation requests through `batch_annotate_images`, batch_size at
+    a time.
+
+    Args:
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        annotate_requests (list): google.cloud.vision_v1.types.AnnotateImageRequest
+        objects or equivalent dicts
+        batch_size (int, optional): Defaults to VISION_BATCH_SIZE.
+
+    Returns:
+        list of google.cloud.vision_v1.types.AnnotateImageResponse in the same
+        order as annotate_requests. Failed requests have their `error` field set.
+    """
+    responses = list()
+    for batch in chunk(annotate_requests, batch_size):
+        response = v_client.batch_annotate_images(batch)
+        logger.debug("Batch annotated %d images.", len(batch))
+        responses.extend(response.responses)
+    return responses
+
+
+ASSETS_DIR = os.path.join(os.path.dirname(__file__), "assets")
+
+# (connect, read) timeouts in seconds for image downloads.
+HTTP_TIMEOUT = (5, 30)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def make_session(per_host=4, retries=3, backoff=0.5):
+    """Returns requests.Session that keeps connections alive, opens at most
+    per_host connections to any one host (blocking when they're all busy), and
+    retries connection errors and 429/5xx responses with exponential backoff.
+    """
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=16,
+                          pool_maxsize=per_host,
+                          pool_block=True,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """Returns the module's shared `make_session` session."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+class IncompleteDownload(requests.exceptions.RequestException):
+    """Raised when a download ends with a different number of bytes than the
+    server said it would send."""
+
+
+# Bytes per read and write while downloading.
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+# Seconds a partial download can go untouched before it's given up on.
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+
+_download_dbs = dict()
+_download_db_lock = threading.Lock()
+
+
+def _download_db():
+    """Returns the SQLite connection for ASSETS_DIR's download records."""
+    path = os.path.join(ASSETS_DIR, "downloads.sqlite3")
+    with _download_db_lock:
+        if path not in _download_dbs:
+            os.makedirs(ASSETS_DIR, exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS downloads ("
+                       "name TEXT PRIMARY KEY, "
+                       "url TEXT, "
+                       "etag TEXT, "
+                       "last_modified TEXT, "
+                       "length INTEGER)")
+            db.commit()
+            _download_dbs[path] = db
+        return _download_dbs[path]
+
+
+def download_record(name):
+    """Returns dict of the url, etag, last_modified and length (None if the
+    server didn't say) recorded when name was last downloaded, or None."""
+    db = _download_db()
+    with _download_db_lock:
+        row = db.execute("SELECT url, etag, last_modified, length FROM downloads WHERE name = ?",
+                         (name,)).fetchone()
+    if row is None:
+        return None
+    return dict(zip(("url", "etag", "last_modified", "length"), row))
+
+
+def _save_download_record(name, url, etag, last_modified, length):
+    db = _download_db()
+    with _download_db_lock:
+        db.execute("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?)",
+                   (name, url, etag, last_modified, length))
+        db.commit()
+
+
+def download_image(url, name, session=None, timeout=HTTP_TIMEOUT, revalidate=False,
+                   resumes=2):
     # TODO: Handle other filetypes than JPG?
-    """Downloads image from url, saves to disk, returns filepath.
+    """Downloads image from url, saves it in the asset store (see
+    `asset_store.get_store`), returns filepath.
+
+    Bytes go to 'path/to/assets/partial/name.jpg.part' as they arrive, and
+    only reach the store once there are as many as the server's
+    Content-Length. A download cut short resumes from where it stopped with a
+    Range request (guarded by If-Range, so a changed image starts over),
+    right away up to resumes times, or on a later call (see
+    `remove_stale_partials`). Each image's ETag, Last-Modified and length are
+    recorded, so a stored image of the wrong size is downloaded again, and, if
+    revalidate, an image the server says is unchanged (304) isn't.
 
     Args:
         url (str): URL of image
         name (str): Name to save file as (do not include extension)
+        session (requests.Session, optional): Defaults to `get_session()`.
+        timeout (tuple, optional): Defaults to HTTP_TIMEOUT.
+        revalidate (bool, optional): Ask the server whether a stored image
+        has changed. Defaults to False.
+        resumes (int, optional): Defaults to 2.
     
     Returns:
         str: e.g., "path/to/assets/name.jpg"
+
+    Raises:
+        requests.exceptions.RequestException, e.g., IncompleteDownload
     """
-    if not os.path.exists("assets"):
-        pathlib.Path("assets").mkdir(parents=True)
-    filepath = os.path.join(os.path.dirname(__file__), f'assets/{name}.jpg')
+    filepath = os.path.join(ASSETS_DIR, f'{name}.jpg')
+    store = asset_store.get_store()
+    record = download_record(name)
+    headers = dict()
     
     # If we've already downloaded an image, just return.
-    if os.path.exists(filepath):
-        logger.debug(f"{filepath} already exists.")
+    if store.exists(filepath):
+        if record and record["length"] is not None and store.size(filepath) != record["length"]:
+            logger.warning(f"{filepath} isn't {record['length']} bytes; downloading again.")
+            store.remove(filepath)
+        elif not revalidate:
+            logger.debug(f"{filepath} already exists.")
+            return filepath
+        elif record and record["url"] == url:
+            if record["etag"]:
+                headers["If-None-Match"] = record["etag"]
+            if record["last_modified"]:
+                headers["If-Modified-Since"] = record["last_modified"]
+
+    partial = os.path.join(ASSETS_DIR, "partial", f"{name}.jpg.part")
+    session = session or get_session()
+    for attempt in range(resumes + 1):
+        try:
+            with metrics.timer("download.image"):
+                received = _download_to_partial(url, name, partial, session, timeout,
+                                                dict(headers))
+            break
+        except (requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ConnectionError,
+                IncompleteDownload) as e:
+            if attempt == resumes or not os.path.exists(partial):
+                raise
+            logger.warning(f"Download of {name} stopped at {os.path.getsize(partial)} bytes "
+                           f"({e}); resuming.")
+    if received is None:
+        logger.debug(f"{filepath} hasn't changed.")
         return filepath
-    
-    logger.debug(f"Opening {url}...")
-    r = requests.get(url, stream=True)
-    if r.status_code == 200:
-        with open(filepath, 'wb') as image:
-            for chunk in r:
-                image.write(chunk)
-        logger.debug(f"Saved image as {filepath}")
+
+    with open(partial, "rb") as f:
+        store.write_stream(filepath, iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), b""))
+    os.remove(partial)
+    logger.debug(f"Saved image as {filepath}")
+    return filepath
+
+
+def _content_range(header):
+    """Given 'bytes 1000-4999/5000', returns (1000, 5000). The total is None
+    if the server doesn't know it, and both are None for a malformed header."""
+    match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", header or "")
+    if not match:
+        return None, None
+    return int(match.group(1)), int(match.group(2)) if match.group(2) != "*" else None
+
+
+def remove_stale_partials(max_age=PARTIAL_MAX_AGE):
+    """Deletes partial downloads in ASSETS_DIR that haven't grown for max_age
+    seconds, e.g. of images whose URL keeps failing.
+
+    Returns:
+        int: Number of files deleted.
+    """
+    directory = os.path.join(ASSETS_DIR, "partial")
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for f in os.listdir(directory):
+        path = os.path.join(directory, f)
+        try:
+            if f.endswith(".part") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            # Finished or removed meanwhile.
+            continue
+    if removed:
+        logger.info(f"Removed {removed} stale partial downloads.")
+    return removed
+
+
+def _download_to_partial(url, name, partial, session, timeout, headers):
+    """Downloads url into partial, resuming it if it was cut short. Returns the
+    number of bytes received, or None if the server answered 304. Bytes
+    received count towards 'download.bytes' even if the download then fails.
+    """
+    record = download_record(name)
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    validator = record and record["url"] == url and (record["etag"] or record["last_modified"])
+    if offset and validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
     else:
-        logger.error(f"Failed to download {name} from {url}")
-        r.raise_for_status()
+        offset = 0
+    # Lengths and ranges must count the bytes stored, not a compressed form.
+    headers["Accept-Encoding"] = "identity"
+
+    logger.debug("Opening %s...", url)
+    r = session.get(url, stream=True, timeout=timeout, headers=headers)
+    received = offset
+    try:
+        if r.status_code == 304:
+            return None
+        if r.status_code == 206:
+            start, length = _content_range(r.headers.get("Content-Range"))
+            if start != offset:
+                os.remove(partial)
+                raise IncompleteDownload(f"Asked for {name} from byte {offset}, got {start}")
+            metrics.count("download.resumed")
+        elif r.status_code == 200:
+            offset = 0
+            length = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+        else:
+            logger.error(f"Failed to download {name} from {url}")
+            # Nothing to resume: the range is wrong, or the image is gone.
+            if r.status_code in (404, 410, 416) and os.path.exists(partial):
+                os.remove(partial)
+            r.raise_for_status()
+            raise IncompleteDownload(f"Unexpected {r.status_code} for {name}")
+        _save_download_record(name, url, r.headers.get("ETag") or (record or {}).get("etag"),
+                              r.headers.get("Last-Modified"), length)
+
+        pathlib.Path(os.path.dirname(partial)).mkdir(parents=True, exist_ok=True)
+        with open(partial, "ab" if offset else "wb") as f:
+            for block in r.iter_content(chunk_size=DOWNLOAD_BLOCK_SIZE):
+                f.write(block)
+                received += len(block)
+    finally:
+        r.close()
+        metrics.count("download.bytes", received - offset)
+    if length is not None and received != length:
+        if received > length:
+            os.remove(partial)
+        raise IncompleteDownload(f"Got {received} of {length} bytes of {name}")
+    return received - offset
+
+
+def write_atomically(filepath, content):
+    """Writes bytes to filepath through a temporary file renamed into place,
+    so readers never see it half-written."""
+    asset_store.write_atomically(filepath, [content])
     return filepath
 
+
+def download_images(pairs, max_workers=8, per_host=4, timeout=HTTP_TIMEOUT,
+                    retries=3, backoff=0.5, session=None):
+    """Downloads many images in parallel over one pooled session. See
+    `download_image` and `make_session`.
+
+    Args:
+        pairs (iterable): (url, name) tuples
+        max_workers (int, optional): Downloads in flight. Defaults to 8.
+        per_host (int, optional): Connections per host. Defaults to 4.
+        timeout (tuple, optional): Defaults to HTTP_TIMEOUT.
+        retries (int, optional): Defaults to 3.
+        backoff (float, optional): Defaults to 0.5.
+        session (requests.Session, optional): Session to share with other
+        callers, e.g. `get_session()`; per_host, retries and backoff are then
+        ignored. Defaults to a new `make_session` session for this call.
+
+    Returns:
+        dict of name: filepath for the images that downloaded. Failures are
+        logged and left out.
+    """
+    own_session = session is None
+    if own_session:
+        session = make_session(per_host=per_host, retries=retries, backoff=backoff)
+    remove_stale_partials()
+    filepaths = dict()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(download_image, url, name, session, timeout): name
+                       for url, name in pairs}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    filepaths[name] = future.result()
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"Failed to download {name}: {e}")
+    finally:
+        if own_session:
+            session.close()
+    logger.debug(f"Downloaded {len(filepaths)} of {len(futures)} images.")
+    return filepaths
+
 ################################################################################
 def draw_on_box(box, filepath):
     """Given a list of coordinates and a JPG location to open, draws box and
@@ -103,46 +780,55 @@ def draw_on_box(box, filepath):
     Args:
         box (list): Integer coordinates of polygon vertices. Example: [392, 353,
         542, 353, 542, 470, 392, 470]
-        filepath (str): 'path/to/assets/name.jpg'
+        filepath (str or ImageHandle): 'path/to/assets/name.jpg'
     
     Returns:
         str: path to new file
     """
     # https://cloud.google.com/vision/docs/crop-hints
-    if not os.path.exists("assets/cropped"):
-        pathlib.Path("assets/cropped").mkdir(parents=True)
-    name = name_from_path(filepath)
-    draw_path = os.path.join(os.path.dirname(__file__), f'assets/cropped/{name}_boxed.jpg')
-    with Image.open(filepath) as im:
+    handle = ImageHandle.of(filepath)
+    try:
+        name = name_from_path(handle.filepath)
+        draw_path = os.path.join(os.path.dirname(__file__), f'assets/cropped/{name}_boxed.jpg')
+        handle.image.load()
         # Don't draw on original.
-        with im.copy() as im2:
+        with handle.image.copy() as im2:
             draw = ImageDraw.Draw(im2)
             draw.polygon(xy=box,
                          fill=None,
                          outline='red')
-            im2.save(draw_path, 'JPEG')
-    return draw_path
+            with io.BytesIO() as buffer:
+                im2.save(buffer, 'JPEG')
+                return asset_store.get_store().write(draw_path, buffer.getvalue())
+    finally:
+        # A handle passed in belongs to the caller.
+        if handle is not filepath:
+            handle.close()
 
 
-def crop_to_box(box, filepath):
+def crop_to_box(box, filepath, quality=CROP_QUALITY, max_size=None):
     """Given a list of points and a JPG location to open, draws crops to points
     and saves as new file.
     
     Args:
         box (list): Integer points of box. Example: [392, 353, 542, 470]
-        filepath (str): 'path/to/assets/name.jpg'
+        filepath (str or ImageHandle): 'path/to/assets/name.jpg'
+        quality (int, optional): See `ImageHandle.crop_bytes`.
+        max_size (int, optional): See `ImageHandle.crop_bytes`.
     
     Returns:
         str: path to new file
     """
-    if not os.path.exists("assets/cropped"):
-        pathlib.Path("assets/cropped").mkdir(parents=True)
-    name = name_from_path(filepath)
-    crop_path = os.path.join(os.path.dirname(__file__), f'assets/cropped/{name}_cropped.jpg')
-    with Image.open(filepath) as im:
-        with im.crop(box=box) as im2:
-            im2.save(crop_path, 'JPEG')
-    return crop_path
+    handle = ImageHandle.of(filepath)
+    try:
+        name = name_from_path(handle.filepath)
+        crop_path = os.path.join(os.path.dirname(__file__), f'assets/cropped/{name}_cropped.jpg')
+        return asset_store.get_store().write(crop_path,
+                                             handle.crop_bytes(box, quality=quality, max_size=max_size))
+    finally:
+        # A handle passed in belongs to the caller.
+        if handle is not filepath:
+            handle.close()
 
 
 def get_safety_annotations(v_client, image):
@@ -159,7 +845,7 @@ def get_safety_annotations(v_client, image):
     """
     # https://cloud.google.com/vision/docs/detecting-safe-search
     response = v_client.safe_search_detection(image=image)
-    logger.debug(f"API response for safe_search_detection: {response}")
+    logger.debug("API response for safe_search_detection: %s", response)
     if not response.safe_search_annotation:
         logger.error(f"No safety annotations for image.")
         raise exceptions.GoogleAPIError(f"No safety annotations for image. Vision API response: {response}")
@@ -170,7 +856,7 @@ def get_safety_annotations(v_client, image):
                           "spoofed": likelihood_name[response.safe_search_annotation.spoof],
                           "violence": likelihood_name[response.safe_search_annotation.violence],
                           "racy": likelihood_name[response.safe_search_annotation.racy]}
-    logger.debug(f"Returning safety_annotations: {safety_annotations}")
+    logger.debug("Returning safety_annotations: %s", safety_annotations)
     return safety_annotations
 
 
@@ -187,12 +873,12 @@ def get_label_annotations(v_client, filepath):
     # https://cloud.google.com/vision/docs/reference/rest/v1/images/annotate#EntityAnnotation
     image = vision_img_from_path(v_client, filepath)
     response = v_client.label_detection(image=image)
-    logger.debug(f"API response for label_detection: {response}")
+    logger.debug("API response for label_detection: %s", response)
     if not response.label_annotations:
         logger.error(f"No label annotations for image.")
         raise exceptions.GoogleAPIError(f"No label annotations for image. Vision API response: {response}")
     labels = list(l.description for l in response.label_annotations)
-    logger.debug(f"Returning label annotations: {labels}")
+    logger.debug("Returning label annotations: %s", labels)
     return labels
 
 
@@ -202,7 +888,7 @@ def get_object_annotations(v_client, filepath):
 
     Args:
         v_client (google.cloud.vision_v1.ImageAnnotatorClient)
-        filepath (str): 'path/to/assets/name.jpg'
+        filepath (str or ImageHandle): 'path/to/assets/name.jpg'
     
     Returns:
         list of object annotation dictionaries with object name and box
@@ -213,13 +899,14 @@ def get_object_annotations(v_client, filepath):
         353, 542, 353, 542, 470, 392, 470]}]
     """
     # https://cloud.google.com/vision/docs/detecting-objects
-    image = vision_img_from_path(v_client, filepath)
-    response = v_client.object_localization(image=image)
-    logger.debug(f"Response for {filepath} object_localization request: {response}")
+    handle = ImageHandle.of(filepath)
+    filepath = handle.filepath
+    response = v_client.object_localization(image=handle.vision_image())
+    logger.debug("Response for %s object_localization request: %s", filepath, response)
     if not response.localized_object_annotations:
         logger.error(f"No object annotations for {filepath}.")
         raise exceptions.GoogleAPIError(f"No object annotations for {filepath}. Vision API response: {response}") 
-    width, height = Image.open(filepath).size
+    width, height = handle.size
     object_annotations = list()
     for o in response.localized_object_annotations:
         oa = dict()
@@ -236,7 +923,7 @@ def get_object_annotations(v_client, filepath):
                           round(verts[2].x * width), round(verts[2].y * height),
                           round(verts[3].x * width), round(verts[3].y * height)]
         object_annotations.append(oa)
-    logger.debug(f"Returning object annotations: {object_annotations}")
+    logger.debug("Returning object annotations: %s", object_annotations)
     return object_annotations
 
 
@@ -259,13 +946,13 @@ def get_crop_hints(v_client, filepath):
     # https://cloud.google.com/vision/docs/crop-hints
     image = vision_img_from_path(v_client, filepath)
     response = v_client.crop_hints(image=image)
-    logger.debug(f"API response for crop_hints: {response}")
+    logger.debug("API response for crop_hints: %s", response)
     if not response.crop_hints_annotation:
         logger.error(f"No crop hints annotation for image.")
         raise exceptions.GoogleAPIError(f"No object annotations for image. Vision API response: {response}")
     hints = response.crop_hints_annotation.crop_hints
     vertices = hints[0].bounding_poly.vertices
-    logger.debug(f"Returning crop hints bounding poly vertices: {vertices}")
+    logger.debug("Returning crop hints bounding poly vertices: %s", vertices)
     return vertices
 
 
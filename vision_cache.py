@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from google.cloud import vision
+
+import utils
+
+### LOGGING ####################################################################
+logger = logging.getLogger(__name__)
+utils.configure_logger(logger, console_output=True)
+################################################################################
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "assets/vision_cache.sqlite3")
+# Eviction frees space down to this fraction of max_bytes, so that it doesn't
+# run again on the next put.
+LOW_WATER = 0.9
+# Cache hits whose last_used is written back in one go.
+TOUCH_BATCH = 100
+
+
+class VisionCache(object):
+    """Persistent cache of Vision API annotation responses, keyed by a hash of
+    the image bytes plus the requested features. When the stored responses
+    grow past max_bytes, the least recently used ones are evicted, down to
+    LOW_WATER of max_bytes. Hits update last_used in batches of TOUCH_BATCH.
+
+    Args:
+        path (str, optional): SQLite database file. Defaults to
+        'path/to/assets/vision_cache.sqlite3'.
+        max_bytes (int, optional): Defaults to 256 MB.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=256 * 1024 * 1024):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, "
+                         "response BLOB NOT NULL, "
+                         "size INTEGER NOT NULL, "
+                         "last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used "
+                         "ON responses (last_used)")
+        self._db.commit()
+        self._touched = dict()  # Key -> when it was last used, not yet written.
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(request):
+        """Returns cache key for a google.cloud.vision_v1.types.AnnotateImageRequest,
+        or None if the image isn't sent as bytes (e.g., it's a URI)."""
+        if not request.image.content:
+            return None
+        h = hashlib.sha256(request.image.content)
+        for feature in request.features:
+            h.update(feature.SerializeToString(deterministic=True))
+        h.update(request.image_context.SerializeToString(deterministic=True))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns cached google.cloud.vision_v1.types.AnnotateImageResponse or None."""
+        with self._lock:
+            row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched()
+                self._db.commit()
+        return vision.types.AnnotateImageResponse.FromString(row[0])
+
+    def put(self, key, response):
+        """Caches response under key, then evicts until under max_bytes."""
+        blob = response.SerializeToString()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old:
+                self._size -= old[0]
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                             (key, blob, len(blob), time.time()))
+            self._size += len(blob)
+            self._evict()
+            self._db.commit()
+
+    def _write_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                 [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        self._write_touched()
+        target = self.max_bytes * LOW_WATER
+        victims = list()
+        freed = 0
+        # Walks the last_used index only as far as it needs to, and deletes
+        # exactly the rows it counted.
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if self._size - freed <= target:
+                break
+            victims.append((key,))
+            freed += size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self._size -= freed
+        self.evictions += len(victims)
+
+    def stats(self):
+        """Returns dict of hit/miss/eviction counters and cache size."""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self._size}
+
+    def close(self):
+        with self._lock:
+            self._write_touched()
+            self._db.commit()
+            self._db.close()
+
+
+class CachedAnnotatorClient(object):
+    """Wraps google.cloud.vision.ImageAnnotatorClient so that annotation
+    requests are answered from a VisionCache when possible. Anything else is
+    passed through to the wrapped client.
+
+    Args:
+        v_client (google.cloud.vision_v1.ImageAnnotatorClient)
+        cache (VisionCache, optional): Defaults to a VisionCache at DEFAULT_PATH.
+    """
+
+    def __init__(self, v_client, cache=None):
+        self.v_client = v_client
+        self.cache = cache if cache is not None else VisionCache()
+
+    def __getattr__(self, name):
+        return getattr(self.v_client, name)
+
+    def annotate_image(self, request, **kwargs):
+        request = _to_request(request)
+        key = VisionCache.key(request)
+        if key:
+            response = self.cache.get(key)
+            if response is not None:
+                return response
+        response = self.v_client.annotate_image(request, **kwargs)
+        if key and not response.error.message:
+            self.cache.put(key, response)
+        return response
+
+    def batch_annotate_images(self, requests, **kwargs):
+        requests = [_to_request(r) for r in requests]
+        keys = [VisionCache.key(r) for r in requests]
+        responses = [self.cache.get(k) if k else None for k in keys]
+        misses = [i for i, r in enumerate(responses) if r is None]
+        if misses:
+            fetched = self.v_client.batch_annotate_images([requests[i] for i in misses], **kwargs)
+            for i, response in zip(misses, fetched.responses):
+                responses[i] = response
+                if keys[i] and not response.error.message:
+                    self.cache.put(keys[i], response)
+        return vision.types.BatchAnnotateImagesResponse(responses=responses)
+
+    def label_detection(self, image, **kwargs):
+        return self._detect(image, vision.enums.Feature.Type.LABEL_DETECTION, **kwargs)
+
+    def object_localization(self, image, **kwargs):
+        return self._detect(image, vision.enums.Feature.Type.OBJECT_LOCALIZATION, **kwargs)
+
+    def safe_search_detection(self, image, **kwargs):
+        return self._detect(image, vision.enums.Feature.Type.SAFE_SEARCH_DETECTION, **kwargs)
+
+    def crop_hints(self, image, **kwargs):
+        return self._detect(image, vision.enums.Feature.Type.CROP_HINTS, **kwargs)
+
+    def _detect(self, image, feature_type, max_results=None, **kwargs):
+        feature = {"type": feature_type}
+        if max_results:
+            feature["max_results"] = max_results
+        return self.annotate_image({"image": image, "features": [feature]}, **kwargs)
+
+
+def _to_request(request):
+    """Returns request as a google.cloud.vision_v1.types.AnnotateImageRequest."""
+    if isinstance(request, dict):
+        return vision.types.AnnotateImageRequest(**request)
+    return request